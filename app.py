@@ -13,25 +13,34 @@
 # limitations under the License.
 
 import traceback
-import vertexai
+import atexit
+import json
 import os
 import logging
-
-import vertexai.preview.generative_models as generative_models
-from vertexai.preview.generative_models import (
-    GenerationConfig,
-    GenerativeModel,
-    Part,
-    Tool,
-)
-
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-from flask import Flask, request, jsonify, render_template
-
-from common import config as configuration, function_calling, rag
-from services.user import User as UserService
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from common.startup import LazyResource, StartupTimings, warm_up
+
+timings = StartupTimings()
+
+with timings.phase("import flask"):
+    from flask import Flask, Response, g, request, jsonify, render_template, send_file, stream_with_context
+
+from common import config as configuration, function_calling, tracing
+from common.admission import AdmissionController, AdmissionRejected
+from common.assets import AssetStore
+from common.cassette import Cassette
+from common.hedging import Hedger
+from common.history_store import HistoryStore
+from common.jobs import JobScheduler
+from common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from common.session_store import SessionStore
+from common.single_flight import SingleFlight
+from common.tracing import Tracer
+from common.turns import TurnRejected, UserTurns
+from services.model_cache import ModelCache
 
 # Environment variables
 
@@ -39,22 +48,39 @@ PROJECT_ID = os.environ.get("PROJECT_ID", "<GCP_PROJECT_ID>")
 REGION = os.environ.get("REGION", "<GCP_REGION>")
 FAKE_USER_ID = "7608dc3f-d239-405c-a097-b152ab38a354"
 
-SAFETY_SETTINGS = {
-    generative_models.HarmCategory.HARM_CATEGORY_UNSPECIFIED: generative_models.HarmBlockThreshold.BLOCK_NONE,
-    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
-    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
-}
-
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
 
-vertexai.init(project=PROJECT_ID, location=REGION)
-
 config = configuration.Config.get_instance()
 
+# Vertex AI and Firebase are imported and initialized lazily (or warmed up in the background)
+# so the server can start listening before their import cost is paid
+
+def init_vertexai():
+    with timings.phase("import vertexai"):
+        import vertexai
+        import vertexai.preview.generative_models
+
+    vertexai.init(project=PROJECT_ID, location=REGION)
+    return vertexai
+
+def init_safety_settings():
+    vertexai_module = vertex.get()
+    generative_models = vertexai_module.preview.generative_models
+
+    return {
+        generative_models.HarmCategory.HARM_CATEGORY_UNSPECIFIED: generative_models.HarmBlockThreshold.BLOCK_NONE,
+        generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+        generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+        generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_NONE,
+        generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_NONE,
+    }
+
 def init_model():
+    vertex.get()
+    from vertexai.preview.generative_models import GenerationConfig, GenerativeModel, Tool
+    from services.user import User as UserService
+
     retail_tool = Tool(
         function_declarations=UserService.get_function_declarations(),        
     )
@@ -69,14 +95,29 @@ def init_model():
     return model
 
 def init_rag_model(): 
+    global rag_corpus
+
     if(config.get_property('rag', 'use_rag') == "false"):
         print("Not using RAG since it's disabled in config.ini")
         return init_model() # Fallback to regular model
     
-    _rag = rag.RAG(config)    
+    vertex.get()
+    from vertexai.preview.generative_models import GenerativeModel, Tool
+
+    if config.get_property('rag', 'engine') == "local":
+        from common import local_rag
+
+        # Builds or maps the local index in the background, the retrieved chunks go into the prompt
+        rag_corpus = local_rag.LocalRAG(config)
+        return GenerativeModel(model_name=config.get_property('general', 'gemini_version'))
+
+    from common import rag
+
+    # Syncs the corpus files in the background, see rag_corpus.is_ready()
+    rag_corpus = rag.RAG(config)
 
     rag_retrieval_tool = Tool.from_retrieval(
-        _rag.get_rag_retrieval()
+        rag_corpus.get_rag_retrieval()
     )
     # Create a gemini-pro model instance
     model = GenerativeModel(
@@ -86,36 +127,304 @@ def init_rag_model():
 
     return model
 
+def init_firestore():
+    with timings.phase("import firebase_admin"):
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+    cred = credentials.ApplicationDefault()  # Or use a service account key file
+    firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+def init_model_cache():
+    cache = ModelCache.from_config(config)
+    if config.get_property('cache', 'model_cache_watch') == "true":
+        cache.start_watch(db.get().collection("models"))
+    return cache
+
+def init_model_writes():
+    from services.model_writes import ModelWriteBuffer
+
+    # Dropped updates are not kept in the model cache either
+    buffer = ModelWriteBuffer.from_config(config, db.get(), on_drop=model_cache.get().invalidate)
+    buffer.start()
+    # Pending updates are written before the worker exits
+    atexit.register(buffer.stop)
+    return buffer
+
+def init_answer_cache():
+    if config.get_property('answer_cache', 'enabled') != "true":
+        return None
+
+    vertex.get()
+    from common import local_rag
+    from common.answer_cache import AnswerCache
+
+    embedder = None
+    limiter = None
+    if config.get_property('answer_cache', 'embedder') == "vertex":
+        # Embeddings are network calls with their own quota
+        limiter = admission.limiter("embeddings")
+        if cassette is not None:
+            embedder = cassette.client("embeddings", "answer_cache", lambda: local_rag.create_embedder(config, 'answer_cache', 'embedder', 'embedding_model'))
 
-# Chat initialization per tenant (cleanup needed after timeout/logout)
+    return AnswerCache.from_config(config, embedder, limiter)
+
+def init_intent_router():
+    if config.get_property('intent_router', 'enabled') != "true":
+        return None
+
+    from common.intent_router import IntentRouter
+    from services.user import User as UserService
+
+    return IntentRouter.from_config(config, UserService.get_function_declarations())
+
+def init_compactor():
+    if config.get_property('compaction', 'enabled') != "true":
+        return None
+
+    vertex.get()
+    from vertexai.preview.generative_models import GenerativeModel
+    from common.compaction import HistoryCompactor
+
+    summary_model = upstream("gemini", "summary", lambda: GenerativeModel(config.get_property('compaction', 'summary_model')))
+    return HistoryCompactor.from_config(config, summary_model, admission.limiter("gemini"))
+
+def init_user_service():
+    from services.user import User as UserService
+
+    service = UserService(db.get(), config, rag_model.get(), job_scheduler, model_cache.get(), rag_corpus, answer_cache.get(), admission, rag_hedger, single_flight, model_writes.get(), assets)
+    if cassette is not None:
+        service.avatars.imagen = cassette.client("imagen", "avatars", service.avatars.model)
+    return service
+
+# Upstream clients go through the cassette when recording or replaying, see [cassette]
+def upstream(kind, name, factory, **options):
+    if cassette is None:
+        return factory()
+    return cassette.client(kind, name, factory, **options)
+
+def recorded(path, fields):
+    return cassette.request(path, fields) if cassette is not None else nullcontext()
+
+# Chat turns are traced under the X-Request-ID of the request, or a new one sent back in it
+def request_id(headers):
+    g.request_id = headers.get("X-Request-ID") or uuid.uuid4().hex
+    return g.request_id
+
+def traced(path, turn_request_id):
+    return tracer.trace(path, turn_request_id) if tracer is not None else nullcontext()
+
+
+# Chat initialization per tenant (idle sessions are evicted by the session store)
 def init_chat(model, user_id):
-    if user_id in client_sessions and client_sessions[user_id] != None:
-        logging.debug("Re-using existing session")
-        return client_sessions[user_id]
+    with tracing.span("init_chat"):
+        chat_client = sessions.get_session(user_id)
+
+        # Another worker or instance may have served this user since, which makes our session stale
+        if chat_client is not None and history_store.length(user_id) == len(chat_client.history):
+            logging.debug("Re-using existing session")
+        else:
+            logging.debug("Creating new chat session for user %s", user_id)
+
+            history = history_store.load(user_id)
+            chat_client = model.start_chat(history=history)
+
+            sessions.put(user_id, chat_client, chat_client.history)
+
+        # Older turns summarized since the last turn are swapped in before the history is sent again
+        history_compactor = compactor.get()
+        if history_compactor is not None and history_compactor.apply(user_id, chat_client.history):
+            history_store.replace(user_id, chat_client.history)
+            sessions.update_history(user_id, chat_client.history)
+
+        return chat_client
+
+def save_history(user_id, history):
+    with tracing.span("save_history"):
+        sessions.update_history(user_id, history)
+        history_store.save(user_id, history)
+
+    history_compactor = compactor.get()
+    if history_compactor is not None:
+        history_compactor.schedule(user_id, history)
+
+def evict_history(user_id):
+    history_store.evict(user_id)
+
+    if compactor.is_ready() and compactor.get() is not None:
+        compactor.get().forget(user_id)
+
+# Sends one message of a chat turn. A hedged request may be sent twice, so it goes through
+# generate_content with the history and only the winning response is appended to it
+def send_chat_message(chat, message):
+    gemini = admission.limiter("gemini")
+
+    if chat_hedger is None:
+        return gemini.call(chat.send_message, message, safety_settings=safety_settings.get())
 
-    logging.debug("Creating new chat session for user %s", user_id)
+    contents, request_content = chat_request(chat, message)
+    response = chat_hedger.call(gemini.call, chat_model.get().generate_content, contents, safety_settings=safety_settings.get())
 
-    if user_id not in history_clients:
-        history_clients[user_id] = []
+    return append_chat_response(chat, contents, request_content, response)
 
-    chat_client = model.start_chat(history=history_clients[user_id])
+def chat_request(chat, message):
+    from vertexai.preview.generative_models import Content
 
-    client_sessions[user_id] = chat_client
-    return client_sessions[user_id]
+    request_content = Content(role="user", parts=message if isinstance(message, list) else [message])
+    return chat.history + [request_content], request_content
 
-# Init models 
-chat_model = init_model()
-rag_model = init_rag_model()
+def append_chat_response(chat, contents, request_content, response):
+    # What ChatSession.send_message does with the response
+    validate_chat_response(contents, response)
 
-cred = credentials.ApplicationDefault()  # Or use a service account key file
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+    response_content = response.candidates[0].content
+    response_content.role = "model"
+    chat.history.extend([request_content, response_content])
 
-user_service = UserService(db, config, rag_model)
+    return response
+
+def validate_chat_response(contents, response):
+    # Blocked or incomplete responses are kept out of the history, as a chat session does
+    from vertexai.preview.generative_models import FinishReason, ResponseValidationError
+
+    if not response.candidates:
+        message = "The model response was blocked."
+    elif response.candidates[0].finish_reason not in (FinishReason.STOP, FinishReason.FINISH_REASON_UNSPECIFIED):
+        message = "The model response did not complete successfully. Finish reason: %s." % response.candidates[0].finish_reason.name
+    else:
+        return
+
+    raise ResponseValidationError(message=message, request_contents=contents, responses=[response])
+
+# Runs every function call of a model response, independent ones concurrently
+def run_function_calls(function_calls, user_id):
+    prepare_function_calls(function_calls, user_id)
+
+    with tracing.span("function_calls"):
+        results = function_calling.call_functions(user_service.get(), function_calls, function_executor)
+
+    return function_response_parts(function_calls, results)
+
+def prepare_function_calls(function_calls, user_id):
+    for _, function_params in function_calls:
+        # Injection of user_id (this should be done dynamically when proper auth is implemented)
+        function_params['user_id'] = user_id
+
+    logging.info(function_calls)
+    logging.info("Calling  " + ", ".join(function_name for function_name, _ in function_calls))
+
+# The parts sending the results back to the model in one message, and the html for the user
+def function_response_parts(function_calls, results):
+    from vertexai.preview.generative_models import Part
+
+    parts = [
+        Part.from_function_response(
+            name=function_name,
+            response={
+                "content": function_response,
+            },
+        )
+        for (function_name, _), (function_response, _) in zip(function_calls, results)
+    ]
+    html_response = "".join(html for _, html in results)
+
+    return parts, html_response
+
+# Trivial commands are dispatched locally, returns None when the prompt needs the model
+def route_fast_path(chat, user_id, prompt_text):
+    router = intent_router.get()
+    if router is None:
+        return None
+
+    match = router.route(prompt_text)
+    if match is None:
+        return None
+
+    function_name, confidence = match
+    logging.info("Routing prompt to %s without the model (confidence %.2f)", function_name, confidence)
+
+    function_response, html_response = function_calling.normalize_function_result(
+        function_calling.call_function(user_service.get(), function_name, {"user_id": user_id}))
+    reply = router.reply_for(function_name)
+
+    chat.history.extend(router.history_turns(prompt_text, function_name, function_response, reply))
+    save_history(user_id, chat.history)
+
+    return reply, html_response
+
+# Init models and clients
+rag_corpus = None
+
+# Client-side quota, concurrency limit and retries for every model call
+admission = AdmissionController.from_config(config)
+
+# Optional duplicate requests for slow model calls, chat turns and RAG answers have their own latencies
+chat_hedger = None
+rag_hedger = None
+if config.get_property('hedging', 'enabled') == "true":
+    chat_hedger = Hedger.from_config(config)
+    rag_hedger = Hedger.from_config(config)
+
+# Generated avatars and 3D models, served from /assets under content-hash names
+assets = AssetStore.from_config(config)
+
+# Limits of /get_models
+bulk_max_user_ids = int(config.get_property('bulk_models', 'max_user_ids'))
+bulk_stream_threshold = int(config.get_property('bulk_models', 'stream_threshold'))
+bulk_chunk_size = int(config.get_property('bulk_models', 'chunk_size'))
+
+# Identical concurrent model lookups, avatar reads and RAG questions share one upstream call
+single_flight = SingleFlight.from_config(config)
+
+# Recording or replaying the upstream calls, None when off
+cassette = Cassette.from_config(config)
+if cassette is not None:
+    atexit.register(cassette.close)
+
+# Spans of the chat turns and the metrics served on /metrics, None when off
+tracer = Tracer.from_config(config)
+
+vertex = LazyResource("vertexai", init_vertexai, timings)
+safety_settings = LazyResource("safety_settings", init_safety_settings, timings)
+chat_model = LazyResource("chat_model", lambda: upstream("gemini", "chat", init_model), timings)
+rag_model = LazyResource("rag_model", lambda: upstream("gemini", "rag", init_rag_model), timings)
+db = LazyResource("firestore", lambda: upstream("firestore", "firestore", init_firestore), timings)
+model_cache = LazyResource("model_cache", init_model_cache, timings)
+model_writes = LazyResource("model_writes", init_model_writes, timings)
+answer_cache = LazyResource("answer_cache", init_answer_cache, timings)
+intent_router = LazyResource("intent_router", init_intent_router, timings)
+compactor = LazyResource("compactor", init_compactor, timings)
+user_service = LazyResource("user_service", init_user_service, timings)
+
+job_scheduler = JobScheduler.from_config(config)
+if cassette is not None:
+    pool_size = int(config.get_property('jobs', 'http_pool_size'))
+    adapter = cassette.http_adapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    job_scheduler.session.mount("https://", adapter)
+    job_scheduler.session.mount("http://", adapter)
+job_scheduler.start()
+
+# Bounded pool running the function calls of a single model response concurrently
+function_executor = ThreadPoolExecutor(
+    max_workers=int(config.get_property('function_calling', 'max_workers')),
+    thread_name_prefix="function-call",
+)
 
 # Init our session handling variables
-client_sessions = {}
-history_clients = {}
+history_store = HistoryStore.from_config(config)
+sessions = SessionStore.from_config(config, on_evict=evict_history)
+sessions.start_sweeper()
+
+# Turns of one user run one at a time, so they never interleave on the same chat session
+turns = UserTurns.from_config(config)
+
+if config.get_property('startup', 'warm_up') == "true":
+    warm_up(
+        [db, vertex, chat_model, rag_model, safety_settings, model_cache, model_writes, answer_cache, intent_router, compactor, user_service],
+        timings,
+        max_workers=int(config.get_property('startup', 'warm_up_workers')),
+    )
 
 app = Flask(
     __name__,
@@ -123,44 +432,56 @@ app = Flask(
     template_folder="templates",
 )
 
+@app.after_request
+def send_request_id(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
 # Our main chat handler
 @app.route("/chat", methods=["POST"])
 def chat():
-    chat = init_chat(chat_model, FAKE_USER_ID)
+    prompt_text = request.form.get("prompt")
 
-    prompt = Part.from_text(request.form.get("prompt"))
-    response = chat.send_message(
-        prompt,
-        safety_settings=SAFETY_SETTINGS,
-    )
+    try:
+        with recorded("/chat", {"prompt": prompt_text}), traced("/chat", request_id(request.headers)), turns.turn(FAKE_USER_ID):
+            return chat_turn(prompt_text)
+    except TurnRejected as e:
+        logging.warning("%s", e)
+        return function_calling.gemini_response_to_template_html(config.get_property('turns', 'busy_message')), 429
+    except AdmissionRejected as e:
+        logging.warning("%s", e)
+        return function_calling.gemini_response_to_template_html(config.get_property('admission', 'overloaded_message')), 503
+
+def chat_turn(prompt_text):
+    from vertexai.preview.generative_models import Part
+
+    chat = init_chat(chat_model.get(), FAKE_USER_ID)
+
+    fast_path = route_fast_path(chat, FAKE_USER_ID, prompt_text)
+    if fast_path is not None:
+        return function_calling.gemini_response_to_template_html(fast_path[0] + fast_path[1])
+
+    prompt = Part.from_text(prompt_text)
+    with tracing.span("send_message"):
+        response = send_chat_message(chat, prompt)
 
     logging.info(response)
 
-    history_clients[FAKE_USER_ID] = chat.history
+    save_history(FAKE_USER_ID, chat.history)
 
-    function_params = function_calling.extract_params(response)
-    function_name = function_calling.extract_function(response)
+    function_calls = function_calling.extract_function_calls(response)
     text_response = function_calling.extract_text(response)
 
-    if function_name:
+    if function_calls:
         try:
-            # Injection of user_id (this should be done dynamically when proper auth is implemented)
-            function_params['user_id'] = FAKE_USER_ID
-
-            logging.info(function_params)
-            logging.info("Calling  " + function_name)
+            function_response_parts, html_response = run_function_calls(function_calls, FAKE_USER_ID)
 
-            function_response, html_response = function_calling.call_function(user_service, function_name, function_params)
+            # All function responses go back in one message, so there is a single follow-up call
+            with tracing.span("follow_up"):
+                response = send_chat_message(chat, function_response_parts)
 
-            response = chat.send_message(
-                    Part.from_function_response(
-                    name=function_name,
-                    response={
-                        "content": function_response,
-                    },
-                ),
-                safety_settings=SAFETY_SETTINGS     
-            )
+            save_history(FAKE_USER_ID, chat.history)
 
             text_response = function_calling.extract_text(response) + html_response
 
@@ -177,6 +498,110 @@ def chat():
         
     return function_calling.gemini_response_to_template_html(text_response)
 
+# Streaming variant of the chat handler, sends html fragments as server-sent events
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    return Response(
+        stream_with_context(stream_chat_events(request.form.get("prompt"), request_id(request.headers))),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no", # Stop proxies from buffering the stream
+        },
+    )
+
+def stream_model_text(chat, message, cleaner, function_calls, phase):
+    # Function calls found along the way are collected into function_calls
+    span = tracing.start_span(phase)
+    try:
+        for chunk in admission.limiter("gemini").stream(chat.send_message, message, safety_settings=safety_settings.get(), stream=True):
+            function_calls.extend(function_calling.extract_function_calls(chunk))
+
+            text = cleaner.feed(function_calling.extract_text(chunk))
+            if text:
+                yield text
+    except BaseException as e:
+        span.set_outcome(tracing.outcome_of(e))
+        raise
+    finally:
+        span.end()
+
+def stream_chat_events(prompt_text, turn_request_id):
+    # The turn is taken inside the generator, so it is always released when the stream ends
+    with recorded("/chat/stream", {"prompt": prompt_text}), traced("/chat/stream", turn_request_id):
+        try:
+            turns.acquire(FAKE_USER_ID)
+        except TurnRejected as e:
+            logging.warning("%s", e)
+            yield function_calling.sse_event("error", config.get_property('turns', 'busy_message'))
+            yield function_calling.sse_event("done", "")
+            return
+
+        try:
+            yield from stream_turn_events(prompt_text)
+        finally:
+            turns.release(FAKE_USER_ID)
+
+def stream_turn_events(prompt_text):
+    from vertexai.preview.generative_models import Part
+
+    chat = init_chat(chat_model.get(), FAKE_USER_ID)
+    cleaner = function_calling.StreamCleaner()
+    function_calls = []
+    html_response = ''
+    sent_text = False
+    error_message = config.get_property('chatbot', 'generic_error_message')
+
+    try:
+        fast_path = route_fast_path(chat, FAKE_USER_ID, prompt_text)
+        if fast_path is not None:
+            yield function_calling.sse_event("chunk", function_calling.clean_gemini_html(fast_path[0]))
+            if fast_path[1]:
+                yield function_calling.sse_event("html", fast_path[1])
+            yield function_calling.sse_event("done", "")
+            return
+
+        prompt = Part.from_text(prompt_text)
+
+        for text in stream_model_text(chat, prompt, cleaner, function_calls, "send_message"):
+            sent_text = True
+            yield function_calling.sse_event("chunk", text)
+
+        save_history(FAKE_USER_ID, chat.history)
+
+        if function_calls:
+            function_response_parts, html_response = run_function_calls(function_calls, FAKE_USER_ID)
+
+            for text in stream_model_text(chat, function_response_parts, cleaner, [], "follow_up"):
+                sent_text = True
+                yield function_calling.sse_event("chunk", text)
+
+            save_history(FAKE_USER_ID, chat.history)
+
+        text = cleaner.flush()
+        if text:
+            sent_text = True
+            yield function_calling.sse_event("chunk", text)
+
+    except AdmissionRejected as e:
+        logging.warning("%s", e)
+        error_message = config.get_property('admission', 'overloaded_message')
+        sent_text = False
+        html_response = ''
+
+    except Exception as e:
+        logging.error("%s, %s", traceback.format_exc(), e)
+        sent_text = False
+        html_response = ''
+
+    if not sent_text:
+        yield function_calling.sse_event("error", error_message)
+
+    if html_response:
+        yield function_calling.sse_event("html", html_response)
+
+    yield function_calling.sse_event("done", "")
+
 @app.route("/", methods=["GET"])
 def home():
 #    if os.environ.get("DEV_MODE") == "true":
@@ -196,7 +621,7 @@ def version():
 # Get character color
 @app.route("/get_model", methods=["GET"])
 def get_model():
-    model = user_service.get_model(FAKE_USER_ID)
+    model = user_service.get().get_model(FAKE_USER_ID)
 
     if(model is not None) :
         response = jsonify(model.to_dict())
@@ -205,13 +630,166 @@ def get_model():
         
     return 'Character was not found. Double-check the name and try again.', 404
 
+# Models of many users at once, e.g. for the lobby: /get_models?user_ids=a,b,c&fields=color,model
+# or a POST of {"user_ids": [...], "fields": [...]}. Large batches are streamed.
+@app.route("/get_models", methods=["GET", "POST"])
+def get_models():
+    try:
+        user_ids, fields = models_request(request.args, request.get_json(silent=True))
+    except ValueError as e:
+        return str(e), 400
+
+    service = user_service.get()
+    try:
+        chunks = service.iter_models(user_ids, fields, chunk_size=bulk_chunk_size)
+        if len(user_ids) <= bulk_stream_threshold:
+            response = jsonify([character_model for chunk in chunks for character_model in chunk])
+        else:
+            response = Response(stream_with_context(stream_json_array(chunks)), mimetype="application/json")
+    except ValueError as e:
+        return str(e), 400
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+def models_request(args, body):
+    # Returns (user_ids, fields), raises ValueError for a request that can't be served
+    if body is not None:
+        if not isinstance(body, dict):
+            raise ValueError("The body must be a JSON object.")
+        user_ids = body.get("user_ids") or []
+        fields = body.get("fields")
+    else:
+        user_ids = [user_id for user_id in args.get("user_ids", "").split(",") if user_id]
+        fields = [field for field in args.get("fields", "").split(",") if field] or None
+
+    if not isinstance(user_ids, list) or not (fields is None or isinstance(fields, list)):
+        raise ValueError("user_ids and fields must be lists.")
+    if not all(isinstance(value, str) for value in user_ids + (fields or [])):
+        raise ValueError("user_ids and fields must be lists of strings.")
+    if not user_ids:
+        raise ValueError("No user_ids given.")
+    if len(user_ids) > bulk_max_user_ids:
+        raise ValueError("At most %d user_ids can be read at once." % bulk_max_user_ids)
+
+    return user_ids, fields
+
+def stream_json_array(chunks):
+    # Every chunk is sent as soon as it is read, the client gets one JSON array
+    yield "["
+    first = True
+    for chunk in chunks:
+        for character_model in chunk:
+            yield ("" if first else ",") + json.dumps(character_model)
+            first = False
+    yield "]"
+
+# Avatars and 3D models with validators, Range support and precompressed variants
+@app.route("/assets/<kind>/<name>", methods=["GET"])
+def asset(kind, name):
+    found = assets.lookup(kind, name, request.headers.get("Accept-Encoding"))
+    if found is None:
+        return 'Asset was not found.', 404
+
+    response = send_file(os.path.abspath(found.path), mimetype=found.mimetype, etag=found.etag, conditional=True)
+    response.headers.update(found.headers())
+    return response
+
+# Status of a background job (e.g. 3D model creation), htmx requests get the chat fragment
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = job_scheduler.get(job_id)
+
+    if job is None:
+        return 'Job was not found.', 404
+
+    if request.headers.get("HX-Request") == "true":
+        return user_service.get().job_status_html(job)
+
+    return jsonify(job.to_dict())
+
+# Readiness for startup probes, 503 until the clients needed to serve a chat turn are initialized
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    status, ready = health_status()
+    return jsonify(status), 200 if ready else 503
+
+def health_status():
+    resources = [vertex, safety_settings, chat_model, rag_model, db, model_cache, model_writes, answer_cache, intent_router, compactor, user_service]
+    status = {resource.name: resource.is_ready() for resource in resources}
+    status["rag_corpus"] = rag_corpus.is_ready() if rag_corpus is not None else None
+
+    ready = chat_model.is_ready() and user_service.is_ready()
+
+    return {
+        "status": "ok" if ready else "starting",
+        "resources": status,
+        "startup_timings": timings.report(),
+    }, ready
+
 @app.route("/reset", methods=["GET"])
 def reset():
-    for uid in client_sessions:
-        client_sessions[uid] = None
+    sessions.reset_sessions()
 
     return jsonify({'status': 'ok'}), 200
 
+@app.route("/sessions/stats", methods=["GET"])
+def sessions_stats():
+    return jsonify(sessions.get_stats())
+
+@app.route("/turns/stats", methods=["GET"])
+def turns_stats():
+    return jsonify(turns.get_stats())
+
+@app.route("/compaction/stats", methods=["GET"])
+def compaction_stats():
+    history_compactor = compactor.get()
+    return jsonify(history_compactor.get_stats() if history_compactor is not None else None)
+
+@app.route("/admission/stats", methods=["GET"])
+def admission_stats():
+    return jsonify(admission.get_stats())
+
+@app.route("/hedging/stats", methods=["GET"])
+def hedging_stats():
+    return jsonify({
+        "chat": chat_hedger.get_stats() if chat_hedger is not None else None,
+        "rag": rag_hedger.get_stats() if rag_hedger is not None else None,
+    })
+
+@app.route("/single_flight/stats", methods=["GET"])
+def single_flight_stats():
+    return jsonify(single_flight.get_stats())
+
+@app.route("/avatars/stats", methods=["GET"])
+def avatars_stats():
+    return jsonify(user_service.get().avatars.get_stats())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(tracer.render() if tracer is not None else "", content_type=METRICS_CONTENT_TYPE)
+
+@app.route("/rag/stats", methods=["GET"])
+def rag_stats():
+    return jsonify(rag_corpus.get_stats() if rag_corpus is not None else None)
+
+@app.route("/cassette/stats", methods=["GET"])
+def cassette_stats():
+    return jsonify(cassette.get_stats() if cassette is not None else None)
+
+@app.route("/router/stats", methods=["GET"])
+def router_stats():
+    router = intent_router.get()
+    return jsonify(router.get_stats() if router is not None else None)
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "models": model_cache.get().get_stats(),
+        "model_writes": model_writes.get().get_stats(),
+        "answers": answer_cache.get().get_stats() if answer_cache.get() is not None else None,
+    })
+
 if __name__ == "__main__":
     os.makedirs('uploads', exist_ok=True)
     
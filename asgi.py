@@ -0,0 +1,435 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Asyncio serving mode: the same routes as app.py, served by an ASGI server (hypercorn asgi:app).
+# Gemini, Firestore and the 3D model API are called through their async clients, so a slow
+# conversation holds a coroutine instead of a thread. Clients, sessions and histories are
+# the ones of app.py.
+
+import asyncio
+import json
+import logging
+import os
+import traceback
+import uuid
+
+import app as wsgi
+from quart import Quart, Response, g, request, jsonify, send_file
+from common import function_calling, tracing
+from common.admission import AdmissionRejected
+from common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from common.turns import TurnRejected
+from services.async_user import AsyncUser
+
+config = wsgi.config
+FAKE_USER_ID = wsgi.FAKE_USER_ID
+
+REQUEST_TIMEOUT = float(config.get_property('asgi', 'request_timeout_seconds'))
+
+app = Quart(__name__)
+
+# Quart's own limits would cut long streamed answers, the chat handlers enforce REQUEST_TIMEOUT
+app.config["RESPONSE_TIMEOUT"] = None
+
+http_client = None
+user_service = None
+
+@app.before_serving
+async def startup():
+    global http_client
+    import httpx
+
+    pool_size = int(config.get_property('jobs', 'http_pool_size'))
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    if wsgi.cassette is not None:
+        http_client = httpx.AsyncClient(transport=wsgi.cassette.http_transport(httpx.AsyncHTTPTransport(limits=limits)))
+    else:
+        http_client = httpx.AsyncClient(limits=limits)
+
+@app.after_serving
+async def shutdown():
+    await http_client.aclose()
+
+async def get_resource(resource):
+    # The first use initializes the resource on a worker thread, later uses return right away
+    if resource.is_ready():
+        return resource.get()
+    return await asyncio.to_thread(resource.get)
+
+async def get_user_service():
+    global user_service
+
+    if user_service is None:
+        from google.cloud import firestore
+
+        sync_user_service = await get_resource(wsgi.user_service)
+        if user_service is None:
+            async_db = wsgi.upstream("firestore", "firestore", lambda: firestore.AsyncClient(project=sync_user_service.db.project), asynchronous=True)
+            user_service = AsyncUser(sync_user_service, async_db, http_client)
+
+    return user_service
+
+async def init_chat(user_id):
+    model = await get_resource(wsgi.chat_model)
+    # Loading the history may hit SQLite or Redis
+    return await asyncio.to_thread(wsgi.init_chat, model, user_id)
+
+async def save_history(user_id, history):
+    await asyncio.to_thread(wsgi.save_history, user_id, history)
+
+async def send_chat_message(chat, message):
+    gemini = wsgi.admission.limiter("gemini")
+    safety_settings = await get_resource(wsgi.safety_settings)
+
+    if wsgi.chat_hedger is None:
+        return await gemini.call_async(chat.send_message_async, message, safety_settings=safety_settings)
+
+    # See app.send_chat_message, only the winning response is appended to the history
+    contents, request_content = wsgi.chat_request(chat, message)
+    model = await get_resource(wsgi.chat_model)
+    response = await wsgi.chat_hedger.call_async(gemini.call_async, model.generate_content_async, contents, safety_settings=safety_settings)
+
+    return wsgi.append_chat_response(chat, contents, request_content, response)
+
+async def run_function_calls(function_calls, user_id):
+    wsgi.prepare_function_calls(function_calls, user_id)
+
+    with tracing.span("function_calls"):
+        results = await function_calling.call_functions_async(await get_user_service(), function_calls)
+
+    return wsgi.function_response_parts(function_calls, results)
+
+async def with_deadline(awaitable, deadline):
+    return await asyncio.wait_for(awaitable, max(deadline - asyncio.get_running_loop().time(), 0))
+
+async def iterate_with_deadline(iterator, deadline):
+    iterator = iterator.__aiter__()
+    while True:
+        try:
+            yield await with_deadline(iterator.__anext__(), deadline)
+        except StopAsyncIteration:
+            return
+
+async def chat_turn(prompt_text):
+    from vertexai.preview.generative_models import Part
+
+    chat = await init_chat(FAKE_USER_ID)
+
+    fast_path = await asyncio.to_thread(wsgi.route_fast_path, chat, FAKE_USER_ID, prompt_text)
+    if fast_path is not None:
+        return fast_path[0] + fast_path[1]
+
+    prompt = Part.from_text(prompt_text)
+    with tracing.span("send_message"):
+        response = await send_chat_message(chat, prompt)
+
+    logging.info(response)
+
+    await save_history(FAKE_USER_ID, chat.history)
+
+    function_calls = function_calling.extract_function_calls(response)
+    text_response = function_calling.extract_text(response)
+
+    if function_calls:
+        try:
+            function_response_parts, html_response = await run_function_calls(function_calls, FAKE_USER_ID)
+
+            # All function responses go back in one message, so there is a single follow-up call
+            with tracing.span("follow_up"):
+                response = await send_chat_message(chat, function_response_parts)
+
+            await save_history(FAKE_USER_ID, chat.history)
+
+            text_response = function_calling.extract_text(response) + html_response
+
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            text_response = config.get_property('chatbot', 'generic_error_message')
+
+    return text_response
+
+# See app.request_id, with Quart's g
+def request_id(headers):
+    g.request_id = headers.get("X-Request-ID") or uuid.uuid4().hex
+    return g.request_id
+
+@app.after_request
+async def send_request_id(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+# Our main chat handler, cancelled by Quart when the browser disconnects
+@app.route("/chat", methods=["POST"])
+async def chat():
+    form = await request.form
+
+    try:
+        with wsgi.recorded("/chat", {"prompt": form.get("prompt")}), wsgi.traced("/chat", request_id(request.headers)):
+            async with wsgi.turns.turn_async(FAKE_USER_ID):
+                text_response = await asyncio.wait_for(chat_turn(form.get("prompt")), REQUEST_TIMEOUT)
+    except TurnRejected as e:
+        logging.warning("%s", e)
+        return function_calling.gemini_response_to_template_html(config.get_property('turns', 'busy_message')), 429
+    except AdmissionRejected as e:
+        logging.warning("%s", e)
+        return function_calling.gemini_response_to_template_html(config.get_property('admission', 'overloaded_message')), 503
+    except asyncio.TimeoutError:
+        logging.warning("Chat turn timed out after %s seconds", REQUEST_TIMEOUT)
+        text_response = ''
+    except asyncio.CancelledError:
+        logging.info("Client disconnected, chat turn cancelled")
+        raise
+
+    if len(text_response) == 0:
+        text_response = config.get_property('chatbot', 'generic_error_message')
+
+    return function_calling.gemini_response_to_template_html(text_response)
+
+# Streaming variant of the chat handler, sends html fragments as server-sent events
+@app.route("/chat/stream", methods=["POST"])
+async def chat_stream():
+    form = await request.form
+
+    return Response(
+        stream_chat_events(form.get("prompt"), request_id(request.headers)),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no", # Stop proxies from buffering the stream
+        },
+    )
+
+async def stream_model_text(chat, message, cleaner, function_calls, deadline, phase):
+    # Function calls found along the way are collected into function_calls
+    span = tracing.start_span(phase)
+    try:
+        responses = wsgi.admission.limiter("gemini").stream_async(
+            chat.send_message_async, message, safety_settings=await get_resource(wsgi.safety_settings), stream=True)
+
+        async for chunk in iterate_with_deadline(responses, deadline):
+            function_calls.extend(function_calling.extract_function_calls(chunk))
+
+            text = cleaner.feed(function_calling.extract_text(chunk))
+            if text:
+                yield text
+    except BaseException as e:
+        span.set_outcome(tracing.outcome_of(e))
+        raise
+    finally:
+        span.end()
+
+async def stream_chat_events(prompt_text, turn_request_id):
+    # The turn is taken inside the generator, so it is always released when the stream ends
+    with wsgi.recorded("/chat/stream", {"prompt": prompt_text}), wsgi.traced("/chat/stream", turn_request_id):
+        try:
+            await wsgi.turns.acquire_async(FAKE_USER_ID)
+        except TurnRejected as e:
+            logging.warning("%s", e)
+            yield function_calling.sse_event("error", config.get_property('turns', 'busy_message'))
+            yield function_calling.sse_event("done", "")
+            return
+
+        try:
+            async for event in stream_turn_events(prompt_text):
+                yield event
+        finally:
+            wsgi.turns.release(FAKE_USER_ID)
+
+async def stream_turn_events(prompt_text):
+    from vertexai.preview.generative_models import Part
+
+    deadline = asyncio.get_running_loop().time() + REQUEST_TIMEOUT
+    cleaner = function_calling.StreamCleaner()
+    function_calls = []
+    html_response = ''
+    sent_text = False
+    error_message = config.get_property('chatbot', 'generic_error_message')
+
+    try:
+        chat = await with_deadline(init_chat(FAKE_USER_ID), deadline)
+
+        fast_path = await asyncio.to_thread(wsgi.route_fast_path, chat, FAKE_USER_ID, prompt_text)
+        if fast_path is not None:
+            yield function_calling.sse_event("chunk", function_calling.clean_gemini_html(fast_path[0]))
+            if fast_path[1]:
+                yield function_calling.sse_event("html", fast_path[1])
+            yield function_calling.sse_event("done", "")
+            return
+
+        prompt = Part.from_text(prompt_text)
+
+        async for text in stream_model_text(chat, prompt, cleaner, function_calls, deadline, "send_message"):
+            sent_text = True
+            yield function_calling.sse_event("chunk", text)
+
+        await save_history(FAKE_USER_ID, chat.history)
+
+        if function_calls:
+            function_response_parts, html_response = await with_deadline(run_function_calls(function_calls, FAKE_USER_ID), deadline)
+
+            async for text in stream_model_text(chat, function_response_parts, cleaner, [], deadline, "follow_up"):
+                sent_text = True
+                yield function_calling.sse_event("chunk", text)
+
+            await save_history(FAKE_USER_ID, chat.history)
+
+        text = cleaner.flush()
+        if text:
+            sent_text = True
+            yield function_calling.sse_event("chunk", text)
+
+    except asyncio.CancelledError:
+        logging.info("Client disconnected, chat stream cancelled")
+        raise
+
+    except asyncio.TimeoutError:
+        logging.warning("Chat stream timed out after %s seconds", REQUEST_TIMEOUT)
+        sent_text = False
+        html_response = ''
+
+    except AdmissionRejected as e:
+        logging.warning("%s", e)
+        error_message = config.get_property('admission', 'overloaded_message')
+        sent_text = False
+        html_response = ''
+
+    except Exception as e:
+        logging.error("%s, %s", traceback.format_exc(), e)
+        sent_text = False
+        html_response = ''
+
+    if not sent_text:
+        yield function_calling.sse_event("error", error_message)
+
+    if html_response:
+        yield function_calling.sse_event("html", html_response)
+
+    yield function_calling.sse_event("done", "")
+
+@app.route("/", methods=["GET"])
+async def home():
+    def read_index():
+        with open("templates/index.html", mode='r') as file:
+            return file.read()
+
+    return await asyncio.to_thread(read_index)
+
+@app.route("/version", methods=["GET"])
+async def version():
+    return jsonify({
+        "version": config.get_property('general', 'version')
+        })
+
+# Get character color
+@app.route("/get_model", methods=["GET"])
+async def get_model():
+    service = await get_user_service()
+
+    try:
+        model = await asyncio.wait_for(service.get_model(FAKE_USER_ID), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("get_model timed out after %s seconds", REQUEST_TIMEOUT)
+        return 'Timed out while loading the character.', 504
+
+    if model is not None:
+        response = jsonify(model.to_dict())
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response
+
+    return 'Character was not found. Double-check the name and try again.', 404
+
+# Models of many users at once, see the WSGI app
+@app.route("/get_models", methods=["GET", "POST"])
+async def get_models():
+    try:
+        user_ids, fields = wsgi.models_request(request.args, await request.get_json(silent=True))
+        service = await get_user_service()
+        chunks = await service.iter_models(user_ids, fields, chunk_size=wsgi.bulk_chunk_size)
+    except ValueError as e:
+        return str(e), 400
+
+    if len(user_ids) <= wsgi.bulk_stream_threshold:
+        try:
+            models = await asyncio.wait_for(read_model_chunks(chunks), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("get_models timed out after %s seconds", REQUEST_TIMEOUT)
+            return 'Timed out while loading the characters.', 504
+        response = jsonify(models)
+    else:
+        response = Response(stream_json_array(chunks), mimetype="application/json")
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+async def iterate_model_chunks(chunks):
+    # Every chunk is read from Firestore on a worker thread
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+async def read_model_chunks(chunks):
+    return [character_model async for chunk in iterate_model_chunks(chunks) for character_model in chunk]
+
+async def stream_json_array(chunks):
+    first = True
+    yield "["
+    async for chunk in iterate_model_chunks(chunks):
+        for character_model in chunk:
+            yield ("" if first else ",") + json.dumps(character_model)
+            first = False
+    yield "]"
+
+# Avatars and 3D models, see the WSGI app
+@app.route("/assets/<kind>/<name>", methods=["GET"])
+async def asset(kind, name):
+    found = await asyncio.to_thread(wsgi.assets.lookup, kind, name, request.headers.get("Accept-Encoding"))
+    if found is None:
+        return 'Asset was not found.', 404
+
+    path = os.path.abspath(found.path)
+    response = await send_file(path, mimetype=found.mimetype, add_etags=False)
+    response.set_etag(found.etag)
+    response.headers.update(found.headers())
+    return await response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+
+# Status of a background job (e.g. 3D model creation), htmx requests get the chat fragment
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id):
+    job = wsgi.job_scheduler.get(job_id)
+
+    if job is None:
+        return 'Job was not found.', 404
+
+    if request.headers.get("HX-Request") == "true":
+        return (await get_resource(wsgi.user_service)).job_status_html(job)
+
+    return jsonify(job.to_dict())
+
+@app.route("/healthz", methods=["GET"])
+async def healthz():
+    status, ready = wsgi.health_status()
+    return jsonify(status), 200 if ready else 503
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    return Response(wsgi.tracer.render() if wsgi.tracer is not None else "", content_type=METRICS_CONTENT_TYPE)
+
+@app.route("/reset", methods=["GET"])
+async def reset():
+    wsgi.sessions.reset_sessions()
+
+    return jsonify({'status': 'ok'}), 200
@@ -0,0 +1,443 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Latency, throughput, memory and threads of /chat, /get_model and /get_models under load.
+#
+# Gemini, Imagen, Firestore and the 3D model API are replaced by the stand-ins of bench/fakes.py,
+# with the latencies and the mix of function calls given on the command line, so no Google
+# Cloud access is needed. Requests go through the test client of the Flask app, or of the Quart
+# app with --app asgi, the HTTP server is not part of the measurement. All turns are the demo
+# user's, so concurrent /chat requests queue behind one another: unless --keep-turn-limit is
+# given, the turn queue is made deep enough for none to be rejected. The client-side model
+# quotas are lifted as well, unless --keep-quotas is given.
+#
+# Results are written as JSON with --output, --baseline compares them with an earlier run and
+# exits with 1 when p95 latency or throughput got worse by more than --tolerance.
+#
+#   python -m bench.chat_load --concurrency 1,4,16 --requests 200 --output bench-results.json
+#   python -m bench.chat_load --app asgi --baseline bench-results.json
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fakes import (FakeAsyncFirestore, FakeFirestore, FakeGenerativeModel, FakeImageGenerationModel,
+                         FakeJobAPI, Latency, parse_mix)
+
+PROMPTS = [
+    "Hi! What can you do?",
+    "Make my character green",
+    "What is Cloud Meow?",
+    "Show me my avatar",
+]
+
+def configure(overrides, log_level):
+    # Imports the app with the given config.ini values replaced, the app reads it from its directory
+    os.chdir(ROOT)
+
+    from common import config as configuration
+
+    config = configuration.Config.get_instance()
+    for (section, key), value in overrides.items():
+        config.config.set(section, key, value)
+
+    import vertexai.preview.generative_models
+    import app as wsgi
+
+    # The app logs every turn at DEBUG
+    logging.getLogger().setLevel(log_level)
+    return wsgi
+
+def load_test_overrides(args, levels):
+    # Nothing is initialized in the background, and only the clients replaced by fakes are used
+    overrides = {
+        ("startup", "warm_up"): "false",
+        ("cache", "model_cache_watch"): "false",
+        ("answer_cache", "enabled"): "false",
+        ("intent_router", "enabled"): "false",
+        ("compaction", "enabled"): "false",
+        ("cassette", "mode"): "off",
+    }
+    if not args.keep_quotas:
+        # The fakes have no quota, the client-side one would be all that is measured
+        from common import config as configuration
+        for limiter in configuration.Config.get_instance().get_property("admission", "limiters").split("|"):
+            overrides[("admission_" + limiter, "requests_per_minute")] = "1000000"
+            overrides[("admission_" + limiter, "burst")] = "1000000"
+    if not args.keep_turn_limit:
+        # Every request is a turn of the demo user, they are queued instead of rejected
+        overrides[("turns", "max_queue_depth")] = str(max(levels) + 1)
+    return overrides
+
+def install_fakes(wsgi, args):
+    from common.startup import LazyResource
+
+    fakes = {
+        "gemini": FakeGenerativeModel(Latency.parse(args.gemini_ms, args.seed), parse_mix(args.function_mix), args.seed),
+        "imagen": FakeImageGenerationModel(Latency.parse(args.imagen_ms, args.seed)),
+        "firestore": FakeFirestore(Latency.parse(args.firestore_ms, args.seed)),
+        "jobs_api": FakeJobAPI(wsgi.config.get_property("jobs", "api_endpoint"), Latency.parse(args.jobs_api_ms, args.seed)),
+    }
+    seed_database(fakes["firestore"], wsgi.FAKE_USER_ID, args.users)
+
+    # Avatars and 3D models are written to a scratch directory
+    wsgi.assets.root = tempfile.mkdtemp(prefix="bench-assets-")
+
+    def init_user_service():
+        service = wsgi.init_user_service()
+        service.avatars.imagen = fakes["imagen"]
+        return service
+
+    wsgi.chat_model = LazyResource("chat_model", lambda: fakes["gemini"], wsgi.timings)
+    wsgi.rag_model = LazyResource("rag_model", lambda: fakes["gemini"], wsgi.timings)
+    wsgi.safety_settings = LazyResource("safety_settings", lambda: {}, wsgi.timings)
+    wsgi.db = LazyResource("firestore", lambda: fakes["firestore"], wsgi.timings)
+    wsgi.user_service = LazyResource("user_service", init_user_service, wsgi.timings)
+
+    wsgi.job_scheduler.session.mount(fakes["jobs_api"].endpoint, fakes["jobs_api"].adapter())
+
+    if args.app == "asgi":
+        import httpx
+        import asgi
+        from services.async_user import AsyncUser
+
+        asgi.user_service = AsyncUser(
+            wsgi.user_service.get(),
+            FakeAsyncFirestore(fakes["firestore"]),
+            httpx.AsyncClient(transport=fakes["jobs_api"].async_transport()),
+        )
+
+    return fakes
+
+def seed_database(db, user_id, users):
+    models = db.collection("models")
+    accounts = db.collection("users")
+    for user in [user_id] + bench_user_ids(users):
+        models.add({"user_id": user, "color": "#ffffff", "model": "cat.glb", "original_material": True})
+        accounts.add({"user_id": user})
+
+def bench_user_ids(users):
+    return ["bench-user-%d" % number for number in range(users)]
+
+def endpoint_request(endpoint, number, args):
+    # (method, path, form, json) of the number-th request to the endpoint
+    if endpoint == "chat":
+        return "POST", "/chat", {"prompt": PROMPTS[number % len(PROMPTS)]}, None
+    if endpoint == "get_model":
+        return "GET", "/get_model", None, None
+    if endpoint == "get_models":
+        return "POST", "/get_models", None, {"user_ids": bench_user_ids(args.users)[:args.batch_size]}
+    raise ValueError("Unknown endpoint: %s" % endpoint)
+
+def request_body(form, body, form_argument):
+    # Keyword arguments of the test clients, Flask takes the form as data and Quart as form
+    if form is not None:
+        return {form_argument: form}
+    if body is not None:
+        return {"json": body}
+    return {}
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def thread_count():
+    # Native threads (e.g. gRPC's) as well, when /proc is there
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return threading.active_count()
+
+class ResourceSampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.rss = []
+        self.threads = []
+        self.thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def __enter__(self):
+        self._sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+
+    def report(self):
+        rss = [value for value in self.rss if value is not None]
+        megabytes = lambda value: round(value / 1024 / 1024, 1)
+        return {
+            "rss_mb": {
+                "start": megabytes(rss[0]),
+                "end": megabytes(rss[-1]),
+                "peak": megabytes(max(rss)),
+                "growth": megabytes(rss[-1] - rss[0]),
+            } if rss else None,
+            "threads": {
+                "start": self.threads[0],
+                "end": self.threads[-1],
+                "peak": max(self.threads),
+            },
+        }
+
+    def _sample(self):
+        self.rss.append(rss_bytes())
+        self.threads.append(thread_count())
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+def percentile(sorted_values, percent):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(endpoint, concurrency, samples, elapsed, sampler):
+    # samples are (latency in seconds, status code or None for an exception)
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": sum(1 for _, status in samples if status is None or status >= 500),
+        "statuses": statuses,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+    }
+    result.update(sampler.report())
+    return result
+
+def run_wsgi(wsgi, endpoint, concurrency, requests, args):
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    samples = []
+
+    def worker():
+        client = wsgi.app.test_client()
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                return
+
+            method, path, form, body = endpoint_request(endpoint, number, args)
+            started = time.monotonic()
+            try:
+                response = client.open(path, method=method, **request_body(form, body, "data"))
+                # Streamed responses are only done once they are read
+                response.get_data()
+                status = response.status_code
+                response.close()
+            except Exception as e:
+                logging.error("%s %s failed: %s", method, path, e)
+                status = None
+
+            with lock:
+                samples.append((time.monotonic() - started, status))
+
+    workers = [threading.Thread(target=worker, name="bench-client-%d" % number) for number in range(concurrency)]
+    started = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return samples, time.monotonic() - started
+
+def run_asgi(endpoint, concurrency, requests, args):
+    import asgi
+
+    async def main():
+        counter = iter(range(requests))
+        samples = []
+
+        async def worker():
+            client = asgi.app.test_client()
+            for number in counter:
+                method, path, form, body = endpoint_request(endpoint, number, args)
+                started = time.monotonic()
+                try:
+                    response = await client.open(path, method=method, **request_body(form, body, "form"))
+                    await response.get_data()
+                    status = response.status_code
+                except Exception as e:
+                    logging.error("%s %s failed: %s", method, path, e)
+                    status = None
+                samples.append((time.monotonic() - started, status))
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return samples, time.monotonic() - started
+
+    return asyncio.run(main())
+
+def run(wsgi, endpoint, concurrency, requests, args):
+    # Every run starts with an empty conversation, turns get slower as the history grows
+    wsgi.sessions.remove(wsgi.FAKE_USER_ID)
+    wsgi.history_store.evict(wsgi.FAKE_USER_ID)
+
+    with ResourceSampler() as sampler:
+        if args.app == "asgi":
+            samples, elapsed = run_asgi(endpoint, concurrency, requests, args)
+        else:
+            samples, elapsed = run_wsgi(wsgi, endpoint, concurrency, requests, args)
+
+    return summarize(endpoint, concurrency, samples, elapsed, sampler)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    # Returns the lines describing the changes, and whether anything got worse than the tolerance
+    previous = {(result["endpoint"], result["concurrency"]): result for result in baseline["results"]}
+    lines = []
+    regressed = False
+
+    for result in results:
+        before = previous.get((result["endpoint"], result["concurrency"]))
+        if before is None:
+            continue
+
+        p95_change = result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1 if before["latency_ms"]["p95"] else 0.0
+        throughput_change = result["throughput_rps"] / before["throughput_rps"] - 1 if before["throughput_rps"] else 0.0
+        worse = p95_change > tolerance or throughput_change < -tolerance
+        regressed = regressed or worse
+
+        lines.append("%-12s %6d %+11.1f%% %+13.1f%%%s" % (
+            result["endpoint"], result["concurrency"], p95_change * 100, throughput_change * 100, "  REGRESSION" if worse else ""))
+
+    return lines, regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the chat pipeline with fake Vertex AI, Firestore and 3D model API.")
+    parser.add_argument("--app", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--endpoints", default="chat,get_model,get_models")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated levels, every endpoint is run at each")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint and concurrency level")
+    parser.add_argument("--warmup", type=int, default=5, help="Requests per endpoint sent before measuring")
+    parser.add_argument("--gemini-ms", default="400:2000", help="Median[:p99] latency of a Gemini call")
+    parser.add_argument("--imagen-ms", default="6000:12000")
+    parser.add_argument("--firestore-ms", default="8:60")
+    parser.add_argument("--jobs-api-ms", default="150:800")
+    parser.add_argument("--function-mix", default="text=5,fc_save_model_color=2,fc_rag_retrieval=2,fc_show_my_avatar=1,fc_show_my_model=1",
+                        help="Weights of the replies of the chat model, text or a function name")
+    parser.add_argument("--users", type=int, default=500, help="Users in the fake Firestore")
+    parser.add_argument("--batch-size", type=int, default=50, help="Users read by each /get_models request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-quotas", action="store_true", help="Keep the client-side model quotas of config.ini")
+    parser.add_argument("--keep-turn-limit", action="store_true", help="Reject the turns beyond the queue depth of config.ini")
+    parser.add_argument("--output", help="File to write the results to, as JSON")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Change counted as a regression, 0.1 is 10%%")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    # Relative to where the benchmark is started, not to the app directory it runs in
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+
+    os.chdir(ROOT)
+    wsgi = configure(load_test_overrides(args, levels), args.log_level)
+    fakes = install_fakes(wsgi, args)
+
+    if args.warmup > 0:
+        for endpoint in endpoints:
+            run(wsgi, endpoint, 1, args.warmup, args)
+
+    results = []
+    print("%-12s %6s %9s %9s %9s %9s %10s %10s %8s %9s" % (
+        "endpoint", "conc", "p50 ms", "p95 ms", "p99 ms", "req/s", "statuses", "rss +MB", "threads", "errors"))
+    for endpoint in endpoints:
+        for concurrency in levels:
+            result = run(wsgi, endpoint, concurrency, args.requests, args)
+            results.append(result)
+            print("%-12s %6d %9.1f %9.1f %9.1f %9.1f %10s %10s %8d %9d" % (
+                endpoint, concurrency, result["latency_ms"]["p50"], result["latency_ms"]["p95"], result["latency_ms"]["p99"],
+                result["throughput_rps"], ",".join("%s:%d" % item for item in sorted(result["statuses"].items())),
+                result["rss_mb"]["growth"] if result["rss_mb"] else "-", result["threads"]["peak"], result["errors"]))
+
+    report = {
+        "version": wsgi.config.get_property("general", "version"),
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "fakes": {name: fake.stats.get() for name, fake in fakes.items()},
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print()
+        print("Results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        lines, regressed = compare(results, baseline, args.tolerance)
+        print()
+        print("Compared with %s (%s):" % (args.baseline, baseline.get("commit") or baseline.get("version")))
+        print("%-12s %6s %12s %14s" % ("endpoint", "conc", "p95 change", "req/s change"))
+        for line in lines:
+            print(line)
+
+        if regressed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand-ins for Gemini, Imagen, Firestore and the 3D model API, for the benchmarks.
+#
+# They implement the parts of the client APIs the app uses and nothing else, answer after a
+# random delay drawn from a Latency and count what they were asked for in their stats.
+
+import asyncio
+import io
+import json
+import math
+import random
+import re
+import threading
+import uuid
+
+# The latencies of the Latency.parse() spec are the median and the 99th percentile
+P99_SIGMAS = 2.326
+
+class Latency:
+    """
+    A log-normal latency distribution, the usual shape of the latency of a remote call.
+    """
+
+    def __init__(self, median_ms=0.0, p99_ms=None, seed=None):
+        self.median_ms = median_ms
+        self.p99_ms = p99_ms if p99_ms is not None else median_ms
+        self.sigma = math.log(self.p99_ms / median_ms) / P99_SIGMAS if median_ms > 0 and self.p99_ms > median_ms else 0.0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        # "300" is always 300 ms, "300:1500" has a median of 300 ms and a p99 of 1500 ms
+        median, _, p99 = spec.partition(":")
+        return cls(float(median), float(p99) if p99 else None, seed)
+
+    def sample(self):
+        # In seconds
+        if self.median_ms <= 0:
+            return 0.0
+        with self.lock:
+            return self.median_ms * math.exp(self.random.gauss(0, self.sigma)) / 1000
+
+    def sleep(self):
+        delay = self.sample()
+        if delay > 0:
+            threading.Event().wait(delay)
+
+    async def sleep_async(self):
+        delay = self.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def to_dict(self):
+        return {"median_ms": self.median_ms, "p99_ms": self.p99_ms}
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def get(self):
+        with self.lock:
+            return dict(self.counts)
+
+def parse_mix(spec):
+    # "text=5,fc_save_model_color=2" gives the weights of the replies of the chat model
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name:
+            mix[name] = float(weight or 1)
+    return mix
+
+QUESTIONS = [
+    "What is Cloud Meow?",
+    "How do I get to the second level?",
+    "Which cats can I play with?",
+    "What are the rules of the game?",
+]
+
+DESCRIPTIONS = [
+    "a cat astronaut with a red helmet",
+    "a wizard cat in a blue robe",
+    "a pirate cat with an eye patch",
+]
+
+ARGUMENTS = {
+    "fc_save_model_color": lambda rng: {"color": "#%06x" % rng.randrange(1 << 24)},
+    "fc_rag_retrieval": lambda rng: {"question_passthrough": rng.choice(QUESTIONS)},
+    "fc_generate_avatar": lambda rng: {"description": rng.choice(DESCRIPTIONS)},
+}
+
+class FakeGenerativeModel:
+    """
+    Stand-in for GenerativeModel, also used through ChatSession (see start_chat).
+
+    A prompt is answered with a function call or with text, picked at random with the weights
+    of the mix ("text" for a text reply). Function responses are always answered with text.
+    """
+
+    def __init__(self, latency, mix=None, seed=None):
+        self.latency = latency
+        self.mix = mix or {"text": 1}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Stats()
+
+    def start_chat(self, history=None, response_validation=True):
+        from vertexai.preview.generative_models import ChatSession
+        return ChatSession(model=self, history=history, response_validation=response_validation)
+
+    def generate_content(self, contents, **kwargs):
+        self.latency.sleep()
+        return self.respond(contents)
+
+    async def generate_content_async(self, contents, **kwargs):
+        await self.latency.sleep_async()
+        return self.respond(contents)
+
+    # What ChatSession.send_message and send_message_async call
+    _generate_content = generate_content
+    _generate_content_async = generate_content_async
+
+    def respond(self, contents):
+        from vertexai.preview.generative_models import GenerationResponse
+
+        self.stats.count("calls")
+
+        if isinstance(contents, list) and contents and self.is_function_response(contents[-1]):
+            parts = [{"text": "Done, anything else?"}]
+        elif not isinstance(contents, list):
+            # Plain prompts, e.g. the RAG model's
+            parts = [{"text": "Cloud Meow is a game about cats in the clouds."}]
+        else:
+            parts = [self.pick()]
+
+        return GenerationResponse.from_dict({
+            "candidates": [{"content": {"role": "model", "parts": parts}, "finish_reason": 1}],
+        })
+
+    def pick(self):
+        with self.lock:
+            name = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            arguments = ARGUMENTS.get(name, lambda rng: {})(self.random)
+
+        self.stats.count(name)
+        if name == "text":
+            return {"text": "Meow! Cloud Meow is full of cats."}
+        return {"function_call": {"name": name, "args": arguments}}
+
+    @staticmethod
+    def is_function_response(content):
+        return any("function_response" in part for part in content.to_dict().get("parts", []))
+
+class FakeGeneratedImage:
+    def __init__(self, image_bytes):
+        self._image_bytes = image_bytes
+
+class FakeImageGenerationModel:
+    """
+    Stand-in for ImageGenerationModel, generates noisy PNGs so they cost about as much to
+    post-process as real ones. A few images are made once and handed out in turn.
+    """
+
+    def __init__(self, latency, size=1024, variants=4):
+        self.latency = latency
+        self.size = size
+        self.variants = variants
+        self.lock = threading.Lock()
+        self.images = None
+        self.next = 0
+        self.stats = Stats()
+
+    def generate_images(self, prompt, number_of_images=1, seed=None, **kwargs):
+        self.latency.sleep()
+        self.stats.count("calls")
+        self.stats.count("images", number_of_images)
+
+        with self.lock:
+            if self.images is None:
+                self.images = [self.make_image(variant) for variant in range(self.variants)]
+            images = []
+            for _ in range(number_of_images):
+                images.append(FakeGeneratedImage(self.images[self.next % len(self.images)]))
+                self.next += 1
+        return images
+
+    def make_image(self, variant):
+        from PIL import Image
+
+        noise = Image.effect_noise((self.size, self.size), 32 + 8 * variant)
+        tint = Image.new("L", (self.size, self.size), 64 * variant % 256)
+        image = Image.merge("RGB", (noise, tint, noise))
+
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        return output.getvalue()
+
+class FakeSnapshot:
+    def __init__(self, reference, data, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+        self.field_paths = field_paths
+
+    def to_dict(self):
+        if self.data is None:
+            return None
+        if self.field_paths:
+            return {key: value for key, value in self.data.items() if key in self.field_paths}
+        return dict(self.data)
+
+class FakeDocumentReference:
+    def __init__(self, db, collection, document_id):
+        self.db = db
+        self.collection = collection
+        self.id = document_id
+
+    def get(self, field_paths=None):
+        self.db.latency.sleep()
+        return self.snapshot(field_paths)
+
+    def snapshot(self, field_paths=None):
+        self.db.stats.count("reads")
+        with self.db.lock:
+            data = self.db.documents(self.collection).get(self.id)
+            return FakeSnapshot(self, dict(data) if data is not None else None, field_paths)
+
+    def update(self, fields):
+        self.db.latency.sleep()
+        self.db.write([(self, fields)])
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), field_paths=None):
+        self.db = db
+        self.collection = collection
+        self.filters = filters
+        self.field_paths = field_paths
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return FakeQuery(self.db, self.collection, self.filters + ((field_path, op_string, value),), self.field_paths)
+
+    def select(self, field_paths):
+        return FakeQuery(self.db, self.collection, self.filters, list(field_paths))
+
+    def get(self):
+        self.db.latency.sleep()
+        return self.results()
+
+    def stream(self):
+        return iter(self.get())
+
+    def results(self):
+        self.db.stats.count("queries")
+        with self.db.lock:
+            found = [
+                FakeSnapshot(FakeDocumentReference(self.db, self.collection, document_id), dict(data), self.field_paths)
+                for document_id, data in self.db.documents(self.collection).items()
+                if all(self.matches(data, field_filter) for field_filter in self.filters)
+            ]
+        self.db.stats.count("reads", len(found))
+        return found
+
+    @staticmethod
+    def matches(data, field_filter):
+        field_path, op_string, value = field_filter
+        if op_string == "==":
+            return data.get(field_path) == value
+        if op_string == "in":
+            return data.get(field_path) in value
+        raise ValueError("Unsupported operator: %s" % op_string)
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, collection):
+        super().__init__(db, collection)
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self.db, self.collection, document_id or uuid.uuid4().hex)
+
+    def add(self, data):
+        reference = self.document()
+        with self.db.lock:
+            self.db.documents(self.collection)[reference.id] = dict(data)
+        return None, reference
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, reference, fields):
+        self.updates.append((reference, fields))
+
+    def commit(self):
+        self.db.latency.sleep()
+        self.db.stats.count("commits")
+        self.db.write(self.updates)
+
+class FakeFirestore:
+    """
+    Stand-in for the Firestore client, an in-memory database. Every call is one round trip.
+    """
+
+    project = "bench"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.collections = {}
+        self.stats = Stats()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def documents(self, collection):
+        return self.collections.setdefault(collection, {})
+
+    def get_all(self, references, field_paths=None):
+        self.latency.sleep()
+        return [reference.snapshot(field_paths) for reference in references]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write(self, updates):
+        with self.lock:
+            for reference, fields in updates:
+                data = self.documents(reference.collection).get(reference.id)
+                if data is None:
+                    raise KeyError("No document to update: %s/%s" % (reference.collection, reference.id))
+                data.update(fields)
+        self.stats.count("writes", len(updates))
+
+class FakeAsyncQuery:
+    def __init__(self, query):
+        self.query = query
+
+    def where(self, *args, **kwargs):
+        return FakeAsyncQuery(self.query.where(*args, **kwargs))
+
+    def select(self, field_paths):
+        return FakeAsyncQuery(self.query.select(field_paths))
+
+    async def get(self):
+        await self.query.db.latency.sleep_async()
+        return self.query.results()
+
+class FakeAsyncFirestore:
+    # Stand-in for the Firestore AsyncClient, on the data of a FakeFirestore
+    def __init__(self, db):
+        self.db = db
+        self.project = db.project
+
+    def collection(self, name):
+        return FakeAsyncQuery(self.db.collection(name))
+
+class FakeJobAPI:
+    """
+    Stand-in for the 3D model API: uploads start a job, which is finished after
+    polls_until_finished status checks, and the model file can then be downloaded.
+    """
+
+    def __init__(self, endpoint, latency, polls_until_finished=2, model_bytes=256 * 1024):
+        self.endpoint = endpoint.rstrip("/")
+        self.latency = latency
+        self.polls_until_finished = polls_until_finished
+        self.model = bytes(random.Random(0).getrandbits(8) for _ in range(model_bytes))
+        self.lock = threading.Lock()
+        self.polls = {}
+        self.stats = Stats()
+
+    def handle(self, method, url):
+        # Returns (status code, content type, body)
+        path = url[len(self.endpoint):] if url.startswith(self.endpoint) else url
+        self.stats.count("requests")
+
+        if method == "POST" and path == "/upload":
+            job_id = uuid.uuid4().hex
+            with self.lock:
+                self.polls[job_id] = 0
+            self.stats.count("uploads")
+            return 200, "application/json", json.dumps({"job_id": job_id}).encode()
+
+        match = re.match(r"^/check_job/(\w+)$", path)
+        if method == "GET" and match:
+            with self.lock:
+                if match.group(1) not in self.polls:
+                    return 404, "text/plain", b"No such job"
+                self.polls[match.group(1)] += 1
+                finished = self.polls[match.group(1)] >= self.polls_until_finished
+            if finished:
+                status = {"status": "finished", "filename": "%s/files/%s.glb" % (self.endpoint, match.group(1))}
+            else:
+                status = {"status": "processing"}
+            return 200, "application/json", json.dumps(status).encode()
+
+        if method == "GET" and path.startswith("/files/"):
+            self.stats.count("downloads")
+            return 200, "model/gltf-binary", self.model
+
+        return 404, "text/plain", b"Not found"
+
+    def adapter(self):
+        # To mount on a requests.Session for the endpoint
+        from requests.adapters import BaseAdapter
+        from requests.models import Response
+        from requests.structures import CaseInsensitiveDict
+
+        api = self
+
+        class FakeJobAPIAdapter(BaseAdapter):
+            def send(self, request, **kwargs):
+                api.latency.sleep()
+                status, content_type, body = api.handle(request.method, request.url)
+
+                response = Response()
+                response.status_code = status
+                response.headers = CaseInsensitiveDict({"Content-Type": content_type, "Content-Length": str(len(body))})
+                response.url = request.url
+                response.request = request
+                response.encoding = "utf-8"
+                response._content = body
+                response._content_consumed = True
+                return response
+
+            def close(self):
+                pass
+
+        return FakeJobAPIAdapter()
+
+    def async_transport(self):
+        # For an httpx.AsyncClient
+        import httpx
+
+        async def handler(request):
+            await self.latency.sleep_async()
+            status, content_type, body = self.handle(request.method, str(request.url))
+            return httpx.Response(status, content=body, headers={"Content-Type": content_type})
+
+        return httpx.MockTransport(handler)
@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Turn latency against conversation length, with and without history compaction.
+#
+# The chat model is simulated: a turn takes base_ms plus per_token_ms for every prompt token,
+# which is how prompt processing cost grows with the history. No Google Cloud access needed.
+#
+#   python -m bench.history_compaction --turns 60
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vertexai.preview.generative_models import Content, Part
+from common.compaction import HistoryCompactor, estimate_tokens
+
+USER_ID = "bench-user"
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeSummaryModel:
+    def generate_content(self, prompt):
+        time.sleep(0.05)
+        return FakeResponse("The user chatted about Cloud Meow and changed the color of their model a few times.")
+
+def run(turns, compactor, base_ms, per_token_ms, words_per_turn):
+    history = []
+    rows = []
+
+    for turn in range(1, turns + 1):
+        if compactor is not None:
+            compactor.apply(USER_ID, history)
+
+        prompt = "Tell me more about the Cloud Meow level %d. " % turn + "meow " * words_per_turn
+        prompt_tokens = sum(estimate_tokens(content) for content in history) + len(prompt) // 4
+
+        started = time.monotonic()
+        time.sleep((base_ms + per_token_ms * prompt_tokens) / 1000)
+        latency_ms = (time.monotonic() - started) * 1000
+
+        history.append(Content(role="user", parts=[Part.from_text(prompt)]))
+        history.append(Content(role="model", parts=[Part.from_text("Level %d is full of cats. " % turn + "purr " * words_per_turn)]))
+
+        if compactor is not None:
+            compactor.schedule(USER_ID, history)
+            # Users take a moment to type, the summary is written meanwhile
+            time.sleep(0.1)
+
+        rows.append((turn, prompt_tokens, latency_ms))
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Turn latency against conversation length, with and without history compaction.")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--token-budget", type=int, default=2000)
+    parser.add_argument("--keep-recent-tokens", type=int, default=800)
+    parser.add_argument("--base-ms", type=float, default=20)
+    parser.add_argument("--per-token-ms", type=float, default=0.02)
+    parser.add_argument("--words-per-turn", type=int, default=60)
+    args = parser.parse_args()
+
+    full = run(args.turns, None, args.base_ms, args.per_token_ms, args.words_per_turn)
+
+    compactor = HistoryCompactor(FakeSummaryModel(), "Summarize:", args.token_budget, args.keep_recent_tokens)
+    compacted = run(args.turns, compactor, args.base_ms, args.per_token_ms, args.words_per_turn)
+
+    print("%6s %14s %12s %14s %12s" % ("turn", "full tokens", "full ms", "compact tokens", "compact ms"))
+    for (turn, full_tokens, full_ms), (_, compact_tokens, compact_ms) in zip(full, compacted):
+        print("%6d %14d %12.1f %14d %12.1f" % (turn, full_tokens, full_ms, compact_tokens, compact_ms))
+
+    print()
+    print("Compaction stats: %s" % compactor.get_stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sends the chat turns of a cassette again, with every upstream call replayed from it.
+#
+# Record real traffic by serving with mode = record in the [cassette] section of config.ini,
+# then replay it offline. With --pace original the turns are sent at their recorded times and
+# every upstream call takes as long as it did, with --pace fast the turns are sent one after
+# the other and upstream calls return right away, which leaves only the Python side of the
+# hot path to profile, e.g. with python -m cProfile -m bench.replay --pace fast ...
+#
+#   python -m bench.replay cassette.jsonl.gz --pace fast --output replay.json
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.chat_load import ResourceSampler, configure, git_commit, percentile, request_body
+
+def send_wsgi(wsgi, recorded_request):
+    client = wsgi.app.test_client()
+    response = client.open(recorded_request["path"], method="POST", **request_body(recorded_request["f"], None, "data"))
+    response.get_data()
+    response.close()
+    return response.status_code
+
+def send_asgi(recorded_request):
+    import asgi
+
+    async def send():
+        client = asgi.app.test_client()
+        response = await client.open(recorded_request["path"], method="POST", **request_body(recorded_request["f"], None, "form"))
+        await response.get_data()
+        return response.status_code
+
+    return asyncio.run(send())
+
+def replay(wsgi, requests, args):
+    # Returns a row per request, in the recorded order
+    rows = [None] * len(requests)
+
+    def send(index):
+        started = time.monotonic()
+        try:
+            status = send_asgi(requests[index]) if args.app == "asgi" else send_wsgi(wsgi, requests[index])
+        except Exception as e:
+            print("%s failed: %s" % (requests[index]["path"], e), file=sys.stderr)
+            status = None
+        rows[index] = {
+            "path": requests[index]["path"],
+            "session": requests[index]["session"],
+            "status": status,
+            "recorded_ms": round(requests[index]["d"] * 1000, 2),
+            "replayed_ms": round((time.monotonic() - started) * 1000, 2),
+        }
+
+    if args.pace == "fast":
+        for index in range(len(requests)):
+            send(index)
+        return rows
+
+    # Turns overlapping when recorded overlap again, every session starts when the previous one is done
+    with ThreadPoolExecutor(max_workers=args.max_concurrency, thread_name_prefix="replay-client") as executor:
+        for session in sorted(set(recorded_request["session"] for recorded_request in requests)):
+            started = time.monotonic()
+            futures = []
+            for index, recorded_request in enumerate(requests):
+                if recorded_request["session"] != session:
+                    continue
+                delay = recorded_request["t"] - (time.monotonic() - started)
+                if delay > 0:
+                    threading.Event().wait(delay)
+                futures.append(executor.submit(send, index))
+            for future in futures:
+                future.result()
+
+    return rows
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": round(sum(values) / len(values), 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays the chat turns and upstream calls of a cassette.")
+    parser.add_argument("cassette", help="Cassette recorded with mode = record")
+    parser.add_argument("--app", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--pace", choices=["original", "fast"], default="original")
+    parser.add_argument("--paths", default="/chat,/chat/stream", help="Recorded requests to send again")
+    parser.add_argument("--max-concurrency", type=int, default=32, help="Turns sent at the same time with --pace original")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="Replaces a config.ini value, e.g. to replay with a setting changed")
+    parser.add_argument("--output", help="File to write the results to, as JSON")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    args.cassette = os.path.abspath(args.cassette)
+    args.output = os.path.abspath(args.output) if args.output else None
+
+    overrides = {("startup", "warm_up"): "false"}
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        section, _, key = name.partition(".")
+        overrides[(section, key)] = value
+    overrides.update({
+        ("cassette", "mode"): "replay",
+        ("cassette", "path"): args.cassette,
+        ("cassette", "pace"): args.pace,
+    })
+
+    wsgi = configure(overrides, args.log_level)
+    # Clients are created before the clock starts, none of them is used for real
+    for resource in (wsgi.vertex, wsgi.safety_settings, wsgi.chat_model, wsgi.rag_model, wsgi.db, wsgi.model_cache,
+                     wsgi.model_writes, wsgi.answer_cache, wsgi.intent_router, wsgi.compactor, wsgi.user_service):
+        resource.get()
+
+    paths = set(args.paths.split(","))
+    requests = sorted(
+        (recorded_request for recorded_request in wsgi.cassette.requests if recorded_request["path"] in paths),
+        key=lambda recorded_request: (recorded_request["session"], recorded_request["t"]))
+    if not requests:
+        sys.exit("No %s requests recorded in %s" % (args.paths, args.cassette))
+
+    started = time.monotonic()
+    with ResourceSampler() as sampler:
+        rows = replay(wsgi, requests, args)
+    elapsed = time.monotonic() - started
+
+    recorded = latency_summary([row["recorded_ms"] for row in rows])
+    replayed = latency_summary([row["replayed_ms"] for row in rows])
+    report = {
+        "cassette": args.cassette,
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "settings": vars(args),
+        "elapsed_seconds": round(elapsed, 3),
+        "recorded_ms": recorded,
+        "replayed_ms": replayed,
+        "cassette_stats": wsgi.cassette.get_stats(),
+        "requests": rows,
+    }
+    report.update(sampler.report())
+
+    print("%-10s %10s %10s %10s %10s" % ("", "p50 ms", "p95 ms", "p99 ms", "mean ms"))
+    for name, summary in (("recorded", recorded), ("replayed", replayed)):
+        print("%-10s %10.1f %10.1f %10.1f %10.1f" % (name, summary["p50"], summary["p95"], summary["p99"], summary["mean"]))
+    print()
+    print("%d requests in %.1f s, cassette: %s" % (len(rows), elapsed, wsgi.cassette.get_stats()))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print("Results written to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from common import tracing
+
+# Client-side admission control for the Vertex AI models. Every model has its own token bucket
+# (its per-minute quota) and concurrency limit. Calls queue for both until their deadline,
+# are shed right away when the queue ahead of them cannot drain in time, and are retried
+# with exponential backoff and full jitter when the model answers with a retryable error.
+
+class AdmissionRejected(Exception):
+    outcome = "rejected"
+
+    def __init__(self, limiter_name, reason):
+        super().__init__("Call to %s rejected: %s" % (limiter_name, reason))
+        self.limiter_name = limiter_name
+        self.reason = reason
+
+def is_retryable(error):
+    from google.api_core import exceptions
+
+    return isinstance(error, (
+        exceptions.TooManyRequests,
+        exceptions.ResourceExhausted,
+        exceptions.InternalServerError,
+        exceptions.BadGateway,
+        exceptions.ServiceUnavailable,
+        exceptions.GatewayTimeout,
+        exceptions.DeadlineExceeded,
+    ))
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # Returns 0 when a token was taken, else how long until one is available
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def time_for(self, count):
+        # How long until count tokens will have been available
+        self._refill()
+        return max(count - self.tokens, 0) / self.rate
+
+class ModelLimiter:
+    """
+    Token bucket, concurrency limit and retries for the calls to one model.
+    """
+
+    def __init__(self, name, requests_per_minute, burst, max_concurrency, queue_deadline=20,
+                 max_retries=3, backoff_initial=1, backoff_max=16, retryable=is_retryable):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_deadline = queue_deadline
+        self.max_retries = max_retries
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.retryable = retryable
+
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.stats = {
+            "admitted": 0,
+            "rejected_shed": 0,
+            "rejected_deadline": 0,
+            "retries": 0,
+            "failures": 0,
+            "queue_wait_seconds": 0.0,
+            "max_queue_wait_seconds": 0.0,
+        }
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls function once admitted, retrying retryable errors until the queue deadline.
+        """
+        with tracing.span("model_call", model=self.name):
+            deadline = time.monotonic() + self.queue_deadline
+            attempt = 0
+
+            while True:
+                self._admit(deadline)
+                try:
+                    return function(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, deadline)
+                finally:
+                    self._release()
+
+                attempt += 1
+                time.sleep(delay)
+
+    def stream(self, function, *args, **kwargs):
+        """
+        Like call() for functions returning a stream. The concurrency slot is held until the
+        stream is consumed, and only failures before the first chunk are retried.
+        """
+        span = tracing.start_span("model_call", model=self.name)
+        deadline = time.monotonic() + self.queue_deadline
+        attempt = 0
+
+        try:
+            while True:
+                started = False
+                self._admit(deadline)
+                try:
+                    for chunk in function(*args, **kwargs):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started:
+                        self._count("failures")
+                        raise
+                    delay = self._retry_delay(e, attempt, deadline)
+                finally:
+                    self._release()
+
+                attempt += 1
+                time.sleep(delay)
+        except BaseException as e:
+            span.set_outcome(tracing.outcome_of(e))
+            raise
+        finally:
+            span.end()
+
+    async def call_async(self, function, *args, **kwargs):
+        with tracing.span("model_call", model=self.name):
+            deadline = time.monotonic() + self.queue_deadline
+            attempt = 0
+
+            while True:
+                await self._admit_async(deadline)
+                try:
+                    return await function(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, deadline)
+                finally:
+                    self._release()
+
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def stream_async(self, function, *args, **kwargs):
+        span = tracing.start_span("model_call", model=self.name)
+        deadline = time.monotonic() + self.queue_deadline
+        attempt = 0
+
+        try:
+            while True:
+                started = False
+                await self._admit_async(deadline)
+                try:
+                    async for chunk in await function(*args, **kwargs):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started:
+                        self._count("failures")
+                        raise
+                    delay = self._retry_delay(e, attempt, deadline)
+                finally:
+                    self._release()
+
+                attempt += 1
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            span.set_outcome(tracing.outcome_of(e))
+            raise
+        finally:
+            span.end()
+
+    def get_stats(self):
+        with self.condition:
+            decided = self.stats["admitted"] + self.stats["rejected_shed"] + self.stats["rejected_deadline"]
+            rejected = self.stats["rejected_shed"] + self.stats["rejected_deadline"]
+            return dict(
+                self.stats,
+                active=self.active,
+                waiting=self.waiting,
+                tokens=round(self.bucket.tokens, 2),
+                average_queue_wait_seconds=self.stats["queue_wait_seconds"] / self.stats["admitted"] if self.stats["admitted"] else 0.0,
+                rejection_rate=rejected / decided if decided else 0.0,
+            )
+
+    def _retry_delay(self, error, attempt, deadline):
+        # Re-raises the error unless another attempt can be made before the deadline
+        if attempt >= self.max_retries or not self.retryable(error):
+            self._count("failures")
+            raise error
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_initial * 2 ** attempt))
+        if time.monotonic() + delay >= deadline:
+            self._count("failures")
+            raise error
+
+        logging.warning("Retrying call to %s in %.1f seconds after %s", self.name, delay, error)
+        self._count("retries")
+        return delay
+
+    def _try_admit(self, started, deadline):
+        # Returns None once admitted, else how long to wait before trying again
+        if self.active < self.max_concurrency:
+            wait = self.bucket.take()
+            if wait == 0:
+                self.active += 1
+                waited = time.monotonic() - started
+                self.stats["admitted"] += 1
+                self.stats["queue_wait_seconds"] += waited
+                self.stats["max_queue_wait_seconds"] = max(self.stats["max_queue_wait_seconds"], waited)
+                return None
+        else:
+            # Woken up by _release()
+            wait = None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (wait is not None and wait >= remaining):
+            self.stats["rejected_deadline"] += 1
+            raise AdmissionRejected(self.name, "no capacity before the deadline")
+
+        return remaining if wait is None else wait
+
+    def _enter_queue(self, deadline):
+        # Sheds the call when the calls already waiting need all the tokens until the deadline
+        if self.bucket.time_for(self.waiting + 1) > deadline - time.monotonic():
+            self.stats["rejected_shed"] += 1
+            raise AdmissionRejected(self.name, "queue cannot be served before the deadline")
+        self.waiting += 1
+
+    def _admit(self, deadline):
+        started = time.monotonic()
+
+        with self.condition:
+            self._enter_queue(deadline)
+            try:
+                while True:
+                    wait = self._try_admit(started, deadline)
+                    if wait is None:
+                        return
+                    self.condition.wait(wait)
+            finally:
+                self.waiting -= 1
+
+    async def _admit_async(self, deadline):
+        started = time.monotonic()
+
+        with self.condition:
+            self._enter_queue(deadline)
+        try:
+            while True:
+                with self.condition:
+                    wait = self._try_admit(started, deadline)
+                if wait is None:
+                    return
+                # The event loop cannot block on the condition, free slots are polled for
+                await asyncio.sleep(min(wait, 0.05))
+        finally:
+            with self.condition:
+                self.waiting -= 1
+
+    def _release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def _count(self, name):
+        with self.condition:
+            self.stats[name] += 1
+
+class AdmissionController:
+    """
+    The ModelLimiter of every model, e.g. limiter("gemini").call(chat.send_message, prompt).
+    """
+
+    def __init__(self, limiters):
+        self.limiters = {limiter.name: limiter for limiter in limiters}
+
+    @classmethod
+    def from_config(cls, config_service):
+        limiters = []
+        for name in config_service.get_property('admission', 'limiters').split('|'):
+            section = 'admission_' + name
+            limiters.append(ModelLimiter(
+                name,
+                requests_per_minute=float(config_service.get_property(section, 'requests_per_minute')),
+                burst=float(config_service.get_property(section, 'burst')),
+                max_concurrency=int(config_service.get_property(section, 'max_concurrency')),
+                queue_deadline=float(config_service.get_property('admission', 'queue_deadline_seconds')),
+                max_retries=int(config_service.get_property('admission', 'max_retries')),
+                backoff_initial=float(config_service.get_property('admission', 'backoff_initial_seconds')),
+                backoff_max=float(config_service.get_property('admission', 'backoff_max_seconds')),
+            ))
+
+        return cls(limiters)
+
+    def limiter(self, name):
+        return self.limiters[name]
+
+    def get_stats(self):
+        return {name: limiter.get_stats() for name, limiter in self.limiters.items()}
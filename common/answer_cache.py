@@ -0,0 +1,204 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+def normalize_question(question):
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+class CachedAnswer:
+    def __init__(self, question, answer, latency, expires, slot):
+        self.question = question
+        self.answer = answer
+        self.latency = latency
+        self.expires = expires
+        self.slot = slot
+
+class AnswerCache:
+    """
+    Caches RAG answers by question, matching exact and near-duplicate questions.
+
+    Questions are normalized first; when there is no exact match, the most similar cached
+    question whose embedding similarity is above the threshold is used. Embeddings of the
+    cached questions live in one preallocated matrix so a lookup is a single dot product.
+    The cache is cleared whenever the version of the corpus it was filled from changes.
+
+    Embedding calls go through limiter when given (see common.admission). A question that
+    cannot be embedded is only matched exactly.
+    """
+
+    def __init__(self, embedder=None, threshold=0.92, ttl=3600, max_entries=500, limiter=None):
+        self.embedder = embedder
+        self.limiter = limiter
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.slot_keys = {}
+        self.miss_vectors = OrderedDict()
+        self.vectors = None
+        self.valid = np.zeros(max_entries, dtype=bool)
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.version = None
+        self.stats = {
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+            "embedding_failures": 0,
+            "saved_seconds": 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service, embedder=None, limiter=None):
+        # An embedder given is used instead of the configured one
+        if embedder is None and config_service.get_property('answer_cache', 'embedder') != "none":
+            from common import local_rag
+
+            embedder = local_rag.create_embedder(config_service, 'answer_cache', 'embedder', 'embedding_model')
+
+        return cls(
+            embedder=embedder,
+            threshold=float(config_service.get_property('answer_cache', 'similarity_threshold')),
+            ttl=float(config_service.get_property('answer_cache', 'ttl_seconds')),
+            max_entries=int(config_service.get_property('answer_cache', 'max_entries')),
+            limiter=limiter,
+        )
+
+    def lookup(self, question, version):
+        key = normalize_question(question)
+
+        with self.lock:
+            self._check_version(version)
+
+            entry = self.entries.get(key)
+            if entry is not None and not self._expired(key, entry):
+                return self._hit(key, entry, "exact_hits")
+
+        # Embedding happens outside the lock, it may be a network call
+        vector = self._embed(key)
+
+        with self.lock:
+            if vector is not None and self.vectors is not None and self.valid.any():
+                scores = self.vectors @ vector
+                scores[~self.valid] = -np.inf
+                slot = int(np.argmax(scores))
+
+                if scores[slot] >= self.threshold:
+                    similar_key = self.slot_keys[slot]
+                    entry = self.entries[similar_key]
+                    if not self._expired(similar_key, entry):
+                        return self._hit(similar_key, entry, "semantic_hits")
+
+            # Kept for the store() that usually follows a miss
+            if vector is not None:
+                self.miss_vectors[key] = vector
+                while len(self.miss_vectors) > self.max_entries:
+                    self.miss_vectors.popitem(last=False)
+
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, question, version, answer, latency):
+        key = normalize_question(question)
+
+        with self.lock:
+            vector = self.miss_vectors.pop(key, None)
+        if vector is None:
+            vector = self._embed(key)
+
+        with self.lock:
+            self._check_version(version)
+
+            if key in self.entries:
+                self._remove(key)
+            while not self.free_slots:
+                self._remove(next(iter(self.entries)))
+
+            slot = self.free_slots.pop()
+            if vector is not None:
+                if self.vectors is None:
+                    self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self.vectors[slot] = vector
+                self.valid[slot] = True
+
+            self.entries[key] = CachedAnswer(question, answer, latency, time.monotonic() + self.ttl, slot)
+            self.slot_keys[slot] = key
+
+    def invalidate(self):
+        with self.lock:
+            self._clear()
+
+    def get_stats(self):
+        with self.lock:
+            hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+            lookups = hits + self.stats["misses"]
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                hit_ratio=hits / lookups if lookups else 0.0,
+            )
+
+    def _embed(self, key):
+        if self.embedder is None or not key:
+            return None
+
+        try:
+            if self.limiter is None:
+                return self.embedder.embed([key])[0]
+            return self.limiter.call(self.embedder.embed, [key])[0]
+        except Exception as e:
+            # Rejected by the limiter or failed, the cache still answers exact matches
+            logging.warning("Cannot embed question for the answer cache: %s", e)
+            with self.lock:
+                self.stats["embedding_failures"] += 1
+            return None
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.stats["invalidations"] += 1
+            self._clear()
+            self.version = version
+
+    def _expired(self, key, entry):
+        if entry.expires > time.monotonic():
+            return False
+        self._remove(key)
+        return True
+
+    def _hit(self, key, entry, kind):
+        self.entries.move_to_end(key)
+        self.stats[kind] += 1
+        self.stats["saved_seconds"] += entry.latency
+        return entry.answer
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        del self.slot_keys[entry.slot]
+        self.valid[entry.slot] = False
+        self.free_slots.append(entry.slot)
+
+    def _clear(self):
+        self.entries.clear()
+        self.slot_keys.clear()
+        self.valid[:] = False
+        self.free_slots = list(range(self.max_entries - 1, -1, -1))
@@ -0,0 +1,242 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+
+mimetypes.add_type("model/gltf-binary", ".glb")
+mimetypes.add_type("model/gltf+json", ".gltf")
+
+# Variants are preferred in this order when the client accepts them
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+HASH_LENGTH = 32
+CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{%d}\.[0-9a-z]+$" % HASH_LENGTH)
+
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        quality = params.strip().replace(" ", "")
+        # "gzip;q=0" means the client does not accept it
+        if quality.startswith("q=") and re.match(r"^q=0(\.0*)?$", quality):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+def write_atomic(path, data):
+    # Readers see either no file or the complete file, never a partial one
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".part")
+    try:
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+class Asset:
+    def __init__(self, path, mimetype, etag, encoding, immutable, max_age):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.encoding = encoding
+        self.immutable = immutable
+        self.max_age = max_age
+
+    def headers(self):
+        headers = {
+            # Content-addressed names never change contents, the others are revalidated with the ETag
+            "Cache-Control": "public, max-age=%d, immutable" % self.max_age if self.immutable else "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if self.encoding is not None:
+            headers["Content-Encoding"] = self.encoding
+        return headers
+
+class AssetStore:
+    """
+    Generated assets (avatars, 3D models) stored under content-hash names.
+
+    A file is named after the first 32 hex digits of the SHA-256 of its contents, so its URL
+    changes whenever its contents do and every response can be cached for good. Compressible
+    assets get precompressed .gz (and .br, when the brotli module is installed) variants next
+    to them. Files with older, non content-addressed names are still served, revalidated
+    with an ETag of their contents, from root or else from legacy_root where they were
+    written before (e.g. the default.glb of the seeded models).
+    """
+
+    def __init__(self, root="static", kinds=("avatars", "models"), url_prefix="/assets",
+                 max_age=31536000, compress_min_bytes=1024, compress_extensions=(".glb", ".gltf", ".json", ".svg"),
+                 legacy_root="static"):
+        self.root = root
+        self.legacy_root = legacy_root
+        self.kinds = set(kinds)
+        self.url_prefix = url_prefix
+        self.max_age = max_age
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_extensions = set(compress_extensions)
+
+        self.lock = threading.Lock()
+        self.legacy_etags = {}
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            root=config_service.get_property('assets', 'root'),
+            kinds=config_service.get_property('assets', 'kinds').split('|'),
+            max_age=int(config_service.get_property('assets', 'max_age_seconds')),
+            compress_min_bytes=int(config_service.get_property('assets', 'compress_min_bytes')),
+            compress_extensions=config_service.get_property('assets', 'compress_extensions').split('|'),
+            legacy_root=config_service.get_property('assets', 'legacy_root'),
+        )
+
+    def put(self, kind, data, extension):
+        """
+        Stores data under its content-hash name and returns the name, e.g. "3f2a...9c.png".
+        """
+        name = hashlib.sha256(data).hexdigest()[:HASH_LENGTH] + extension
+        path = self.path(kind, name)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, data)
+            self._precompress(path, data)
+
+        return name
+
+    def put_file(self, kind, source_path, extension):
+        # Moves a file written elsewhere (e.g. a download) to its content-hash name
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as source:
+            for block in iter(lambda: source.read(1024 * 1024), b""):
+                digest.update(block)
+
+        name = digest.hexdigest()[:HASH_LENGTH] + extension
+        path = self.path(kind, name)
+
+        if os.path.exists(path):
+            os.unlink(source_path)
+            return name
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+        if extension in self.compress_extensions and os.path.getsize(path) >= self.compress_min_bytes:
+            with open(path, "rb") as asset_file:
+                self._precompress(path, asset_file.read())
+
+        return name
+
+    def temp_file(self, kind, extension):
+        # A new empty file to write an asset to before put_file(), on the same filesystem so it can be renamed
+        directory = os.path.dirname(self.path(kind, "asset" + extension))
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=extension + ".part")
+        os.close(handle)
+        return temp_path
+
+    def url(self, kind, name):
+        return "%s/%s/%s" % (self.url_prefix, kind, name)
+
+    def path(self, kind, name):
+        if kind not in self.kinds or not self.is_safe_name(name):
+            raise ValueError("Not an asset: %s/%s" % (kind, name))
+        return os.path.join(self.root, kind, name)
+
+    def path_for_url(self, url):
+        # Paths of URLs returned by url(), and of the /static/<kind>/<name> URLs from before
+        for prefix in (self.url_prefix + "/", "/" + self.root + "/"):
+            if url.startswith(prefix):
+                kind, _, name = url[len(prefix):].partition("/")
+                return self.path(kind, name.split("?")[0])
+        raise ValueError("Not an asset URL: %s" % url)
+
+    @staticmethod
+    def is_safe_name(name):
+        return bool(name) and os.path.basename(name) == name and not name.startswith(".")
+
+    @staticmethod
+    def is_content_addressed(name):
+        return CONTENT_ADDRESSED.match(name) is not None
+
+    def lookup(self, kind, name, accept_encoding=None):
+        """
+        Finds the variant of an asset to send to a client.
+
+        Returns:
+            An Asset, or None when there is no such asset.
+        """
+        if kind not in self.kinds or not self.is_safe_name(name):
+            return None
+
+        immutable = self.is_content_addressed(name)
+        path = os.path.join(self.root, kind, name)
+        if not os.path.isfile(path) and not immutable and self.legacy_root:
+            path = os.path.join(self.legacy_root, kind, name)
+        if not os.path.isfile(path):
+            return None
+
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        etag = name.split(".")[0] if immutable else self._legacy_etag(path)
+
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(path + suffix):
+                return Asset(path + suffix, mimetype, etag + "-" + encoding, encoding, immutable, self.max_age)
+
+        return Asset(path, mimetype, etag, None, immutable, self.max_age)
+
+    def _legacy_etag(self, path):
+        # Hashing a large model on every request is avoided while the file is unchanged
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            cached = self.legacy_etags.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as asset_file:
+            for block in iter(lambda: asset_file.read(1024 * 1024), b""):
+                digest.update(block)
+        etag = digest.hexdigest()[:HASH_LENGTH]
+
+        with self.lock:
+            self.legacy_etags[path] = (key, etag)
+        return etag
+
+    def _precompress(self, path, data):
+        extension = os.path.splitext(path)[1]
+        if extension not in self.compress_extensions or len(data) < self.compress_min_bytes:
+            return
+
+        variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+        try:
+            import brotli
+            variants[".br"] = brotli.compress(data, quality=11)
+        except ImportError:
+            pass
+
+        for suffix, compressed in variants.items():
+            # Variants that don't save anything are left out
+            if len(compressed) < len(data):
+                write_atomic(path + suffix, compressed)
+                logging.debug("Precompressed %s to %d of %d bytes", path + suffix, len(compressed), len(data))
@@ -0,0 +1,685 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+FORMAT_VERSION = 1
+
+class CassetteMiss(Exception):
+    # A call made while replaying that the cassette has no recording left for
+    pass
+
+class ReplayedError(Exception):
+    # An error recorded without an HTTP status, raised again when replaying
+    pass
+
+def fingerprint(request):
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), default=repr)
+    return hashlib.sha1(encoded.encode()).hexdigest()[:16]
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode("ascii")
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+def encode_error(error):
+    # API errors keep their status, so retries and admission treat a replayed error like the original
+    encoded = {"type": type(error).__name__, "message": str(error)}
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        encoded["code"] = code
+    return encoded
+
+def decode_error(encoded):
+    if "code" in encoded:
+        from google.api_core import exceptions
+        return exceptions.from_http_status(encoded["code"], encoded["message"])
+    return ReplayedError("%s: %s" % (encoded["type"], encoded["message"]))
+
+def read_entries(path):
+    # Recordings cut short (e.g. the process was killed) are read up to their last complete line
+    opener = gzip.open if path.endswith(".gz") else open
+    entries = []
+    try:
+        with opener(path, "rt", encoding="utf-8") as cassette_file:
+            for line in cassette_file:
+                if line.endswith("\n"):
+                    entries.append(json.loads(line))
+    except (EOFError, gzip.BadGzipFile) as e:
+        logging.warning("Cassette %s ends with an incomplete recording: %s", path, e)
+    return entries
+
+class Cassette:
+    """
+    Records the calls to upstream services (Gemini, Imagen, embeddings, Firestore and the 3D model
+    API) with their timings, and replays them without the network.
+
+    A cassette is a JSON lines file, gzip-compressed when its name ends with .gz. Recordings are
+    appended: every process recording to it starts a new session with a header line, followed
+    by one line per call and per served request (see request()). When replaying, a call gets
+    the first unused recording of the same operation and request, or else the first unused
+    one of the same operation, which keeps a replay of the same traffic deterministic. Replayed
+    calls take as long as the recorded ones with pace "original" and return right away with
+    pace "fast".
+
+    Clients are wrapped with client(), see the Cassette* classes below.
+    """
+
+    def __init__(self, path, mode="replay", pace="original"):
+        if mode not in ("record", "replay"):
+            raise ValueError("Unknown cassette mode: %s" % mode)
+        if pace not in ("original", "fast"):
+            raise ValueError("Unknown cassette pace: %s" % pace)
+
+        self.path = path
+        self.mode = mode
+        self.pace = pace
+        self.origin = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.calls = []
+        self.requests = []
+        self.by_request = {}
+        self.by_operation = {}
+        self.stats = {
+            "recorded": 0,
+            "recorded_errors": 0,
+            "requests_recorded": 0,
+            "replayed": 0,
+            "replayed_errors": 0,
+            "matched_request": 0,
+            "matched_operation": 0,
+            "misses": 0,
+        }
+
+        if mode == "record":
+            opener = gzip.open if path.endswith(".gz") else open
+            self.file = opener(path, "at", encoding="utf-8")
+            self._write({"cassette": FORMAT_VERSION, "created": datetime.datetime.now(datetime.timezone.utc).isoformat()})
+        else:
+            self.load(read_entries(path))
+
+    @classmethod
+    def from_config(cls, config_service):
+        mode = config_service.get_property('cassette', 'mode')
+        if mode == "off":
+            return None
+
+        return cls(
+            config_service.get_property('cassette', 'path'),
+            mode=mode,
+            pace=config_service.get_property('cassette', 'pace'),
+        )
+
+    def load(self, entries):
+        session = -1
+        for entry in entries:
+            if "cassette" in entry:
+                session += 1
+            elif entry.get("k") == "request":
+                self.requests.append(dict(entry, session=session))
+            elif "k" in entry:
+                index = len(self.calls)
+                self.calls.append(entry)
+                operation = (entry["k"], entry["o"])
+                self.by_request.setdefault(operation + (entry["h"],), deque()).append(index)
+                self.by_operation.setdefault(operation, deque()).append(index)
+
+        logging.info("Loaded %d calls and %d requests from cassette %s", len(self.calls), len(self.requests), self.path)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def client(self, kind, name, factory, **options):
+        """
+        Wraps the client built by factory, which is not called when replaying.
+
+        Args:
+            kind: gemini, imagen, embeddings or firestore.
+            name: Tells the clients of a kind apart, e.g. the chat and the RAG model.
+            factory: Builds the real client.
+            options: asynchronous=True for the Firestore AsyncClient.
+        """
+        wrappers = {
+            "gemini": CassetteModel,
+            "imagen": CassetteImagen,
+            "embeddings": CassetteEmbedder,
+            "firestore": CassetteFirestore,
+        }
+        return wrappers[kind](self, name, factory() if self.mode == "record" else None, **options)
+
+    def http_adapter(self, **kwargs):
+        # For a requests.Session, kwargs are the HTTPAdapter's (e.g. pool_maxsize)
+        return cassette_adapter(self, **kwargs)
+
+    def http_transport(self, transport=None):
+        # For an httpx.AsyncClient, wraps the transport the recorded requests are sent with
+        return cassette_transport(self, transport)
+
+    def call(self, kind, operation, request, function, encode=None, decode=None):
+        """
+        Records function() or replays its recording.
+
+        The recording is encode(result), replays return decode(recording). Both default to the
+        result itself, which has to be JSON serializable then.
+        """
+        key = fingerprint(request)
+
+        if self.mode == "replay":
+            entry = self._take(kind, operation, key)
+            if self.pace == "original":
+                time.sleep(entry["d"])
+            return self._replayed(entry, decode)
+
+        started = time.monotonic()
+        try:
+            result = function()
+        except Exception as e:
+            self._record(kind, operation, key, started, error=e)
+            raise
+
+        self._record(kind, operation, key, started, result=encode(result) if encode else result)
+        return result
+
+    async def call_async(self, kind, operation, request, function, encode=None, decode=None):
+        # call() for a coroutine function
+        key = fingerprint(request)
+
+        if self.mode == "replay":
+            entry = self._take(kind, operation, key)
+            if self.pace == "original":
+                await asyncio.sleep(entry["d"])
+            return self._replayed(entry, decode)
+
+        started = time.monotonic()
+        try:
+            result = await function()
+        except Exception as e:
+            self._record(kind, operation, key, started, error=e)
+            raise
+
+        self._record(kind, operation, key, started, result=encode(result) if encode else result)
+        return result
+
+    def stream(self, kind, operation, request, function, encode, decode):
+        # call() for a function returning an iterator, every chunk is replayed at its own time
+        key = fingerprint(request)
+
+        if self.mode == "replay":
+            entry = self._take(kind, operation, key)
+            started = time.monotonic()
+            for offset, chunk in zip(entry["c"], entry["r"]):
+                if self.pace == "original":
+                    time.sleep(max(offset - (time.monotonic() - started), 0))
+                yield decode(chunk)
+            if "e" in entry:
+                raise decode_error(entry["e"])
+            return
+
+        started = time.monotonic()
+        chunks, offsets = [], []
+        try:
+            for chunk in function():
+                chunks.append(encode(chunk))
+                offsets.append(round(time.monotonic() - started, 4))
+                yield chunk
+        except Exception as e:
+            self._record(kind, operation, key, started, result=chunks, offsets=offsets, error=e)
+            raise
+
+        self._record(kind, operation, key, started, result=chunks, offsets=offsets)
+
+    async def stream_async(self, kind, operation, request, function, encode, decode):
+        # stream() for a coroutine function returning an async iterator
+        key = fingerprint(request)
+
+        if self.mode == "replay":
+            entry = self._take(kind, operation, key)
+            started = time.monotonic()
+            for offset, chunk in zip(entry["c"], entry["r"]):
+                if self.pace == "original":
+                    await asyncio.sleep(max(offset - (time.monotonic() - started), 0))
+                yield decode(chunk)
+            if "e" in entry:
+                raise decode_error(entry["e"])
+            return
+
+        started = time.monotonic()
+        chunks, offsets = [], []
+        try:
+            async for chunk in await function():
+                chunks.append(encode(chunk))
+                offsets.append(round(time.monotonic() - started, 4))
+                yield chunk
+        except Exception as e:
+            self._record(kind, operation, key, started, result=chunks, offsets=offsets, error=e)
+            raise
+
+        self._record(kind, operation, key, started, result=chunks, offsets=offsets)
+
+    @contextmanager
+    def request(self, path, fields):
+        # Requests served while recording are written down as well, bench/replay.py sends them again
+        if self.mode != "record":
+            yield
+            return
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._write({
+                "k": "request",
+                "path": path,
+                "f": fields,
+                "t": round(started - self.origin, 4),
+                "d": round(time.monotonic() - started, 4),
+            })
+            with self.lock:
+                self.stats["requests_recorded"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, mode=self.mode, pace=self.pace, path=self.path)
+            if self.mode == "replay":
+                stats["left"] = len(self.calls) - self.stats["replayed"]
+            return stats
+
+    def _record(self, kind, operation, key, started, result=None, offsets=None, error=None):
+        entry = {
+            "k": kind,
+            "o": operation,
+            "h": key,
+            "t": round(started - self.origin, 4),
+            "d": round(time.monotonic() - started, 4),
+            "r": result,
+        }
+        if offsets is not None:
+            entry["c"] = offsets
+        if error is not None:
+            entry["e"] = encode_error(error)
+
+        self._write(entry)
+        with self.lock:
+            self.stats["recorded"] += 1
+            if error is not None:
+                self.stats["recorded_errors"] += 1
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(",", ":"), default=repr) + "\n"
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            # Every line is on disk right away, a recording cut short can still be replayed
+            self.file.flush()
+
+    def _take(self, kind, operation, key):
+        with self.lock:
+            matched = "matched_request"
+            index = self._next_unused(self.by_request.get((kind, operation, key)))
+            if index is None:
+                matched = "matched_operation"
+                index = self._next_unused(self.by_operation.get((kind, operation)))
+
+            if index is None:
+                self.stats["misses"] += 1
+                raise CassetteMiss("No recording left for %s %s" % (kind, operation))
+
+            entry = self.calls[index]
+            entry["used"] = True
+            self.stats["replayed"] += 1
+            self.stats[matched] += 1
+            return entry
+
+    def _next_unused(self, indexes):
+        # Recordings taken through the other index are skipped
+        while indexes:
+            index = indexes.popleft()
+            if not self.calls[index].get("used"):
+                return index
+        return None
+
+    def _replayed(self, entry, decode):
+        if "e" in entry:
+            with self.lock:
+                self.stats["replayed_errors"] += 1
+            raise decode_error(entry["e"])
+        return decode(entry["r"]) if decode else entry["r"]
+
+# Gemini
+
+def describe_contents(contents):
+    # The contents of a model request as JSON, what the recordings of a request are found by
+    if isinstance(contents, (list, tuple)):
+        return [describe_contents(item) for item in contents]
+    if isinstance(contents, (str, int, float, bool)) or contents is None:
+        return contents
+    to_dict = getattr(contents, "to_dict", None)
+    return to_dict() if to_dict is not None else repr(contents)
+
+def encode_response(response):
+    return response.to_dict()
+
+def decode_response(encoded):
+    from vertexai.preview.generative_models import GenerationResponse
+    return GenerationResponse.from_dict(encoded)
+
+class CassetteModel:
+    """
+    A GenerativeModel whose calls go through the cassette, chats included: the ChatSession of
+    start_chat() calls the model's _generate_content* methods.
+    """
+
+    def __init__(self, cassette, name, model):
+        self.cassette = cassette
+        self.name = name
+        self.model = model
+
+    def __getattr__(self, attribute):
+        if self.model is None:
+            raise AttributeError("%s is not available when replaying" % attribute)
+        return getattr(self.model, attribute)
+
+    def start_chat(self, history=None, response_validation=True):
+        from vertexai.preview.generative_models import ChatSession
+        return ChatSession(model=self, history=history, response_validation=response_validation)
+
+    def generate_content(self, contents, **kwargs):
+        return self._call("generate_content", contents, lambda: self.model.generate_content(contents, **kwargs))
+
+    async def generate_content_async(self, contents, **kwargs):
+        return await self._call_async("generate_content", contents, lambda: self.model.generate_content_async(contents, **kwargs))
+
+    def _generate_content(self, contents, **kwargs):
+        return self._call("generate_content", contents, lambda: self.model._generate_content(contents=contents, **kwargs))
+
+    async def _generate_content_async(self, contents, **kwargs):
+        return await self._call_async("generate_content", contents, lambda: self.model._generate_content_async(contents=contents, **kwargs))
+
+    def _generate_content_streaming(self, contents, **kwargs):
+        return self.cassette.stream(
+            "gemini", self.name + ".stream", describe_contents(contents),
+            lambda: self.model._generate_content_streaming(contents=contents, **kwargs), encode_response, decode_response)
+
+    async def _generate_content_streaming_async(self, contents, **kwargs):
+        return self.cassette.stream_async(
+            "gemini", self.name + ".stream", describe_contents(contents),
+            lambda: self.model._generate_content_streaming_async(contents=contents, **kwargs), encode_response, decode_response)
+
+    def _call(self, method, contents, function):
+        return self.cassette.call("gemini", self.name + "." + method, describe_contents(contents), function, encode_response, decode_response)
+
+    async def _call_async(self, method, contents, function):
+        return await self.cassette.call_async("gemini", self.name + "." + method, describe_contents(contents), function, encode_response, decode_response)
+
+# Imagen and embeddings
+
+def encode_images(images):
+    return [encode_bytes(image._image_bytes) for image in images]
+
+def decode_images(encoded):
+    from vertexai.preview.vision_models import GeneratedImage
+    return [GeneratedImage(decode_bytes(image), generation_parameters={}) for image in encoded]
+
+class CassetteImagen:
+    def __init__(self, cassette, name, model):
+        self.cassette = cassette
+        self.name = name
+        self.model = model
+
+    def generate_images(self, prompt, **kwargs):
+        return self.cassette.call(
+            "imagen", self.name + ".generate_images", {"prompt": prompt, "parameters": kwargs},
+            lambda: self.model.generate_images(prompt=prompt, **kwargs), encode_images, decode_images)
+
+class CassetteEmbedder:
+    # An embedder of common.local_rag, embed() returns a matrix of normalized vectors
+    def __init__(self, cassette, name, embedder):
+        self.cassette = cassette
+        self.name = name
+        self.embedder = embedder
+
+    def embed(self, texts):
+        import numpy as np
+
+        return self.cassette.call(
+            "embeddings", self.name + ".embed", list(texts), lambda: self.embedder.embed(texts),
+            lambda vectors: vectors.tolist(), lambda vectors: np.asarray(vectors, dtype=np.float32))
+
+# Firestore
+
+def encode_snapshot(snapshot):
+    return {
+        "path": snapshot.reference.path,
+        "exists": snapshot.exists,
+        "data": json_fields(snapshot.to_dict()) if snapshot.exists else None,
+    }
+
+def json_fields(fields):
+    # Timestamps and the like are recorded as text
+    return json.loads(json.dumps(fields, default=str))
+
+class CassetteSnapshot:
+    def __init__(self, client, encoded):
+        self.reference = CassetteDocument(client, encoded["path"])
+        self.id = self.reference.id
+        self.exists = encoded["exists"]
+        self.data = encoded["data"]
+
+    def to_dict(self):
+        return dict(self.data) if self.data is not None else None
+
+class CassetteDocument:
+    # Only the path is kept, the real reference is made from it when recording
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def live(self):
+        return self.client.client.document(self.path)
+
+    def get(self, field_paths=None):
+        return self.client.call(
+            "document.get", {"path": self.path, "fields": field_paths},
+            lambda: encode_snapshot(self.live().get(field_paths=field_paths)),
+            lambda encoded: CassetteSnapshot(self.client, encoded))
+
+    def update(self, fields):
+        def update_live():
+            self.live().update(fields)
+
+        self.client.call("document.update", {"path": self.path, "fields": json_fields(fields)}, update_live)
+
+class CassetteQuery:
+    def __init__(self, client, query, path, description=()):
+        self.client = client
+        self.query = query
+        self.path = path
+        self.description = description
+
+    def where(self, *args, **kwargs):
+        field_filter = kwargs.get("filter")
+        if field_filter is not None:
+            described = [field_filter.field_path, field_filter.op_string, field_filter.value]
+        else:
+            described = list(args) + [kwargs.get(name) for name in ("field_path", "op_string", "value") if name in kwargs]
+        return self._chain("where", json_fields(described), lambda query: query.where(*args, **kwargs))
+
+    def select(self, field_paths):
+        return self._chain("select", list(field_paths), lambda query: query.select(field_paths))
+
+    def limit(self, count):
+        return self._chain("limit", count, lambda query: query.limit(count))
+
+    def document(self, document_id):
+        return CassetteDocument(self.client, self.path + "/" + document_id)
+
+    def get(self):
+        request = {"path": self.path, "query": self.description}
+        decode = lambda encoded: [CassetteSnapshot(self.client, snapshot) for snapshot in encoded]
+
+        if self.client.asynchronous:
+            async def get_async():
+                return [encode_snapshot(snapshot) for snapshot in await self.query.get()]
+            return self.client.call_async("query.get", request, get_async, decode)
+
+        return self.client.call("query.get", request, lambda: [encode_snapshot(snapshot) for snapshot in self.query.get()], decode)
+
+    def stream(self):
+        return iter(self.get())
+
+    def on_snapshot(self, callback):
+        # Listeners keep running while recording, nothing changes when replaying
+        if self.query is None:
+            return NoWatch()
+        return self.query.on_snapshot(callback)
+
+    def _chain(self, step, arguments, function):
+        query = function(self.query) if self.query is not None else None
+        return CassetteQuery(self.client, query, self.path, self.description + ((step, arguments),))
+
+class NoWatch:
+    def unsubscribe(self):
+        pass
+
+class CassetteBatch:
+    def __init__(self, client):
+        self.client = client
+        self.updates = []
+
+    def update(self, reference, fields):
+        self.updates.append((reference, fields))
+
+    def commit(self):
+        def commit_live():
+            batch = self.client.client.batch()
+            for reference, fields in self.updates:
+                batch.update(reference.live(), fields)
+            batch.commit()
+
+        return self.client.call(
+            "batch.commit", [[reference.path, json_fields(fields)] for reference, fields in self.updates], commit_live)
+
+class CassetteFirestore:
+    """
+    A Firestore client (or AsyncClient with asynchronous=True) whose reads and writes go through
+    the cassette. Snapshots and references are the cassette's own in both modes, so the
+    application code runs the same when recording and when replaying.
+    """
+
+    def __init__(self, cassette, name, client, asynchronous=False):
+        self.cassette = cassette
+        self.name = name
+        self.client = client
+        self.asynchronous = asynchronous
+
+    @property
+    def project(self):
+        return self.client.project if self.client is not None else "replay"
+
+    def collection(self, name):
+        return CassetteQuery(self, self.client.collection(name) if self.client is not None else None, name)
+
+    def document(self, path):
+        return CassetteDocument(self, path)
+
+    def get_all(self, references, field_paths=None):
+        references = list(references)
+        return self.call(
+            "get_all", {"paths": [reference.path for reference in references], "fields": field_paths},
+            lambda: [encode_snapshot(snapshot) for snapshot in self.client.get_all([reference.live() for reference in references], field_paths=field_paths)],
+            lambda encoded: [CassetteSnapshot(self, snapshot) for snapshot in encoded])
+
+    def batch(self):
+        return CassetteBatch(self)
+
+    def call(self, operation, request, function, decode=None):
+        # Recordings are the encoded results, so the replayed and the recorded results are made alike
+        result = self.cassette.call("firestore", self.name + "." + operation, request, function)
+        return decode(result) if decode else result
+
+    async def call_async(self, operation, request, function, decode=None):
+        result = await self.cassette.call_async("firestore", self.name + "." + operation, request, function)
+        return decode(result) if decode else result
+
+# 3D model API
+
+def encode_http_response(status, headers, body):
+    return {"status": status, "headers": dict(headers), "body": encode_bytes(body)}
+
+def cassette_adapter(cassette, **kwargs):
+    from requests.adapters import HTTPAdapter
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+
+    class CassetteAdapter(HTTPAdapter):
+        def send(self, request, **send_kwargs):
+            def send_live():
+                response = HTTPAdapter.send(self, request, **send_kwargs)
+                return encode_http_response(response.status_code, response.headers, response.content)
+
+            encoded = cassette.call("http", request.method, {"url": request.url}, send_live)
+
+            response = Response()
+            response.status_code = encoded["status"]
+            response.headers = CaseInsensitiveDict(encoded["headers"])
+            # The body was read whole, it can't be decoded again
+            response.headers.pop("Content-Encoding", None)
+            response.url = request.url
+            response.request = request
+            response.encoding = "utf-8"
+            response._content = decode_bytes(encoded["body"])
+            response._content_consumed = True
+            return response
+
+    return CassetteAdapter(**kwargs)
+
+def cassette_transport(cassette, transport):
+    import httpx
+
+    class CassetteTransport(httpx.AsyncBaseTransport):
+        async def handle_async_request(self, request):
+            async def send_live():
+                response = await transport.handle_async_request(request)
+                body = await response.aread()
+                await response.aclose()
+                return encode_http_response(response.status_code, response.headers, body)
+
+            encoded = await cassette.call_async("http", request.method, {"url": str(request.url)}, send_live)
+
+            headers = {name: value for name, value in encoded["headers"].items() if name.lower() not in ("content-encoding", "transfer-encoding")}
+            return httpx.Response(encoded["status"], headers=headers, content=decode_bytes(encoded["body"]), request=request)
+
+        async def aclose(self):
+            if transport is not None:
+                await transport.aclose()
+
+    return CassetteTransport()
@@ -0,0 +1,213 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+def estimate_tokens(content):
+    # Roughly 4 characters per token, counting function calls and responses with their arguments
+    try:
+        return len(json.dumps(content.to_dict(), default=str)) // 4 + 1
+    except Exception:
+        return len(repr(content)) // 4 + 1
+
+def is_user_prompt(content):
+    # A turn typed by the user, as opposed to the function responses sent back to the model
+    if content.role != "user":
+        return False
+
+    raw_parts = content._raw_content.parts
+    return any(part.text for part in raw_parts) and not any(part.function_response.name for part in raw_parts)
+
+def transcript(history):
+    lines = []
+    for content in history:
+        speaker = "User" if content.role == "user" else "Assistant"
+        for part in content._raw_content.parts:
+            if part.text:
+                lines.append("%s: %s" % (speaker, part.text))
+            elif part.function_call.name:
+                lines.append("Assistant called %s(%s)" % (part.function_call.name, json.dumps(dict(part.function_call.args.items()), default=str)))
+            elif part.function_response.name:
+                lines.append("%s returned %s" % (part.function_response.name, json.dumps(dict(part.function_response.response.items()), default=str)))
+    return "\n".join(lines)
+
+class PendingSummary:
+    def __init__(self, prefix, turns, saved_tokens):
+        self.prefix = prefix
+        self.turns = turns
+        self.saved_tokens = saved_tokens
+
+class HistoryCompactor:
+    """
+    Keeps the history sent with every chat turn within a token budget.
+
+    Once a history is over token_budget, the turns older than the most recent
+    keep_recent_tokens are summarized by summary_model on a background thread. At the start
+    of the next turn, while the turn lock is held, those turns are replaced with the summary,
+    unless the history changed in the meantime. Histories are only split in front of a user
+    prompt, so function calls always stay together with their responses. A previous summary
+    is part of the older turns and gets folded into the new one.
+    """
+
+    def __init__(self, summary_model, instruction, token_budget=8000, keep_recent_tokens=3000,
+                 workers=2, count_tokens=estimate_tokens, limiter=None):
+        self.summary_model = summary_model
+        self.limiter = limiter
+        self.instruction = instruction
+        self.token_budget = token_budget
+        self.keep_recent_tokens = keep_recent_tokens
+        self.count_tokens = count_tokens
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-compaction")
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.running = set()
+        self.saved = {}
+        self.stats = {
+            "turns": 0,
+            "history_tokens_sent": 0,
+            "tokens_saved": 0,
+            "compactions": 0,
+            "compactions_discarded": 0,
+            "summaries_failed": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service, summary_model, limiter=None):
+        return cls(
+            summary_model,
+            config_service.get_property('compaction', 'summary_instruction'),
+            token_budget=int(config_service.get_property('compaction', 'token_budget')),
+            keep_recent_tokens=int(config_service.get_property('compaction', 'keep_recent_tokens')),
+            workers=int(config_service.get_property('compaction', 'workers')),
+            limiter=limiter,
+        )
+
+    def apply(self, user_id, history):
+        """
+        Swaps in a finished summary and reports the tokens the turn about to start saves.
+
+        Must be called with the user's turn lock held. Returns True when history was compacted.
+        """
+        with self.lock:
+            summary = self.pending.pop(user_id, None)
+
+        compacted = False
+        if summary is not None:
+            prefix = summary.prefix
+            if len(history) >= len(prefix) and all(a is b for a, b in zip(history, prefix)):
+                history[:len(prefix)] = summary.turns
+                compacted = True
+            else:
+                # The session was rebuilt or reset while summarizing
+                with self.lock:
+                    self.stats["compactions_discarded"] += 1
+
+        history_tokens = sum(self.count_tokens(content) for content in history)
+
+        with self.lock:
+            if compacted:
+                self.saved[user_id] = self.saved.get(user_id, 0) + summary.saved_tokens
+                self.stats["compactions"] += 1
+
+            saved_tokens = self.saved.get(user_id, 0)
+            self.stats["turns"] += 1
+            self.stats["history_tokens_sent"] += history_tokens
+            self.stats["tokens_saved"] += saved_tokens
+
+        logging.info("Turn of user %s sends %d history tokens, compaction saves %d", user_id, history_tokens, saved_tokens)
+        return compacted
+
+    def schedule(self, user_id, history):
+        """
+        Starts summarizing the older turns in the background if history is over the budget.
+        """
+        tokens = [self.count_tokens(content) for content in history]
+        if sum(tokens) <= self.token_budget:
+            return
+
+        split = self.split_index(history, tokens)
+        # Folding the previous summary pair alone would not save anything
+        if split <= 2:
+            return
+
+        with self.lock:
+            if user_id in self.running:
+                return
+            self.running.add(user_id)
+
+        prefix = list(history[:split])
+        self.executor.submit(self._summarize, user_id, prefix, sum(tokens[:split]))
+
+    def split_index(self, history, tokens):
+        # The recent turns within keep_recent_tokens are kept, starting at a user prompt
+        split = None
+        kept = 0
+        for index in range(len(history) - 1, -1, -1):
+            kept += tokens[index]
+            if is_user_prompt(history[index]):
+                if kept > self.keep_recent_tokens and split is not None:
+                    break
+                split = index
+
+        return split or 0
+
+    def forget(self, user_id):
+        with self.lock:
+            self.pending.pop(user_id, None)
+            self.saved.pop(user_id, None)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                pending=len(self.pending),
+                running=len(self.running),
+            )
+
+    def _summarize(self, user_id, prefix, prefix_tokens):
+        from vertexai.preview.generative_models import Content, Part
+
+        try:
+            prompt = self.instruction + "\n\n" + transcript(prefix)
+            if self.limiter is not None:
+                response = self.limiter.call(self.summary_model.generate_content, prompt)
+            else:
+                response = self.summary_model.generate_content(prompt)
+            summary = response.text.strip()
+
+            turns = [
+                Content(role="user", parts=[Part.from_text("Summary of our conversation so far: " + summary)]),
+                Content(role="model", parts=[Part.from_text("Thanks, I'll keep that in mind.")]),
+            ]
+            saved_tokens = prefix_tokens - sum(self.count_tokens(content) for content in turns)
+
+            with self.lock:
+                if saved_tokens > 0:
+                    self.pending[user_id] = PendingSummary(prefix, turns, saved_tokens)
+
+            logging.debug("Summarized %d turns of user %s, saving %d tokens", len(prefix), user_id, saved_tokens)
+
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            with self.lock:
+                self.stats["summaries_failed"] += 1
+
+        finally:
+            with self.lock:
+                self.running.discard(user_id)
@@ -12,38 +12,102 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
+from common import tracing
 
 def call_function(service, function_name, params):
-    try:
-        return getattr(service, function_name)(**params)
-    except Exception as e:
-        logging.error("Cannot invoke the function dynamically. Exception: " + e)
-        return 'Unable to retrieve data from external source'
+    with tracing.span("call_function", function=function_name) as span:
+        try:
+            return getattr(service, function_name)(**params)
+        except Exception as e:
+            logging.error("Cannot invoke the function dynamically. Exception: %s", e)
+            span.set_outcome("error")
+            return 'Unable to retrieve data from external source'
 
-def extract_function(response):
-    try:
-        for part in response.candidates[0].content.parts: 
-            if part.function_call.name:
-                return part.function_call.name
-    except AttributeError as e:
-        return None
-    except Exception as e:
-        logging.error("Cannot extract function name from gemini response. Exception: " + e)
+def normalize_function_result(result):
+    # Functions return (response for the model, html for the user), error paths sometimes only the response
+    if isinstance(result, tuple):
+        return result
+    return str(result), ''
+
+def group_calls(service, calls):
+    """
+    Splits the (name, params) calls into groups of call indexes that run one after the other.
+
+    Calls to the same function are a group, since they act on the same data (e.g. two color
+    changes). So are all the calls to the service's ORDERED_FUNCTIONS, which depend on each
+    other's writes (e.g. a new avatar and the 3D model made from it).
+    """
+    ordered = getattr(service, "ORDERED_FUNCTIONS", frozenset())
+    groups = {}
+    for index, (function_name, _) in enumerate(calls):
+        key = None if function_name in ordered else function_name
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+def call_functions(service, calls, executor):
+    """
+    Runs the (name, params) calls of one model response on executor, the groups of
+    group_calls concurrently. Returns one (function_response, html_response) per call.
+    """
+    groups = group_calls(service, calls)
+
+    results = [None] * len(calls)
+
+    def run(indexes):
+        for index in indexes:
+            function_name, params = calls[index]
+            results[index] = normalize_function_result(call_function(service, function_name, params))
+
+    if len(groups) == 1:
+        run(groups[0])
+    else:
+        for future in [executor.submit(tracing.in_context(run), indexes) for indexes in groups]:
+            future.result()
+
+    return results
+
+async def call_function_async(service, function_name, params):
+    with tracing.span("call_function", function=function_name) as span:
+        try:
+            return await getattr(service, function_name)(**params)
+        except Exception as e:
+            logging.error("Cannot invoke the function dynamically. Exception: %s", e)
+            span.set_outcome("error")
+            return 'Unable to retrieve data from external source'
+
+async def call_functions_async(service, calls):
+    """
+    Async counterpart of call_functions for services whose functions are coroutines.
+    """
+    groups = group_calls(service, calls)
+
+    results = [None] * len(calls)
+
+    async def run(indexes):
+        for index in indexes:
+            function_name, params = calls[index]
+            results[index] = normalize_function_result(await call_function_async(service, function_name, params))
+
+    await asyncio.gather(*(run(indexes) for indexes in groups))
 
-def extract_params(response):
-    params = {}
+    return results
+
+def extract_function_calls(response):
+    # Every function call of the response as (name, params), in order
+    calls = []
 
     try:
-        for part in response.candidates[0].content.parts: 
-            for field in part.function_call.args.items():
-                params[field[0]] = field[1]
-    except AttributeError as e:
-        return params
+        for part in response.candidates[0].content.parts:
+            if part.function_call.name:
+                calls.append((part.function_call.name, dict(part.function_call.args.items())))
+    except (AttributeError, IndexError) as e:
+        return calls
     except Exception as e:
-        logging.error("Cannot extract function parameters name from gemini response. Exception: %e" + e)
+        logging.error("Cannot extract function calls from gemini response. Exception: %s", e)
 
-    return params
+    return calls
 
 def extract_text(response):
     try:
@@ -60,13 +124,63 @@ def extract_text(response):
     
     return ""
     
+# Sometimes gemini produces empty paragraphs as well as markdown in html outputs
+HTML_CLEANUP_REPLACEMENTS = [
+    ('<p></p>', ''),
+    ('```html', ''),
+    ('```', ''),
+    ('\\"', '"'),
+]
+
+def clean_gemini_html(response):
+    for pattern, replacement in HTML_CLEANUP_REPLACEMENTS:
+        response = response.replace(pattern, replacement)
+
+    return response
+
 def gemini_response_to_template_html(response):
-    # Sometimes gemini produces empty paragraphs as well as markdown in html outputs
-    response = response.replace('<p></p>', '') 
-    response = response.replace('```html', '')
-    response = response.replace('```', '')
-    response = response.replace('\\"', '"')
-    
     return """
-        <div class="msg">""" + response + """</div>
-    """    
\ No newline at end of file
+        <div class="msg">""" + clean_gemini_html(response) + """</div>
+    """
+
+class StreamCleaner:
+    """
+    Applies the same cleanup as clean_gemini_html to a response that arrives in chunks.
+
+    A pattern can be split across two chunks (e.g. "``" + "`html"), so the tail of the
+    buffer that could still become a pattern is held back until the next chunk arrives.
+    """
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, chunk):
+        self.pending += chunk
+
+        hold = self._partial_pattern_length(self.pending)
+        ready = self.pending[:len(self.pending) - hold]
+        self.pending = self.pending[len(self.pending) - hold:]
+
+        return clean_gemini_html(ready)
+
+    def flush(self):
+        ready = clean_gemini_html(self.pending)
+        self.pending = ''
+
+        return ready
+
+    @staticmethod
+    def _partial_pattern_length(text):
+        longest = 0
+        for pattern, _ in HTML_CLEANUP_REPLACEMENTS:
+            for size in range(min(len(pattern) - 1, len(text)), longest, -1):
+                if text.endswith(pattern[:size]):
+                    longest = size
+                    break
+
+        return longest
+
+def sse_event(event, data):
+    # Every line of a multi-line payload needs its own "data:" prefix
+    lines = data.split('\n')
+    return 'event: ' + event + '\n' + ''.join('data: ' + line + '\n' for line in lines) + '\n'
@@ -0,0 +1,210 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from common import tracing
+
+class Hedger:
+    """
+    Sends a duplicate of a slow request and returns whichever response arrives first.
+
+    A call gets its duplicate (the hedge) when it has not completed after the given
+    percentile of the recent latencies. Hedges are capped at max_extra_ratio of the calls.
+    The functions hedged must not have side effects: chat turns are sent with
+    generate_content and only the winning response is appended to the history.
+
+    Every call runs on a thread of its own while the caller waits for it or its hedge, so
+    calls in flight are not capped by a pool and the hedge delay starts when the call does.
+    Hedges run on a pool of workers threads, a hedge is skipped when they are all busy.
+    """
+
+    def __init__(self, percentile=95, initial_delay=5, min_delay=0.5, min_samples=20,
+                 window=500, max_extra_ratio=0.05, workers=32):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_extra_ratio = max_extra_ratio
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedging")
+        self.running_hedges = 0
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.stats = {
+            "calls": 0,
+            "hedges_fired": 0,
+            "hedges_won": 0,
+            "hedges_skipped_budget": 0,
+            "hedges_skipped_busy": 0,
+            "failures_rescued": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            percentile=float(config_service.get_property('hedging', 'percentile')),
+            initial_delay=float(config_service.get_property('hedging', 'initial_delay_seconds')),
+            min_delay=float(config_service.get_property('hedging', 'min_delay_seconds')),
+            min_samples=int(config_service.get_property('hedging', 'min_samples')),
+            max_extra_ratio=float(config_service.get_property('hedging', 'max_extra_percent')) / 100,
+            workers=int(config_service.get_property('hedging', 'workers')),
+        )
+
+    def hedge_delay(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_delay
+
+            ordered = sorted(self.latencies)
+
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return max(ordered[index], self.min_delay)
+
+    def call(self, function, *args, **kwargs):
+        delay = self._start_call()
+        primary = self._start_primary(function, args, kwargs)
+
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget(pooled=True):
+            return primary.result()
+
+        hedge = self.executor.submit(tracing.in_context(self._timed), function, args, kwargs)
+        hedge.add_done_callback(self._hedge_done)
+        # The loser keeps running in the background, a thread cannot be cancelled
+        return self._first_result([primary, hedge], lambda pending: wait(pending, return_when=FIRST_COMPLETED)[0])
+
+    async def call_async(self, function, *args, **kwargs):
+        delay = self._start_call()
+        primary = asyncio.ensure_future(self._timed_async(function, args, kwargs))
+        hedge = None
+
+        # Whatever is still running when the caller returns or is cancelled is cancelled too
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done or not self._take_budget():
+                return await primary
+
+            hedge = asyncio.ensure_future(self._timed_async(function, args, kwargs))
+            return await self._first_result_async([primary, hedge])
+        finally:
+            primary.cancel()
+            if hedge is not None:
+                hedge.cancel()
+
+    def get_stats(self):
+        delay = self.hedge_delay()
+        with self.lock:
+            return dict(
+                self.stats,
+                hedge_delay_seconds=delay,
+                extra_request_ratio=self.stats["hedges_fired"] / self.stats["calls"] if self.stats["calls"] else 0.0,
+            )
+
+    def _start_call(self):
+        with self.lock:
+            self.stats["calls"] += 1
+        return self.hedge_delay()
+
+    def _take_budget(self, pooled=False):
+        # Pooled hedges also need an idle worker, they would be late if they had to queue
+        with self.lock:
+            if self.stats["hedges_fired"] + 1 > self.max_extra_ratio * self.stats["calls"]:
+                self.stats["hedges_skipped_budget"] += 1
+                return False
+            if pooled and self.running_hedges >= self.workers:
+                self.stats["hedges_skipped_busy"] += 1
+                return False
+
+            self.stats["hedges_fired"] += 1
+            if pooled:
+                self.running_hedges += 1
+            return True
+
+    def _hedge_done(self, future):
+        with self.lock:
+            self.running_hedges -= 1
+
+    def _start_primary(self, function, args, kwargs):
+        primary = Future()
+        primary.set_running_or_notify_cancel()
+
+        def run():
+            try:
+                primary.set_result(self._timed(function, args, kwargs))
+            except BaseException as e:
+                primary.set_exception(e)
+
+        threading.Thread(target=tracing.in_context(run), name="hedging-call", daemon=True).start()
+        return primary
+
+    def _record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def _timed(self, function, args, kwargs):
+        started = time.monotonic()
+        result = function(*args, **kwargs)
+        self._record(time.monotonic() - started)
+        return result
+
+    async def _timed_async(self, function, args, kwargs):
+        started = time.monotonic()
+        result = await function(*args, **kwargs)
+        self._record(time.monotonic() - started)
+        return result
+
+    def _first_result(self, futures, wait_first):
+        # The first successful response wins, an error only counts once both requests failed
+        pending = set(futures)
+        error = None
+        while pending:
+            for future in wait_first(pending):
+                pending.discard(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                self._record_winner(future is futures[1], error is not None)
+                return future.result()
+
+        raise error
+
+    async def _first_result_async(self, tasks):
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                self._record_winner(task is tasks[1], error is not None)
+                return task.result()
+
+        raise error
+
+    def _record_winner(self, hedge_won, rescued):
+        with self.lock:
+            if hedge_won:
+                self.stats["hedges_won"] += 1
+            if rescued:
+                self.stats["failures_rescued"] += 1
+
+        if hedge_won:
+            logging.debug("Hedged request won")
@@ -0,0 +1,395 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import socket
+import sqlite3
+import threading
+
+# Conversation history persistence. Every turn (a vertexai Content) is stored as one record
+# holding its serialized protobuf, so saving a turn only appends the new records.
+
+class ContentCodec:
+    def encode(self, content):
+        raw = content._raw_content
+        return type(raw).serialize(raw)
+
+    def decode(self, record):
+        from vertexai.generative_models._generative_models import Content, gapic_content_types
+        return Content._from_gapic(gapic_content_types.Content.deserialize(record))
+
+class HistoryBackend:
+    # Shared backends can be read by other workers/instances, local ones die with the process
+    shared = False
+
+    def append(self, user_id, records):
+        raise NotImplementedError()
+
+    def replace(self, user_id, records):
+        raise NotImplementedError()
+
+    def load(self, user_id):
+        raise NotImplementedError()
+
+    def length(self, user_id):
+        raise NotImplementedError()
+
+    def clear(self, user_id):
+        raise NotImplementedError()
+
+class InMemoryHistoryBackend(HistoryBackend):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+
+    def append(self, user_id, records):
+        with self.lock:
+            self.records.setdefault(user_id, []).extend(records)
+
+    def replace(self, user_id, records):
+        with self.lock:
+            self.records[user_id] = list(records)
+
+    def load(self, user_id):
+        with self.lock:
+            return list(self.records.get(user_id, []))
+
+    def length(self, user_id):
+        with self.lock:
+            return len(self.records.get(user_id, []))
+
+    def clear(self, user_id):
+        with self.lock:
+            self.records.pop(user_id, None)
+
+class SQLiteHistoryBackend(HistoryBackend):
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS history (
+                    user_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    record BLOB NOT NULL,
+                    PRIMARY KEY (user_id, seq)
+                ) WITHOUT ROWID''')
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def append(self, user_id, records):
+        with self._connection() as connection:
+            # Takes the write lock before reading the last seq, so concurrent appends of
+            # another worker wait instead of reusing it
+            connection.execute("BEGIN IMMEDIATE")
+            start = connection.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM history WHERE user_id = ?", (user_id,)).fetchone()[0]
+            connection.executemany(
+                "INSERT INTO history (user_id, seq, record) VALUES (?, ?, ?)",
+                [(user_id, start + i, record) for i, record in enumerate(records)])
+
+    def replace(self, user_id, records):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            connection.executemany(
+                "INSERT INTO history (user_id, seq, record) VALUES (?, ?, ?)",
+                [(user_id, i, record) for i, record in enumerate(records)])
+
+    def load(self, user_id):
+        rows = self._connection().execute(
+            "SELECT record FROM history WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def length(self, user_id):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def clear(self, user_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+
+class RespError(Exception):
+    pass
+
+class RespConnection:
+    """
+    Minimal client for the Redis serialization protocol (RESP2).
+
+    Works against Redis, Memorystore or any local stand-in that speaks the protocol.
+    """
+
+    # Commands that can be sent again when their reply was lost
+    IDEMPOTENT = {"AUTH", "DEL", "EXPIRE", "GET", "LLEN", "LRANGE", "PING", "SELECT"}
+
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        self.sent = False
+
+    def execute(self, *args):
+        return self.pipeline([args], idempotent=str(args[0]).upper() in self.IDEMPOTENT)[0]
+
+    def pipeline(self, commands, idempotent=False):
+        """
+        Sends the commands in one write and returns their replies.
+
+        A batch whose reply was lost (e.g. a read timeout) may have been applied by the server,
+        it is only sent again when idempotent, e.g. reads or a MULTI/EXEC rewriting a key.
+        Otherwise the connection is closed and the error raised.
+        """
+        with self.lock:
+            self.sent = False
+            try:
+                return self._pipeline(commands)
+            except (OSError, EOFError):
+                self.close()
+                if self.sent and not idempotent:
+                    raise
+                return self._pipeline(commands)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    def _pipeline(self, commands):
+        # Connections the server closed while idle are replaced before anything is sent on them
+        if self.sock is not None and self._is_closed():
+            self.close()
+        if self.sock is None:
+            self._connect()
+
+        self.sent = True
+        return self._send(commands)
+
+    def _send(self, commands):
+        self.sock.sendall(b''.join(self._encode(command) for command in commands))
+        replies = [self._read_reply() for _ in commands]
+
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        try:
+            if setup:
+                self._send(setup)
+        except BaseException:
+            # Not left for the next command to use unauthenticated or on the wrong db
+            self.close()
+            raise
+
+    def _is_closed(self):
+        # Nothing is readable between two commands, unless the server closed the connection
+        try:
+            self.sock.settimeout(0)
+            try:
+                self.sock.recv(1, socket.MSG_PEEK)
+                return True
+            except BlockingIOError:
+                return False
+            finally:
+                self.sock.settimeout(self.timeout)
+        except OSError:
+            return True
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            elif isinstance(arg, int):
+                arg = str(arg).encode('ascii')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError("Connection closed by RESP server")
+
+        prefix, payload = line[:1], line[1:-2]
+
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            return RespError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2]
+        if prefix == b'*':
+            size = int(payload)
+            if size < 0:
+                return None
+            return [self._read_reply() for _ in range(size)]
+
+        raise RespError("Unknown RESP reply: %r" % line)
+
+class RedisHistoryBackend(HistoryBackend):
+    shared = True
+
+    def __init__(self, connection, key_prefix="history:", ttl_seconds=0):
+        self.connection = connection
+        self.key_prefix = key_prefix
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, user_id):
+        return self.key_prefix + str(user_id)
+
+    def _expire(self, key):
+        return [("EXPIRE", key, self.ttl_seconds)] if self.ttl_seconds else []
+
+    def append(self, user_id, records):
+        key = self._key(user_id)
+        self.connection.pipeline([("RPUSH", key, *records)] + self._expire(key))
+
+    def replace(self, user_id, records):
+        key = self._key(user_id)
+        commands = [("MULTI",), ("DEL", key)]
+        if records:
+            commands.append(("RPUSH", key, *records))
+        commands += self._expire(key) + [("EXEC",)]
+        self.connection.pipeline(commands, idempotent=True)
+
+    def load(self, user_id):
+        return self.connection.execute("LRANGE", self._key(user_id), 0, -1) or []
+
+    def length(self, user_id):
+        return self.connection.execute("LLEN", self._key(user_id))
+
+    def clear(self, user_id):
+        self.connection.execute("DEL", self._key(user_id))
+
+class HistoryStore:
+    """
+    Loads and saves chat histories through a HistoryBackend.
+
+    The store remembers how many turns of each history are already persisted, so a save
+    only appends the new turns. A history that got shorter is rewritten.
+    """
+
+    def __init__(self, backend, codec=None):
+        self.backend = backend
+        self.codec = codec or ContentCodec()
+        self.lock = threading.Lock()
+        self.persisted = {}
+
+    @classmethod
+    def from_config(cls, config_service):
+        backend = config_service.get_property('history', 'backend')
+
+        if backend == "memory":
+            return cls(InMemoryHistoryBackend())
+        if backend == "sqlite":
+            return cls(SQLiteHistoryBackend(config_service.get_property('history', 'sqlite_path')))
+        if backend == "redis":
+            connection = RespConnection(
+                config_service.get_property('history', 'redis_host'),
+                int(config_service.get_property('history', 'redis_port')),
+                password=config_service.get_property('history', 'redis_password') or None,
+                db=int(config_service.get_property('history', 'redis_db')),
+            )
+            return cls(RedisHistoryBackend(
+                connection,
+                ttl_seconds=int(config_service.get_property('history', 'ttl_seconds')),
+            ))
+
+        raise Exception('Unknown history backend: ' + backend)
+
+    def load(self, user_id):
+        history = [self.codec.decode(record) for record in self.backend.load(user_id)]
+
+        with self.lock:
+            self.persisted[user_id] = len(history)
+
+        logging.debug("Loaded %d turns of history for user %s", len(history), user_id)
+        return history
+
+    def save(self, user_id, history):
+        with self.lock:
+            persisted = self.persisted.get(user_id)
+
+        if persisted is None:
+            persisted = self.backend.length(user_id)
+
+        try:
+            if len(history) >= persisted:
+                new_turns = history[persisted:]
+                if new_turns:
+                    self.backend.append(user_id, [self.codec.encode(content) for content in new_turns])
+            else:
+                self.backend.replace(user_id, [self.codec.encode(content) for content in history])
+        except Exception:
+            # A failed append may still have been applied, the next save reads the length again
+            with self.lock:
+                self.persisted.pop(user_id, None)
+            raise
+
+        with self.lock:
+            self.persisted[user_id] = len(history)
+
+    def replace(self, user_id, history):
+        # For histories rewritten in place (e.g. compacted), save() would only append
+        self.backend.replace(user_id, [self.codec.encode(content) for content in history])
+
+        with self.lock:
+            self.persisted[user_id] = len(history)
+
+    def length(self, user_id):
+        return self.backend.length(user_id)
+
+    def evict(self, user_id):
+        # Called when the session store drops a user, local backends would otherwise keep the history forever
+        with self.lock:
+            self.persisted.pop(user_id, None)
+
+        if not self.backend.shared:
+            self.backend.clear(user_id)
@@ -0,0 +1,51 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Image post-processing run in worker processes. This module is imported by every worker,
+# so it only depends on Pillow and must stay free of the heavy Google Cloud imports.
+
+import io
+
+def resized_webp(image, size, quality):
+    from PIL import Image
+
+    copy = image.copy()
+    # Keeps the aspect ratio, images are only ever scaled down
+    copy.thumbnail((size, size), Image.LANCZOS)
+
+    output = io.BytesIO()
+    copy.save(output, format="WEBP", quality=quality, method=6)
+    return output.getvalue()
+
+def process_avatar(image_bytes, size=512, thumbnail_size=128, quality=85):
+    """
+    Turns a generated image into the files of an avatar.
+
+    Returns:
+        (png, webp, thumbnail): the original PNG, the WebP shown in the chat and a small WebP thumbnail.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        is_png = source.format == "PNG"
+        image = source.convert("RGB")
+
+    # The 3D model API gets a PNG, whatever format the image was generated in
+    png = image_bytes
+    if not is_png:
+        output = io.BytesIO()
+        image.save(output, format="PNG", optimize=True)
+        png = output.getvalue()
+
+    return png, resized_webp(image, size, quality), resized_webp(image, thumbnail_size, quality)
@@ -0,0 +1,123 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import threading
+
+# Words that carry no intent and are ignored when scoring a prompt
+STOPWORDS = {
+    "a", "an", "the", "me", "my", "please", "can", "could", "would", "you", "i", "to", "of",
+    "now", "current", "currently", "again", "just", "pls", "plz", "for", "let", "see", "us",
+}
+
+# Maps words users commonly say to the words found in the function names
+SYNONYMS = {
+    "display": "show", "open": "show", "view": "show", "reveal": "show",
+    "character": "model", "char": "model", "3d": "model",
+    "picture": "avatar", "pic": "avatar", "image": "avatar", "photo": "avatar", "profile": "avatar",
+}
+
+def tokenize(text):
+    words = re.findall(r"\w+", text.lower())
+    return [SYNONYMS.get(word, word) for word in words if word not in STOPWORDS]
+
+class IntentRouter:
+    """
+    Dispatches trivial commands ("show my avatar") without asking Gemini which function to call.
+
+    Only functions without required parameters can be routed. A prompt matches a function
+    when the words of the function name cover the prompt: confidence is the share of the name
+    words found in the prompt times the share of the prompt words that belong to the name, so
+    "show my avatar" is certain while "show my avatar wearing a hat" falls back to the model.
+    """
+
+    def __init__(self, declarations, allowed_functions, replies, threshold=0.75):
+        self.threshold = threshold
+        self.replies = replies
+        self.signatures = {}
+
+        for declaration in declarations:
+            declaration = declaration.to_dict()
+            name = declaration["name"]
+            required = declaration.get("parameters", {}).get("required", [])
+
+            if name in allowed_functions and not required:
+                # fc_show_my_avatar -> {"show", "avatar"}
+                self.signatures[name] = set(tokenize(name.replace("_", " "))) - {"fc"}
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "routed": 0,
+            "fallbacks": 0,
+            "llm_calls_avoided": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service, declarations):
+        allowed_functions = config_service.get_property('intent_router', 'functions').split('|')
+        replies = {name: config_service.get_property('intent_router', 'reply') for name in allowed_functions}
+
+        return cls(
+            declarations,
+            allowed_functions,
+            replies,
+            threshold=float(config_service.get_property('intent_router', 'confidence_threshold')),
+        )
+
+    def route(self, prompt):
+        """
+        Returns (function_name, confidence) for a high-confidence match, otherwise None.
+        """
+        words = set(tokenize(prompt))
+        best_name, best_confidence = None, 0.0
+
+        if words:
+            for name, signature in self.signatures.items():
+                matched = len(words & signature)
+                confidence = (matched / len(signature)) * (matched / len(words))
+
+                if confidence > best_confidence:
+                    best_name, best_confidence = name, confidence
+
+        with self.lock:
+            if best_confidence < self.threshold:
+                self.stats["fallbacks"] += 1
+                return None
+
+            self.stats["routed"] += 1
+            # The turn that picks the function and the one that turns its result into text
+            self.stats["llm_calls_avoided"] += 2
+
+        return best_name, best_confidence
+
+    def reply_for(self, function_name):
+        return self.replies.get(function_name, "There you go.")
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    @staticmethod
+    def history_turns(prompt, function_name, function_response, reply):
+        """
+        The four turns the model would have produced, so the chat history stays consistent.
+        """
+        from vertexai.preview.generative_models import Content, Part
+
+        return [
+            Content(role="user", parts=[Part.from_text(prompt)]),
+            Content(role="model", parts=[Part.from_dict({"function_call": {"name": function_name, "args": {}}})]),
+            Content(role="user", parts=[Part.from_function_response(name=function_name, response={"content": function_response})]),
+            Content(role="model", parts=[Part.from_text(reply)]),
+        ]
@@ -0,0 +1,233 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import tracing
+
+class Job:
+    PENDING = ("queued", "processing")
+
+    def __init__(self, job_id, check_url, on_finished, delay, kind="3d_model"):
+        self.job_id = job_id
+        self.kind = kind
+        self.check_url = check_url
+        self.on_finished = on_finished
+        self.status = "queued"
+        self.message = None
+        self.result = None
+        self.attempts = 0
+        self.delay = delay
+        self.created = time.monotonic()
+        self.next_poll = self.created + delay
+
+    def is_pending(self):
+        return self.status in Job.PENDING or self.status == "completing"
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "message": self.message,
+            "result": self.result,
+            "attempts": self.attempts,
+        }
+
+class JobScheduler:
+    """
+    Polls external jobs (e.g. the 3D model API) from a single scheduler thread.
+
+    Every job is polled with exponential backoff on a shared, pooled HTTP session. When a
+    job reports "finished", its on_finished(job, status_data) callback runs on a small worker
+    pool so slow downloads don't hold up the polling of other jobs. The callback returns
+    the message to show to the user, or raises to mark the job as failed.
+    """
+
+    def __init__(self, initial_delay=2, max_delay=30, backoff=2, timeout=600, pool_size=10, workers=4, retention=3600):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.retention = retention
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+        self.condition = threading.Condition()
+        self.queue = []
+        self.jobs = {}
+        self.thread = None
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            initial_delay=float(config_service.get_property('jobs', 'initial_poll_seconds')),
+            max_delay=float(config_service.get_property('jobs', 'max_poll_seconds')),
+            timeout=float(config_service.get_property('jobs', 'timeout_seconds')),
+            pool_size=int(config_service.get_property('jobs', 'http_pool_size')),
+            workers=int(config_service.get_property('jobs', 'workers')),
+        )
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name="job-scheduler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, job_id, check_url, on_finished):
+        job = Job(job_id, check_url, on_finished, self.initial_delay)
+
+        with self.condition:
+            self.jobs[job_id] = job
+            heapq.heappush(self.queue, (job.next_poll, job_id))
+            self.condition.notify()
+
+        logging.info(f"Scheduled polling of job {job_id}")
+        return job
+
+    def run(self, job_id, kind, function, executor=None):
+        """
+        Tracks local background work (e.g. generating an avatar) like the polled jobs.
+
+        function(job) runs on executor, by default the worker pool, and returns the job's
+        result. It raises to mark the job as failed, with the message of the exception.
+        """
+        job = Job(job_id, None, None, 0, kind=kind)
+        job.status = "processing"
+
+        # Local jobs never wake the scheduler thread, whether it runs or not they are forgotten here too
+        self._forget_old_jobs()
+
+        with self.condition:
+            self.jobs[job_id] = job
+
+        # The spans of the work, e.g. the Imagen call of an avatar, carry the request id of the turn
+        (executor or self.executor).submit(tracing.in_context(self._run_local), job, function)
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def get_stats(self):
+        with self.condition:
+            stats = {}
+            for job in self.jobs.values():
+                stats[job.status] = stats.get(job.status, 0) + 1
+            return stats
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # Woken at least every retention period to forget old jobs, also when none is polled
+                if not self.stopped and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.condition.wait(min(self.queue[0][0] - time.monotonic(), self.retention) if self.queue else self.retention)
+
+                if self.stopped:
+                    return
+
+                due = []
+                while self.queue and self.queue[0][0] <= time.monotonic():
+                    due.append(self.jobs[heapq.heappop(self.queue)[1]])
+
+            for job in due:
+                try:
+                    self._poll(job)
+                except Exception as e:
+                    logging.error("%s, %s", traceback.format_exc(), e)
+                    self._fail(job, "error", "There was an error checking the status of your 3D model.")
+
+            self._forget_old_jobs()
+
+    def _poll(self, job):
+        job.attempts += 1
+        logging.info(f"Checking job status for job {job.job_id}, attempt {job.attempts}")
+
+        status_response = self.session.get(job.check_url, timeout=30)
+
+        if status_response.status_code != 200:
+            logging.error(f"Error checking job status: {status_response.status_code, status_response.text}")
+            self._fail(job, "error", "There was an error checking the status of your 3D model.")
+            return
+
+        status_data = status_response.json()
+        status = status_data.get("status")
+
+        if status == "finished":
+            job.status = "completing"
+            self.executor.submit(self._complete, job, status_data)
+
+        elif status in Job.PENDING:
+            job.status = status
+
+            if time.monotonic() - job.created > self.timeout:
+                self._fail(job, "timeout", "The 3D model is taking too long to generate.")
+                return
+
+            job.delay = min(job.delay * self.backoff, self.max_delay)
+            job.next_poll = time.monotonic() + job.delay
+
+            with self.condition:
+                heapq.heappush(self.queue, (job.next_poll, job.job_id))
+
+        else:
+            logging.error(f"Unknown job status: {status_data}")
+            self._fail(job, "error", "There was an unexpected status while creating your 3D model.")
+
+    def _complete(self, job, status_data):
+        try:
+            job.message = job.on_finished(job, status_data)
+            job.status = "finished"
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            self._fail(job, "error", str(e))
+
+    def _run_local(self, job, function):
+        try:
+            job.result = function(job)
+            job.status = "finished"
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            self._fail(job, "error", str(e))
+
+    def _fail(self, job, status, message):
+        job.status = status
+        job.message = message
+
+    def _forget_old_jobs(self):
+        cutoff = time.monotonic() - self.retention
+
+        with self.condition:
+            for job_id in [job_id for job_id, job in self.jobs.items() if not job.is_pending() and job.created < cutoff]:
+                del self.jobs[job_id]
@@ -0,0 +1,270 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import numpy as np
+from . import config
+from .startup import retry_until_done
+
+# In-process alternative to the Vertex RAG corpus. Documents are chunked locally, their
+# embeddings are kept in a memory-mapped NumPy matrix and top-k retrieval is a single
+# matrix-vector product. Only the retrieved chunks are handed to the chat model.
+
+class HashingEmbedder:
+    """
+    Offline embedder hashing words and word pairs into a fixed size vector.
+
+    Needs no network or model, which makes the local RAG engine runnable in tests. It only
+    captures lexical overlap, use VertexEmbedder for real semantic search.
+    """
+
+    def __init__(self, dimensions=1024):
+        self.dimensions = dimensions
+        self.name = "hashing-%d" % dimensions
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                index = int.from_bytes(digest[:4], "little") % self.dimensions
+                vectors[row, index] += 1.0 if digest[4] & 1 else -1.0
+
+        return normalize(vectors)
+
+class VertexEmbedder:
+    def __init__(self, model_name, batch_size=100):
+        from vertexai.language_models import TextEmbeddingModel
+
+        self.model = TextEmbeddingModel.from_pretrained(model_name)
+        self.batch_size = batch_size
+        self.name = model_name
+
+    def embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings = self.model.get_embeddings(texts[start:start + self.batch_size])
+            vectors.extend(embedding.values for embedding in embeddings)
+
+        return normalize(np.asarray(vectors, dtype=np.float32))
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def create_embedder(config_service, section='rag', embedder_key='local_embedder', model_key='local_embedding_model'):
+    embedder = config_service.get_property(section, embedder_key)
+
+    if embedder == "hashing":
+        return HashingEmbedder()
+    if embedder == "vertex":
+        return VertexEmbedder(config_service.get_property(section, model_key))
+
+    raise Exception('Unknown local RAG embedder: ' + embedder)
+
+def read_document(path):
+    if path.lower().endswith(".pdf"):
+        from pypdf import PdfReader
+
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+    with open(path, mode='r', encoding='utf-8') as file:
+        return file.read()
+
+def chunk_text(text, chunk_size, chunk_overlap):
+    # Chunks are measured in words, roughly matching the token sizes used for the Vertex corpus
+    words = text.split()
+    step = max(chunk_size - chunk_overlap, 1)
+
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_size]))
+        if start + chunk_size >= len(words):
+            break
+
+    return chunks
+
+class LocalRAG:
+    """
+    Local retrieval engine with the same readiness interface as common.rag.RAG.
+
+    The index is stored in index_dir and only rebuilt when the documents, the embedder or
+    the chunking settings change. Every build is written to a directory of its own and
+    published by replacing the manifest naming it.
+    """
+
+    MANIFEST = "current.json"
+
+    def __init__(self, config_service: config.Config, embedder=None, background=True):
+        self.file_paths = config_service.get_property('rag', 'local_paths').split('|')
+        self.index_dir = config_service.get_property('rag', 'local_index_dir')
+        self.chunk_size = int(config_service.get_property('rag', 'local_chunk_size'))
+        self.chunk_overlap = int(config_service.get_property('rag', 'local_chunk_overlap'))
+        self.top_k = int(config_service.get_property('rag', 'local_top_k'))
+        self.min_score = float(config_service.get_property('rag', 'local_min_score'))
+        self.embedder = embedder or create_embedder(config_service)
+        self.retry_initial = float(config_service.get_property('rag', 'sync_retry_initial_seconds'))
+        self.retry_max = float(config_service.get_property('rag', 'sync_retry_max_seconds'))
+
+        self.ready = threading.Event()
+        self.version = None
+        self.matrix = None
+        self.chunks = []
+        self.load_failures = 0
+        self.last_error = None
+
+        if background:
+            threading.Thread(target=self._load_safely, name="local-rag-index", daemon=True).start()
+        else:
+            self.load()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def get_stats(self):
+        return {
+            "ready": self.is_ready(),
+            "chunks": len(self.chunks),
+            "load_failures": self.load_failures,
+            "last_error": self.last_error,
+        }
+
+    def _load_safely(self):
+        # E.g. embedding the chunks may fail for a while, is_ready() stays false meanwhile
+        retry_until_done(self.load, "Local RAG index", self.retry_initial, self.retry_max, self._load_failed)
+
+    def _load_failed(self, error):
+        self.load_failures += 1
+        self.last_error = str(error)
+
+    def load(self):
+        fingerprint = self._fingerprint()
+
+        # A worker may publish another build and delete this one before its files are opened,
+        # the manifest is then read again
+        for attempt in range(3):
+            manifest = self._read_manifest()
+            if manifest is None or manifest["fingerprint"] != fingerprint:
+                manifest = self._build(fingerprint)
+
+            directory = os.path.join(self.index_dir, manifest["directory"])
+            try:
+                with open(os.path.join(directory, "chunks.json"), mode='r') as file:
+                    chunks = json.load(file)
+                # Memory-mapped, so the pages are shared between workers and only loaded when touched
+                matrix = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode='r')
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+        self.chunks = chunks
+        self.matrix = matrix
+        self.version = fingerprint
+        self.last_error = None
+        self.ready.set()
+
+        logging.info("Local RAG index ready with %d chunks", len(self.chunks))
+
+    def _fingerprint(self):
+        digest = hashlib.sha256()
+        digest.update(("%s|%d|%d" % (self.embedder.name, self.chunk_size, self.chunk_overlap)).encode("utf-8"))
+
+        for path in self.file_paths:
+            digest.update(path.encode("utf-8"))
+            with open(path, mode='rb') as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+
+        return digest.hexdigest()
+
+    def _read_manifest(self):
+        # Names the directory of the current build, replaced in one step when a build is published
+        try:
+            with open(os.path.join(self.index_dir, self.MANIFEST), mode='r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _build(self, fingerprint):
+        chunks = []
+        for path in self.file_paths:
+            for text in chunk_text(read_document(path), self.chunk_size, self.chunk_overlap):
+                chunks.append({"source": os.path.basename(path), "text": text})
+
+        logging.info("Embedding %d chunks for the local RAG index", len(chunks))
+        matrix = self.embedder.embed([chunk["text"] for chunk in chunks])
+
+        # Every build gets a directory of its own, other workers never map a half-written index
+        # or the vectors of one build with the chunks of another
+        os.makedirs(self.index_dir, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix="index-", dir=self.index_dir)
+        np.save(os.path.join(directory, "embeddings.npy"), matrix.astype(np.float32))
+        with open(os.path.join(directory, "chunks.json"), mode='w') as file:
+            json.dump(chunks, file)
+
+        previous = self._read_manifest()
+        if previous is not None and previous["fingerprint"] == fingerprint:
+            # Another worker published the same index in the meantime
+            shutil.rmtree(directory, ignore_errors=True)
+            return previous
+
+        manifest = {"fingerprint": fingerprint, "directory": os.path.basename(directory)}
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.index_dir)
+        with os.fdopen(fd, mode='w') as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, os.path.join(self.index_dir, self.MANIFEST))
+
+        # Workers that mapped the previous build keep their pages until they load this one
+        if previous is not None and previous["directory"] != manifest["directory"]:
+            shutil.rmtree(os.path.join(self.index_dir, previous["directory"]), ignore_errors=True)
+
+        return manifest
+
+    def retrieve(self, question, top_k=None):
+        top_k = min(top_k or self.top_k, len(self.chunks))
+        if top_k == 0:
+            return []
+
+        query = self.embedder.embed([question])[0]
+        scores = self.matrix @ query
+
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+
+        return [
+            dict(self.chunks[index], score=float(scores[index]))
+            for index in best if scores[index] >= self.min_score
+        ]
+
+    def augment_prompt(self, question):
+        chunks = self.retrieve(question)
+        if not chunks:
+            return question
+
+        context = "\n\n".join("[%s] %s" % (chunk["source"], chunk["text"]) for chunk in chunks)
+        return (
+            "Answer the question using the following excerpts from our documents. "
+            "If they don't contain the answer, say that you don't know.\n\n"
+            "Excerpts:\n%s\n\nQuestion: %s" % (context, question)
+        )
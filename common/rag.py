@@ -12,54 +12,206 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import logging
+import os
+import threading
 from vertexai.preview import rag
 from . import config
+from .startup import retry_until_done
 
 class RAG:
-    files = []
+    """
+    Keeps a RagCorpus in sync with the configured file paths.
 
-    def __init__(self, config_service: config.Config):
-        corpora = rag.list_corpora()
-        corpus_name = config_service.get_property('rag', 'corpus_name')
-        file_paths = config_service.get_property('rag', 'paths').split('|')
+    In "incremental" sync mode the existing corpus is reused and a local manifest maps every
+    path to its content hash and RagFile, so only new or changed files are imported and files
+    no longer listed are deleted. Without a manifest, a RagFile created after its source was
+    last updated is reused. The sync runs in the background; is_ready() tells whether
+    the corpus can be queried, a failed sync is retried with backoff until it succeeds. The
+    "recreate" mode keeps the old delete-and-import behaviour.
+    """
 
-        rag_corpus = None
+    def __init__(self, config_service: config.Config, background=True):
+        self.corpus_name = config_service.get_property('rag', 'corpus_name')
+        self.file_paths = config_service.get_property('rag', 'paths').split('|')
+        self.sync_mode = config_service.get_property('rag', 'sync_mode')
+        self.manifest_path = config_service.get_property('rag', 'manifest_path')
+        self.retry_initial = float(config_service.get_property('rag', 'sync_retry_initial_seconds'))
+        self.retry_max = float(config_service.get_property('rag', 'sync_retry_max_seconds'))
 
-        for c in corpora:
-            if c.display_name == corpus_name:
-                rag.delete_corpus(c.name) # Comment this to stop re-creating RAG corpora every time
-                # rag_corpus = rag.get_corpus(c.name) # Uncomment this once you are happy with your setup
+        self.files = []
+        self.ready = threading.Event()
+        self.version = None
+        self.sync_failures = 0
+        self.last_error = None
 
+        rag_corpus = self._get_or_create_corpus()
+        self.name = rag_corpus.name
+
+        if background:
+            threading.Thread(target=self._sync_safely, name="rag-sync", daemon=True).start()
+        else:
+            self.sync()
+
+    def _get_or_create_corpus(self):
+        for c in rag.list_corpora():
+            if c.display_name == self.corpus_name:
+                if self.sync_mode == "recreate":
+                    rag.delete_corpus(c.name)
+                else:
+                    return c
+
+        rag_corpus = rag.create_corpus(display_name=self.corpus_name)
         if rag_corpus is None:
-            rag_corpus = rag.create_corpus(display_name=corpus_name)
-            if rag_corpus is None:
-                print("No corpus!")
-                raise Exception('Cannot load nor create new RagCorpus')
+            print("No corpus!")
+            raise Exception('Cannot load nor create new RagCorpus')
+
+        return rag_corpus
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def get_stats(self):
+        return {
+            "ready": self.is_ready(),
+            "files": len(self.files),
+            "sync_failures": self.sync_failures,
+            "last_error": self.last_error,
+        }
+
+    def _sync_safely(self):
+        # Transient errors (e.g. of list_files or import_files) are retried, is_ready() stays false meanwhile
+        retry_until_done(self.sync, "RAG corpus sync", self.retry_initial, self.retry_max, self._sync_failed)
+
+    def _sync_failed(self, error):
+        self.sync_failures += 1
+        self.last_error = str(error)
+
+    def sync(self):
+        manifest = self._load_manifest()
+        remote_files = {f.name: f for f in rag.list_files(corpus_name=self.name)}
+
+        # RagFiles deleted behind our back have to be imported again
+        entries = {path: entry for path, entry in manifest.items() if entry.get("rag_file") in remote_files}
+        imported_sources = self._sources_by_file(remote_files.values())
+
+        keep = {}
+        to_import = []
+        for path in self.file_paths:
+            blob = self._source_blob(path)
+            content_hash = (blob.md5_hash or blob.crc32c) if blob is not None else None
+            entry = entries.get(path)
+
+            if entry is None and path in imported_sources:
+                # Already in the corpus but unknown to this manifest (e.g. a fresh instance). The
+                # creation time of the RagFile is all that is known about what was imported, it is
+                # adopted unless the source changed since.
+                rag_file = remote_files[imported_sources[path]]
+                if blob is None or self._imported_since(rag_file, blob.updated):
+                    entry = {"hash": content_hash, "rag_file": rag_file.name}
+
+            if entry is None or (content_hash is not None and entry["hash"] != content_hash):
+                to_import.append((path, content_hash))
+            else:
+                keep[path] = entry
+
+        entries = keep
 
-            # Import Files to the RagCorpus
+        # New versions are imported before the old ones are deleted, so the corpus always has the document
+        if to_import:
+            logging.info("Importing %d RAG files into %s", len(to_import), self.name)
             rag.import_files(
-                rag_corpus.name,
-                file_paths,
+                self.name,
+                [path for path, _ in to_import],
                 chunk_size=512,  # Optional
                 chunk_overlap=100,  # Optional
             )
 
-        self.name = rag_corpus.name
+            current_files = list(rag.list_files(corpus_name=self.name))
+            new_sources = self._sources_by_file(f for f in current_files if f.name not in remote_files)
+            current_sources = self._sources_by_file(current_files)
+            for path, content_hash in to_import:
+                rag_file = new_sources.get(path) or current_sources.get(path)
+                if rag_file is not None:
+                    entries[path] = {"hash": content_hash, "rag_file": rag_file}
+                else:
+                    logging.warning("RAG file for %s not found after import", path)
+
+        # Replaced files and files that are no longer configured
+        kept_files = set(entry["rag_file"] for entry in entries.values())
+        stale = [name for name in remote_files if name not in kept_files]
+
+        for name in stale:
+            logging.info("Deleting RAG file %s", name)
+            rag.delete_file(name)
+
+        self._save_manifest(entries)
 
+        self.files = [entry["rag_file"].split('/')[-1] for entry in entries.values()]
+        self.version = json.dumps(sorted((path, entry["hash"]) for path, entry in entries.items()))
+        self.last_error = None
+        self.ready.set()
 
-        rag_files = list(rag.list_files(corpus_name=rag_corpus.name))
+        logging.info("RAG corpus %s is ready with %d files (%d imported, %d deleted)",
+                     self.name, len(self.files), len(to_import), len(stale))
+
+    @staticmethod
+    def _sources_by_file(rag_files):
+        sources = {}
         for f in rag_files:
-            self.files.append(f.name.split('/')[-1])
+            for uri in f.gcs_source.uris:
+                sources[uri] = f.name
+        return sources
+
+    @staticmethod
+    def _imported_since(rag_file, updated):
+        created = rag_file.create_time
+        return bool(created) and updated is not None and created >= updated
+
+    @staticmethod
+    def _source_blob(path):
+        # GCS keeps an MD5 (or CRC32C for composite objects) so nothing has to be downloaded
+        if path.startswith("gs://"):
+            from google.cloud import storage
+
+            bucket_name, _, blob_name = path[len("gs://"):].partition('/')
+            blob = storage.Client().bucket(bucket_name).get_blob(blob_name)
+            if blob is None:
+                raise Exception('RAG source file not found: ' + path)
+            return blob
+
+        return None
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path, mode='r') as file:
+            manifest = json.load(file)
+
+        if manifest.get("corpus") != self.name:
+            return {}
+
+        return manifest.get("files", {})
+
+    def _save_manifest(self, entries):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, mode='w') as file:
+            json.dump({"corpus": self.name, "files": entries}, file, indent=2)
+        os.replace(temp_path, self.manifest_path)
 
+    def augment_prompt(self, question):
+        # Retrieval happens inside the model call through the retrieval tool
+        return question
 
     def get_rag_retrieval(self) -> rag.Retrieval:
+        # The corpus only holds the configured files, so no rag_file_ids are needed while they sync
         return rag.Retrieval(
             source=rag.VertexRagStore(
                 rag_resources=[
                     rag.RagResource(
                         rag_corpus=self.name,  # Currently only 1 corpus is allowed.
-                        # Supply IDs from `rag.list_files()`.
-                        rag_file_ids=self.files,
                     )
                 ],
                 similarity_top_k=3,  # Optional
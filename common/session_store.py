@@ -0,0 +1,209 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+def content_size(content):
+    # Serialized proto size of a vertexai Content, falls back to its repr for anything else
+    try:
+        raw = content._raw_content
+        return type(raw).pb(raw).ByteSize()
+    except Exception:
+        return len(repr(content))
+
+class SessionEntry:
+    def __init__(self, session, history):
+        self.session = session
+        self.history = history
+        self.history_bytes = 0
+        self.sized_turns = 0
+        self.last_access = time.monotonic()
+
+class SessionStore:
+    """
+    Bounded store for chat sessions and their histories.
+
+    Entries are kept in LRU order and evicted when they have been idle for longer than
+    idle_ttl, when there are more than max_sessions of them or when the histories take
+    more than max_history_bytes. A background sweeper evicts idle entries.
+    """
+
+    def __init__(self, idle_ttl=1800, max_sessions=500, max_history_bytes=64 * 1024 * 1024,
+                 sweep_interval=60, size_of=content_size, on_evict=None):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_history_bytes = max_history_bytes
+        self.sweep_interval = sweep_interval
+        self.size_of = size_of
+        self.on_evict = on_evict
+
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.history_bytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions_idle": 0,
+            "evictions_lru": 0,
+            "evictions_memory": 0,
+        }
+        self.sweeper = None
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, config_service, on_evict=None):
+        return cls(
+            idle_ttl=float(config_service.get_property('sessions', 'idle_ttl_seconds')),
+            max_sessions=int(config_service.get_property('sessions', 'max_sessions')),
+            max_history_bytes=int(float(config_service.get_property('sessions', 'max_history_megabytes')) * 1024 * 1024),
+            sweep_interval=float(config_service.get_property('sessions', 'sweep_interval_seconds')),
+            on_evict=on_evict,
+        )
+
+    def get_session(self, user_id):
+        with self.lock:
+            entry = self._touch(user_id)
+
+            if entry is None or entry.session is None:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            return entry.session
+
+    def get_history(self, user_id):
+        with self.lock:
+            entry = self._touch(user_id)
+            return entry.history if entry is not None else []
+
+    def put(self, user_id, session, history):
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is not None:
+                self.history_bytes -= entry.history_bytes
+
+            entry = SessionEntry(session, history)
+            self.entries[user_id] = entry
+            self._resize(entry)
+            self._enforce_limits()
+
+    def update_history(self, user_id, history):
+        with self.lock:
+            entry = self._touch(user_id)
+            if entry is None:
+                self.put(user_id, None, history)
+                return
+
+            if entry.history is not history:
+                entry.history = history
+                self.history_bytes -= entry.history_bytes
+                entry.history_bytes = 0
+                entry.sized_turns = 0
+
+            self._resize(entry)
+            self._enforce_limits()
+
+    def reset_sessions(self):
+        # Drops the chat sessions but keeps the histories, new sessions are started from them
+        with self.lock:
+            for entry in self.entries.values():
+                entry.session = None
+
+    def remove(self, user_id):
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is not None:
+                self.history_bytes -= entry.history_bytes
+
+    def sweep(self):
+        deadline = time.monotonic() - self.idle_ttl
+
+        with self.lock:
+            expired = [user_id for user_id, entry in self.entries.items() if entry.last_access < deadline]
+            for user_id in expired:
+                self._evict(user_id, "evictions_idle")
+
+        if expired:
+            logging.debug("Evicted %d idle chat sessions", len(expired))
+
+    def start_sweeper(self):
+        if self.sweeper is not None:
+            return
+
+        def run():
+            while not self.stopped.wait(self.sweep_interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logging.error("Session sweep failed. Exception: %s", e)
+
+        self.sweeper = threading.Thread(target=run, name="session-sweeper", daemon=True)
+        self.sweeper.start()
+
+    def stop_sweeper(self):
+        self.stopped.set()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                sessions=len(self.entries),
+                history_bytes=self.history_bytes,
+                hit_ratio=self.stats["hits"] / lookups if lookups else 0.0,
+            )
+
+    def _touch(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+
+        if time.monotonic() - entry.last_access > self.idle_ttl:
+            self._evict(user_id, "evictions_idle")
+            return None
+
+        entry.last_access = time.monotonic()
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def _resize(self, entry):
+        # Histories only grow between turns, so only the new turns need to be sized
+        if len(entry.history) < entry.sized_turns:
+            self.history_bytes -= entry.history_bytes
+            entry.history_bytes = 0
+            entry.sized_turns = 0
+
+        added = sum(self.size_of(content) for content in entry.history[entry.sized_turns:])
+        entry.history_bytes += added
+        entry.sized_turns = len(entry.history)
+        self.history_bytes += added
+
+    def _enforce_limits(self):
+        # The most recently used entry is never evicted, even if it is over the memory cap alone
+        while len(self.entries) > max(self.max_sessions, 1):
+            self._evict(next(iter(self.entries)), "evictions_lru")
+
+        while self.history_bytes > self.max_history_bytes and len(self.entries) > 1:
+            self._evict(next(iter(self.entries)), "evictions_memory")
+
+    def _evict(self, user_id, reason):
+        entry = self.entries.pop(user_id)
+        self.history_bytes -= entry.history_bytes
+        self.stats[reason] += 1
+
+        if self.on_evict is not None:
+            self.on_evict(user_id)
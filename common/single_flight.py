@@ -0,0 +1,132 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+
+class SingleFlightTimeout(TimeoutError):
+    pass
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: callers using the same key while a call is in
+    flight wait for it and share its result or its error, instead of calling upstream again.
+
+    Keys are tuples starting with the kind of call, e.g. ("get_model", user_id), which is
+    what the merged calls are counted by. Nothing is cached once the call has completed.
+    Callers waiting longer than timeout seconds give up with SingleFlightTimeout, the call
+    itself keeps running for the caller that started it.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.tasks = {}
+        self.stats = {
+            "calls": 0,
+            "merged": 0,
+            "errors_shared": 0,
+            "timeouts": 0,
+        }
+        self.merged_by_kind = {}
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(timeout=float(config_service.get_property('single_flight', 'timeout_seconds')))
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            self._count_call(key, leader)
+
+        if leader:
+            try:
+                flight.result = function(*args, **kwargs)
+                return flight.result
+            except BaseException as e:
+                # Waiters must not take a call that never returned for one that returned None
+                flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+
+        if not flight.done.wait(self.timeout):
+            self._count("timeouts")
+            raise SingleFlightTimeout("Timed out waiting for the call in flight for %s" % (key,))
+
+        if flight.error is not None:
+            self._count("errors_shared")
+            raise flight.error
+
+        return flight.result
+
+    async def do_async(self, key, function, *args, **kwargs):
+        # Async callers share a task, so a cancelled caller does not cancel the call for the others
+        with self.lock:
+            task = self.tasks.get(key)
+            leader = task is None
+            if leader:
+                task = self.tasks[key] = asyncio.ensure_future(function(*args, **kwargs))
+                task.add_done_callback(lambda _: self._forget_task(key, task))
+            self._count_call(key, leader)
+
+        try:
+            if leader:
+                return await asyncio.shield(task)
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            if task.done():
+                # The call itself timed out
+                raise
+            self._count("timeouts")
+            raise SingleFlightTimeout("Timed out waiting for the call in flight for %s" % (key,))
+        except Exception:
+            if not leader:
+                self._count("errors_shared")
+            raise
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                in_flight=len(self.flights) + len(self.tasks),
+                merged_by_kind=dict(self.merged_by_kind),
+            )
+
+    def _forget_task(self, key, task):
+        with self.lock:
+            if self.tasks.get(key) is task:
+                del self.tasks[key]
+
+    def _count_call(self, key, leader):
+        self.stats["calls"] += 1
+        if not leader:
+            self.stats["merged"] += 1
+            self.merged_by_kind[key[0]] = self.merged_by_kind.get(key[0], 0) + 1
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+class StartupTimings:
+    """
+    Collects how long each startup phase took, relative to when the process started.
+    """
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.lock = threading.Lock()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            end = time.monotonic()
+            with self.lock:
+                self.phases.append({
+                    "phase": name,
+                    "start_ms": round((start - self.origin) * 1000, 1),
+                    "duration_ms": round((end - start) * 1000, 1),
+                    "thread": threading.current_thread().name,
+                    "failed": failed,
+                })
+
+    def report(self):
+        with self.lock:
+            return sorted(self.phases, key=lambda phase: phase["start_ms"])
+
+    def log_report(self):
+        lines = ["%-28s %10s %10s  %s" % ("phase", "start ms", "took ms", "thread")]
+        for phase in self.report():
+            lines.append("%-28s %10.1f %10.1f  %s%s" % (
+                phase["phase"], phase["start_ms"], phase["duration_ms"], phase["thread"],
+                " (failed)" if phase["failed"] else ""))
+        logging.info("Startup timings:\n%s", "\n".join(lines))
+
+class LazyResource:
+    """
+    A client or model that is only built the first time it is needed.
+
+    Concurrent callers wait for the same initialization. A failed initialization is not
+    cached, the next get() tries again.
+    """
+
+    def __init__(self, name, factory, timings):
+        self.name = name
+        self.factory = factory
+        self.timings = timings
+        self.lock = threading.Lock()
+        self.value = None
+        self.ready = False
+
+    def get(self):
+        if self.ready:
+            return self.value
+
+        with self.lock:
+            if not self.ready:
+                with self.timings.phase(self.name):
+                    self.value = self.factory()
+                self.ready = True
+
+        return self.value
+
+    def is_ready(self):
+        return self.ready
+
+def warm_up(resources, timings, max_workers=4):
+    """
+    Initializes the resources concurrently on a thread pool, without blocking the caller.
+
+    Resources that depend on each other simply wait for one another through get().
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="warm-up")
+
+    def initialize(resource):
+        try:
+            resource.get()
+        except Exception as e:
+            logging.error("Warm-up of %s failed: %s, %s", resource.name, traceback.format_exc(), e)
+
+    futures = [executor.submit(initialize, resource) for resource in resources]
+
+    def report():
+        for future in futures:
+            future.result()
+        timings.log_report()
+        executor.shutdown(wait=False)
+
+    threading.Thread(target=report, name="warm-up-report", daemon=True).start()
+
+def retry_until_done(function, name, initial_delay=5, max_delay=300, on_error=None):
+    """
+    Calls function until it returns, waiting with exponential backoff after every failure.
+
+    For background initialization (e.g. syncing the RAG corpus) that must not give up on a
+    transient error. on_error(error) is called with every failure.
+    """
+    delay = initial_delay
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            if on_error is not None:
+                on_error(e)
+            logging.error("%s failed, retrying in %.0f seconds: %s, %s", name, delay, traceback.format_exc(), e)
+
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,232 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from common.metrics import DEFAULT_BUCKETS, Metrics
+
+# Timed spans of a chat turn. The turn is the root span, e.g. init_chat, every model call,
+# function call and Firestore read is a span under it. The current span is a context
+# variable, so span() anywhere below the handler joins the turn's tree without passing it
+# around, and is a no-op outside a turn. Threads started for the turn get the caller's
+# context through in_context().
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def outcome_of(error):
+    # Exceptions may name their outcome, e.g. AdmissionRejected is "rejected"
+    if not isinstance(error, Exception):
+        return "cancelled"
+    return getattr(error, "outcome", "error")
+
+def in_context(function):
+    # For executor.submit: runs function in a copy of the caller's context
+    return functools.partial(contextvars.copy_context().run, function)
+
+class Span:
+    def __init__(self, trace, name, labels, parent=None):
+        self.trace = trace
+        self.name = name
+        self.labels = labels
+        self.parent = parent
+        self.children = []
+        self.thread = threading.current_thread().name
+        self.outcome = "ok"
+        self.started = time.monotonic()
+        self.ended = None
+
+    @property
+    def duration(self):
+        return (self.ended if self.ended is not None else time.monotonic()) - self.started
+
+    def set_outcome(self, outcome):
+        self.outcome = outcome
+
+    def end(self, outcome=None):
+        if self.ended is not None:
+            return
+        if outcome is not None:
+            self.outcome = outcome
+        self.ended = time.monotonic()
+        self.trace.tracer.observe(self)
+
+class NoSpan:
+    # What span() gives outside a turn
+    def set_outcome(self, outcome):
+        pass
+
+    def end(self, outcome=None):
+        pass
+
+NO_SPAN = NoSpan()
+
+class Trace:
+    def __init__(self, tracer, request_id):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.lock = threading.Lock()
+        self.spans = 0
+        self.dropped = 0
+
+    def start(self, name, labels, parent):
+        span = Span(self, name, labels, parent)
+        # Spans past max_spans are timed and counted, but left out of the tree
+        with self.lock:
+            if self.spans < self.tracer.max_spans:
+                self.spans += 1
+                parent.children.append(span)
+            else:
+                self.dropped += 1
+        return span
+
+def start_span(name, **labels):
+    """
+    Starts a span under the current one without making it current, for generators whose
+    consumer may start other spans between chunks. The caller ends it.
+    """
+    parent = current_span.get()
+    if parent is None:
+        return NO_SPAN
+    return parent.trace.start(name, labels, parent)
+
+@contextmanager
+def span(name, **labels):
+    """
+    Times the block in a span under the current one, e.g. span("call_function", function=name).
+    An exception leaving the block sets the outcome, which the block may also set itself.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+
+    child = parent.trace.start(name, labels, parent)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set_outcome(outcome_of(e))
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+def format_tree(root):
+    lines = ["%10s %10s  %s" % ("start ms", "took ms", "span")]
+
+    def add(span, depth):
+        labels = "".join(" %s=%s" % (name, value) for name, value in sorted(span.labels.items()))
+        lines.append("%10.1f %10s  %s%s%s%s  [%s]" % (
+            (span.started - root.started) * 1000,
+            "%.1f" % (span.duration * 1000) if span.ended is not None else "running",
+            "  " * depth, span.name, labels,
+            "" if span.outcome == "ok" else " (%s)" % span.outcome,
+            span.thread))
+        for child in sorted(span.children, key=lambda child: child.started):
+            add(child, depth + 1)
+
+    add(root, 0)
+    if root.trace.dropped:
+        lines.append("(%d more spans not kept)" % root.trace.dropped)
+    return "\n".join(lines)
+
+class Tracer:
+    """
+    Traces chat turns and exports what the spans measured as Prometheus metrics.
+
+    Every span is observed in a latency histogram by name and outcome, the spans of function
+    calls and model calls also by function name and by model. A turn slower than slow_turn
+    seconds is logged with its span tree.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, slow_turn=0, max_spans=200):
+        self.slow_turn = slow_turn
+        self.max_spans = max_spans
+
+        self.metrics = Metrics()
+        self.turns = self.metrics.counter(
+            "chat_turns_total", "Chat turns by path and outcome.", ("path", "outcome"))
+        self.turn_seconds = self.metrics.histogram(
+            "chat_turn_duration_seconds", "Latency of chat turns.", ("path", "outcome"), buckets)
+        self.slow_turns = self.metrics.counter(
+            "chat_slow_turns_total", "Chat turns slower than the slow turn threshold.", ("path",))
+        self.span_seconds = self.metrics.histogram(
+            "chat_span_duration_seconds", "Latency of the phases of chat turns.", ("span", "outcome"), buckets)
+        self.function_calls = self.metrics.counter(
+            "function_calls_total", "Function calls by function name and outcome.", ("function", "outcome"))
+        self.function_seconds = self.metrics.histogram(
+            "function_call_duration_seconds", "Latency of function calls.", ("function", "outcome"), buckets)
+        self.model_calls = self.metrics.counter(
+            "model_calls_total", "Model calls by model and outcome, queueing and retries included.", ("model", "outcome"))
+        self.model_seconds = self.metrics.histogram(
+            "model_call_duration_seconds", "Latency of model calls.", ("model", "outcome"), buckets)
+
+    @classmethod
+    def from_config(cls, config_service):
+        if config_service.get_property('tracing', 'enabled') != "true":
+            return None
+
+        return cls(
+            buckets=[float(bound) for bound in config_service.get_property('tracing', 'buckets').split('|')],
+            slow_turn=float(config_service.get_property('tracing', 'slow_turn_ms')) / 1000,
+            max_spans=int(config_service.get_property('tracing', 'max_spans')),
+        )
+
+    @contextmanager
+    def trace(self, path, request_id):
+        """
+        Makes the block a turn, the root span the spans started in it go under.
+
+        The previous span is set back instead of reset, the block may be the body of a
+        generator that is resumed in another context than it started in.
+        """
+        root = Span(Trace(self, request_id), "turn", {"path": path})
+        previous = current_span.get()
+        current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.set_outcome(outcome_of(e))
+            raise
+        finally:
+            current_span.set(previous)
+            root.end()
+
+    def observe(self, span):
+        duration = span.duration
+
+        if span.parent is None:
+            path = span.labels["path"]
+            self.turns.inc((path, span.outcome))
+            self.turn_seconds.observe((path, span.outcome), duration)
+            if self.slow_turn and duration > self.slow_turn:
+                self.slow_turns.inc((path,))
+                logging.warning("Slow turn %s on %s took %.0f ms:\n%s",
+                                span.trace.request_id, path, duration * 1000, format_tree(span))
+            return
+
+        self.span_seconds.observe((span.name, span.outcome), duration)
+        if "function" in span.labels:
+            self.function_calls.inc((span.labels["function"], span.outcome))
+            self.function_seconds.observe((span.labels["function"], span.outcome), duration)
+        if "model" in span.labels:
+            self.model_calls.inc((span.labels["model"], span.outcome))
+            self.model_seconds.observe((span.labels["model"], span.outcome), duration)
+
+    def render(self):
+        return self.metrics.render()
@@ -0,0 +1,211 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+class TurnRejected(Exception):
+    outcome = "busy"
+
+    def __init__(self, user_id, reason):
+        super().__init__("Turn of user %s rejected: %s" % (user_id, reason))
+        self.user_id = user_id
+        self.reason = reason
+
+class Waiter:
+    # Wakes a queued turn, either a thread blocked on an Event or a coroutine awaiting a Future
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = threading.Event() if loop is None else loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.event.done():
+            self.event.set_result(None)
+
+class Mailbox:
+    def __init__(self):
+        self.busy = False
+        self.depth = 0
+        self.waiters = deque()
+
+class UserTurns:
+    """
+    Runs the chat turns of one user one at a time, in arrival order.
+
+    Turns of different users never wait for each other. Mailboxes only exist while a user has
+    turns running or queued, and are spread over a fixed number of stripes, each with its own
+    lock, so the table stays small and users rarely contend on the same lock. A turn is
+    rejected right away when its user already has max_queue_depth turns running or queued,
+    and after waiting wait_timeout seconds for the turns ahead of it.
+    """
+
+    def __init__(self, stripes=64, max_queue_depth=3, wait_timeout=60):
+        self.max_queue_depth = max_queue_depth
+        self.wait_timeout = wait_timeout
+        self.stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "turns": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "max_wait_seconds": 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            stripes=int(config_service.get_property('turns', 'lock_stripes')),
+            max_queue_depth=int(config_service.get_property('turns', 'max_queue_depth')),
+            wait_timeout=float(config_service.get_property('turns', 'wait_timeout_seconds')),
+        )
+
+    def acquire(self, user_id):
+        """
+        Blocks until it is the user's turn, raises TurnRejected when the user is flooding.
+        """
+        started = time.monotonic()
+        waiter = self._enter(user_id, None)
+
+        if waiter is not None and not waiter.event.wait(self.wait_timeout):
+            self._abandon(user_id, waiter)
+
+        self._count_turn(started, waiter)
+
+    async def acquire_async(self, user_id):
+        started = time.monotonic()
+        waiter = self._enter(user_id, asyncio.get_running_loop())
+
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.event, self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._abandon(user_id, waiter)
+            except asyncio.CancelledError:
+                # The client went away while queued, the turn is passed on if it was already ours
+                if not self._withdraw(user_id, waiter):
+                    self.release(user_id)
+                raise
+
+        self._count_turn(started, waiter)
+
+    def release(self, user_id):
+        lock, mailboxes = self._stripe(user_id)
+
+        with lock:
+            mailbox = mailboxes[user_id]
+            mailbox.depth -= 1
+
+            if mailbox.waiters:
+                # The turn is handed over, the mailbox stays busy
+                mailbox.waiters.popleft().wake()
+            else:
+                mailbox.busy = False
+                if mailbox.depth == 0:
+                    del mailboxes[user_id]
+
+    @contextmanager
+    def turn(self, user_id):
+        self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    @asynccontextmanager
+    async def turn_async(self, user_id):
+        await self.acquire_async(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def get_stats(self):
+        active_users = 0
+        queued_turns = 0
+        for lock, mailboxes in self.stripes:
+            with lock:
+                active_users += len(mailboxes)
+                queued_turns += sum(len(mailbox.waiters) for mailbox in mailboxes.values())
+
+        with self.stats_lock:
+            return dict(self.stats, active_users=active_users, queued_turns=queued_turns)
+
+    def _stripe(self, user_id):
+        return self.stripes[zlib.crc32(user_id.encode("utf-8")) % len(self.stripes)]
+
+    def _enter(self, user_id, loop):
+        # Returns None when the turn can start right away, else the Waiter to wait on
+        lock, mailboxes = self._stripe(user_id)
+
+        with lock:
+            mailbox = mailboxes.get(user_id)
+            if mailbox is None:
+                mailbox = mailboxes[user_id] = Mailbox()
+
+            if mailbox.depth >= self.max_queue_depth:
+                self._count("rejected_queue_full")
+                raise TurnRejected(user_id, "too many turns queued")
+
+            mailbox.depth += 1
+            if not mailbox.busy:
+                mailbox.busy = True
+                return None
+
+            waiter = Waiter(loop)
+            mailbox.waiters.append(waiter)
+
+        self._count("queued")
+        return waiter
+
+    def _abandon(self, user_id, waiter):
+        # The turn may have been handed over while timing out, then it simply goes ahead
+        if self._withdraw(user_id, waiter):
+            self._count("rejected_timeout")
+            raise TurnRejected(user_id, "timed out waiting for the previous turns")
+
+    def _withdraw(self, user_id, waiter):
+        lock, mailboxes = self._stripe(user_id)
+
+        with lock:
+            mailbox = mailboxes[user_id]
+            if waiter not in mailbox.waiters:
+                return False
+
+            mailbox.waiters.remove(waiter)
+            mailbox.depth -= 1
+            return True
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def _count_turn(self, started, waiter):
+        waited = time.monotonic() - started
+
+        with self.stats_lock:
+            self.stats["turns"] += 1
+            if waiter is not None:
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
@@ -17,6 +17,9 @@
 if [ "$1" == "debug" ]; then
   export DEV_MODE=true
   /venv/bin/python3 -m flask run --host=0.0.0.0 --port=8080 --debugger --reload
+elif [ "$1" == "asgi" ]; then
+  # Asyncio serving mode, see asgi.py
+  /venv/bin/hypercorn asgi:app --bind 0.0.0.0:8080
 else
   /venv/bin/python3 -m flask run --host=0.0.0.0 --port=8080
 fi
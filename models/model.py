@@ -15,6 +15,8 @@
 import json
 
 class Model:
+    __slots__ = ("user_id", "original_material", "model", "color")
+
     def __init__(self, user_id, original_material, model, color):
         self.original_material = original_material
         self.model = model
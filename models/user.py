@@ -15,6 +15,8 @@
 import json
 
 class User:
+    __slots__ = ("user_id", "email", "name", "avatar")
+
     def __init__(self, user_id, email, name, avatar):
         self.user_id = user_id
         self.email = email
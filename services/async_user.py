@@ -0,0 +1,168 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import time
+import traceback
+from common import tracing
+from common.answer_cache import normalize_question
+from common.function_calling import extract_text
+from models import model
+
+class AsyncUser:
+    """
+    Async facade over the User service, used by the ASGI app.
+
+    Functions backed by an async client (Firestore, Gemini, the 3D model API) are awaited
+    natively. Every other function of the User service is run on a worker thread so the
+    event loop is never blocked.
+    """
+
+    def __init__(self, user_service, async_db, http_client):
+        """
+        Initializes the async User service.
+
+        Args:
+            user_service: The User service holding the state and the synchronous functions.
+            async_db: Firestore AsyncClient instance.
+            http_client: httpx.AsyncClient used for the 3D model API.
+        """
+        self.user_service = user_service
+        self.async_db = async_db
+        self.http_client = http_client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.user_service, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attribute, *args, **kwargs)
+
+        return call
+
+    async def get_model(self, user_id):
+        """
+        Retrieves the color of a character, from the model cache or else from Firestore.
+
+        Args:
+            user_id: The ID of the user.
+
+        Returns:
+            The character model, or None if not found.
+        """
+        model_cache = self.user_service.model_cache
+
+        cached_model = model_cache.get(user_id)
+        if cached_model is None:
+            cached_model = await self.user_service.single_flight.do_async(("get_model", user_id), self.load_model, user_id)
+
+        return self.user_service.model_writes.apply(user_id, cached_model)
+
+    async def load_model(self, user_id):
+        model_cache = self.user_service.model_cache
+
+        try:
+            with tracing.span("firestore", operation="models.query"):
+                results = await self.async_db.collection("models").where("user_id", "==", user_id).get()
+
+            if not results:
+                logging.warning("No character found for '%s'.", user_id)
+                return None
+
+            character_model = model.Model.from_dict(results[0].to_dict())
+            model_cache.put(user_id, character_model)
+            # Updates are written with the synchronous client
+            self.user_service.model_writes.remember(user_id, self.user_service.db.collection("models").document(results[0].id))
+
+            return character_model
+
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            return None
+
+    async def fc_rag_retrieval(self, user_id, question_passthrough):
+        service = self.user_service
+
+        if service.rag_corpus is not None and not service.rag_corpus.is_ready():
+            return service.RAG_LOADING_REPLY, ''
+
+        # Cache lookups and local retrieval may embed the question, which is a network call
+        corpus_version, answer = await asyncio.to_thread(service.lookup_rag_answer, question_passthrough)
+        if answer is not None:
+            return answer, ''
+
+        answer = await service.single_flight.do_async(
+            ("rag", normalize_question(question_passthrough), corpus_version),
+            self.generate_rag_answer, question_passthrough, corpus_version)
+
+        return answer, ''
+
+    async def generate_rag_answer(self, question, corpus_version):
+        service = self.user_service
+        started = time.monotonic()
+
+        prompt = await asyncio.to_thread(service.rag_prompt, question)
+        response = await self.call_model_hedged_async("gemini", service.rag_model.generate_content_async, prompt)
+        answer = extract_text(response)
+
+        await asyncio.to_thread(service.store_rag_answer, question, corpus_version, answer, time.monotonic() - started)
+
+        return answer
+
+    async def call_model_async(self, limiter_name, function, *args, **kwargs):
+        if self.user_service.admission is None:
+            return await function(*args, **kwargs)
+        return await self.user_service.admission.limiter(limiter_name).call_async(function, *args, **kwargs)
+
+    async def call_model_hedged_async(self, limiter_name, function, *args, **kwargs):
+        if self.user_service.hedger is None:
+            return await self.call_model_async(limiter_name, function, *args, **kwargs)
+        return await self.user_service.hedger.call_async(self.call_model_async, limiter_name, function, *args, **kwargs)
+
+    async def fc_create_3d_model_from_avatar(self, user_id):
+        """
+        Creates a 3D model from the user's avatar, see User.fc_create_3d_model_from_avatar.
+
+        Args:
+            user_id: The ID of the user.
+
+        Returns:
+            A tuple containing a message to the user and HTML to display.
+        """
+        service = self.user_service
+
+        try:
+            payload = await service.single_flight.do_async(
+                ("avatar", user_id), asyncio.to_thread, service.avatar_upload_payload, user_id)
+            if payload is None:
+                return service.NO_AVATAR_REPLY, ""
+
+            api_endpoint = service.config_service.get_property("jobs", "api_endpoint") + "/upload"
+
+            logging.info("Sending avatar for user %s to 3D model API", user_id)
+            response = await self.http_client.post(api_endpoint, json=payload, timeout=60)
+
+            if response.status_code != 200:
+                logging.error("API returned error: %s, %s", response.status_code, response.text)
+                return service.UPLOAD_ERROR_REPLY, ""
+
+            # The job is polled by the job scheduler thread, like for the WSGI app
+            return service.start_3d_model_job(user_id, response.json())
+
+        except Exception as e:
+            logging.error("Error in fc_create_3d_model_from_avatar: %s", e)
+            logging.error(traceback.format_exc())
+            return service.CREATE_3D_ERROR_REPLY, ""
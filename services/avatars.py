@@ -0,0 +1,324 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import random
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from google.cloud.firestore_v1.base_query import FieldFilter
+from common import tracing
+from common.answer_cache import normalize_question
+from common.image_processing import process_avatar
+
+class Candidates:
+    def __init__(self, description, images, expires):
+        self.description = description
+        self.images = deque(images)
+        self.expires = expires
+
+class CandidatePool:
+    """
+    The avatars Imagen generated but the user was not shown, kept per user and description
+    so "try another one" is answered without calling Imagen again.
+
+    Candidates are the generated images, only stored as avatar files once they are taken:
+    files are content-addressed and may be shared, so they are never deleted. The pool holds
+    at most max_candidates images, each for at most ttl seconds.
+    """
+
+    def __init__(self, max_candidates=100, ttl=1800, max_users=10000):
+        self.max_candidates = max_candidates
+        self.ttl = ttl
+        self.max_users = max_users
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.descriptions = OrderedDict()
+        self.size = 0
+        self.stats = {
+            "pool_hits": 0,
+            "pool_misses": 0,
+            "fresh_generations": 0,
+            "candidates_added": 0,
+            "evicted_ttl": 0,
+            "evicted_size": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            max_candidates=int(config_service.get_property('avatars', 'pool_max_candidates')),
+            ttl=float(config_service.get_property('avatars', 'pool_ttl_seconds')),
+        )
+
+    def last_description(self, user_id):
+        with self.lock:
+            return self.descriptions.get(user_id)
+
+    def remember(self, user_id, description):
+        # "Another one" without a description means another one of the last avatar
+        with self.lock:
+            self.descriptions[user_id] = description
+            self.descriptions.move_to_end(user_id)
+            while len(self.descriptions) > self.max_users:
+                self.descriptions.popitem(last=False)
+
+    def put(self, user_id, description, images):
+        if not images:
+            return
+
+        with self.lock:
+            key = (user_id, normalize_question(description))
+            self.stats["candidates_added"] += len(images)
+
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                images = list(previous.images) + list(images)
+                self.size -= len(previous.images)
+
+            self.entries[key] = Candidates(description, images, time.monotonic() + self.ttl)
+            self.size += len(images)
+
+            self._evict()
+
+    def take(self, user_id, description):
+        """
+        Removes a candidate for the user and description from the pool.
+
+        Returns:
+            The bytes of the image, or None when there is no candidate left.
+        """
+        with self.lock:
+            self._evict()
+
+            key = (user_id, normalize_question(description))
+            entry = self.entries.get(key)
+            image = None
+            if entry is not None and entry.expires > time.monotonic():
+                image = entry.images.popleft()
+                self.size -= 1
+                if not entry.images:
+                    del self.entries[key]
+
+            self.stats["pool_hits" if image is not None else "pool_misses"] += 1
+
+        return image
+
+    def count_fresh_generation(self):
+        with self.lock:
+            self.stats["fresh_generations"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.stats["pool_hits"] + self.stats["fresh_generations"]
+            return dict(
+                self.stats,
+                candidates=self.size,
+                descriptions=len(self.entries),
+                hit_ratio=self.stats["pool_hits"] / requests if requests else 0.0,
+            )
+
+    def _evict(self):
+        # Entries are in the order they were put, so the expired ones are at the front
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.expires <= now:
+                del self.entries[key]
+                self.size -= len(entry.images)
+                self.stats["evicted_ttl"] += len(entry.images)
+            elif self.size > self.max_candidates:
+                entry.images.popleft()
+                self.size -= 1
+                self.stats["evicted_size"] += 1
+                if not entry.images:
+                    del self.entries[key]
+            else:
+                break
+
+class AvatarPipeline:
+    """
+    Generates avatars off the request thread.
+
+    Every avatar is a job of the job scheduler, run on the pipeline's own threads, so the
+    chat turn returns right away with a placeholder polling /jobs/<job_id>. The Imagen model
+    handle is created once and reused. Generated images are resized, encoded as WebP and
+    thumbnailed in a process pool, and the files are written atomically by the AssetStore
+    under content-hash names, so nobody ever reads a half-written avatar.
+
+    The other images of a generation are kept in the CandidatePool, the next avatar asked
+    for with the same description is made from one of them.
+    """
+
+    def __init__(self, config_service, db, assets, job_scheduler, call_model, number_of_images=4,
+                 size=512, thumbnail_size=128, quality=85, workers=4, processes=2, candidates=None):
+        """
+        Initializes the avatar pipeline.
+
+        Args:
+            config_service: Service to get configuration values.
+            db: Firestore client instance, the avatar URLs are recorded on the user.
+            assets: The AssetStore the avatar files are stored in.
+            job_scheduler: The JobScheduler tracking the avatar jobs.
+            call_model: Function calling a model through its limiter, see User.call_model.
+            number_of_images: Images generated by Imagen per avatar.
+            candidates: The CandidatePool for the images not shown, None to drop them.
+        """
+        self.config_service = config_service
+        self.db = db
+        self.assets = assets
+        self.job_scheduler = job_scheduler
+        self.call_model = call_model
+        self.number_of_images = number_of_images
+        self.size = size
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self.candidates = candidates
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="avatar")
+        # Spawned, not forked: the serving process has gRPC threads running
+        self.processes = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        self.imagen = None
+
+    @classmethod
+    def from_config(cls, config_service, db, assets, job_scheduler, call_model):
+        candidates = None
+        if int(config_service.get_property('avatars', 'pool_max_candidates')) > 0:
+            candidates = CandidatePool.from_config(config_service)
+
+        return cls(
+            config_service, db, assets, job_scheduler, call_model,
+            number_of_images=int(config_service.get_property('avatars', 'number_of_images')),
+            size=int(config_service.get_property('avatars', 'size')),
+            thumbnail_size=int(config_service.get_property('avatars', 'thumbnail_size')),
+            quality=int(config_service.get_property('avatars', 'webp_quality')),
+            workers=int(config_service.get_property('avatars', 'workers')),
+            processes=int(config_service.get_property('avatars', 'processes')),
+            candidates=candidates,
+        )
+
+    def model(self):
+        with self.lock:
+            if self.imagen is None:
+                from vertexai.preview.vision_models import ImageGenerationModel
+                self.imagen = ImageGenerationModel.from_pretrained(self.config_service.get_property("general", "imagen_version"))
+            return self.imagen
+
+    def take_candidate(self, user_id, description):
+        """
+        Makes a candidate from the pool the user's avatar.
+
+        Returns:
+            The URLs of the avatar, or None when the pool has none for the description.
+        """
+        if self.candidates is None:
+            return None
+
+        self.candidates.remember(user_id, description)
+        image = self.candidates.take(user_id, description)
+        if image is None:
+            return None
+
+        urls = self.store(image)
+        self.record(user_id, urls)
+        return urls
+
+    def start(self, user_id, description, seed=100):
+        """
+        Starts generating an avatar for the user.
+
+        Returns:
+            The Job, whose result is the dict of avatar URLs returned by store().
+        """
+        if self.candidates is not None:
+            self.candidates.remember(user_id, description)
+            self.candidates.count_fresh_generation()
+
+        return self.job_scheduler.run(str(uuid.uuid4()), "avatar", lambda job: self.create(user_id, description, seed), self.executor)
+
+    def start_another(self, user_id, description):
+        # Imagen returns the same images for the same seed
+        return self.start(user_id, description, seed=random.randint(1, 2 ** 31 - 1))
+
+    def create(self, user_id, description, seed=100):
+        try:
+            images = self.generate(description, seed)
+            with tracing.span("process_avatar"):
+                urls = self.store(images[0])
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            raise Exception("We failed to generate a new avatar.")
+
+        try:
+            self.record(user_id, urls)
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            raise Exception("We generated your avatar, but failed to save it.")
+
+        if self.candidates is not None:
+            self.candidates.put(user_id, description, images[1:])
+
+        return urls
+
+    def get_stats(self):
+        return self.candidates.get_stats() if self.candidates is not None else None
+
+    def generate(self, description, seed=100):
+        # Returns the bytes of the generated images
+        instruction = self.config_service.get_property("chatbot", "diffusion_generation_instruction")
+        model = self.model()
+
+        images = self.call_model(
+            "imagen",
+            model.generate_images,
+            prompt=instruction % description,
+            number_of_images=self.number_of_images,
+            language="en",
+            seed=seed,
+            add_watermark=False,
+            aspect_ratio="1:1",
+            safety_filter_level="block_some",
+            person_generation="allow_adult",
+        )
+
+        return [image._image_bytes for image in images]
+
+    def store(self, image_bytes):
+        """
+        Post-processes an image in the process pool and stores the avatar files.
+
+        Returns:
+            The URLs of the avatar: avatar (WebP), avatar_source (PNG) and avatar_thumbnail (WebP).
+        """
+        png, webp, thumbnail = self.processes.submit(
+            process_avatar, image_bytes, self.size, self.thumbnail_size, self.quality).result()
+
+        return {
+            "avatar": self.assets.url("avatars", self.assets.put("avatars", webp, ".webp")),
+            "avatar_source": self.assets.url("avatars", self.assets.put("avatars", png, ".png")),
+            "avatar_thumbnail": self.assets.url("avatars", self.assets.put("avatars", thumbnail, ".webp")),
+        }
+
+    def record(self, user_id, urls):
+        # Update Firestore "users" collection
+        user_ref = self.db.collection("users").where(filter=FieldFilter("user_id", "==", user_id))
+        with tracing.span("firestore", operation="users.update"):
+            user_ref.get()[0].reference.update(urls)
+        logging.info('Updated user avatar to %s', urls["avatar"])
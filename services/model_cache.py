@@ -0,0 +1,141 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from models import model
+
+class ModelCache:
+    """
+    Size-bounded, in-process cache of models.model.Model objects keyed by user id.
+
+    Reads go through the cache and writes made by this process update it directly. With
+    start_watch(), a Firestore on_snapshot listener on the models collection keeps it
+    coherent with writes made elsewhere. Without it, ttl seconds after a model was stored
+    it is read again, so writes of other instances show up within ttl. A ttl of 0 keeps
+    models until they are evicted.
+    """
+
+    def __init__(self, max_entries=1000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.watch = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "snapshot_updates": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service):
+        return cls(
+            max_entries=int(config_service.get_property('cache', 'model_cache_size')),
+            ttl=float(config_service.get_property('cache', 'model_cache_ttl_seconds')),
+        )
+
+    def get(self, user_id):
+        with self.lock:
+            cached = self._entry(user_id)
+            if cached is None:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            self.entries.move_to_end(user_id)
+            return model.Model.from_dict(cached[0])
+
+    def put(self, user_id, character_model):
+        with self.lock:
+            self._store(user_id, character_model.to_dict())
+
+    def update(self, user_id, fields):
+        # Write-through of a partial update, only applies if the model is cached
+        with self.lock:
+            cached = self._entry(user_id)
+            if cached is not None:
+                # The rest of the model is as old as it was
+                self._store(user_id, dict(cached[0], **fields), cached[1])
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                hit_ratio=self.stats["hits"] / lookups if lookups else 0.0,
+            )
+
+    def start_watch(self, collection_ref):
+        """
+        Keeps cached models in sync with the collection through on_snapshot.
+
+        Anything implementing on_snapshot(callback) -> watch with an unsubscribe() method
+        works here, so tests can pass a local fake instead of a Firestore collection.
+        """
+        if self.watch is None:
+            self.watch = collection_ref.on_snapshot(self._on_snapshot)
+
+    def stop_watch(self):
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def _on_snapshot(self, collection_snapshot, changes, read_time):
+        with self.lock:
+            for change in changes:
+                data = change.document.to_dict() or {}
+                user_id = data.get("user_id")
+
+                # The first snapshot lists every document, only models that were asked for are kept
+                if user_id is None or user_id not in self.entries:
+                    continue
+
+                if change.type.name == "REMOVED":
+                    self.entries.pop(user_id, None)
+                else:
+                    self._store(user_id, data)
+
+                self.stats["snapshot_updates"] += 1
+
+    def _entry(self, user_id):
+        # (data, time it was stored) unless missing or expired
+        cached = self.entries.get(user_id)
+        if cached is not None and self.ttl and time.monotonic() - cached[1] >= self.ttl:
+            del self.entries[user_id]
+            self.stats["expirations"] += 1
+            return None
+        return cached
+
+    def _store(self, user_id, data, stored=None):
+        # Copies of the dict are kept so callers can't mutate cached models
+        self.entries[user_id] = (dict(data), time.monotonic() if stored is None else stored)
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
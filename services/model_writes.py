@@ -0,0 +1,267 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+from google.api_core import exceptions
+from google.cloud.firestore_v1.base_query import FieldFilter
+from common import tracing
+from models import model
+
+class ModelWriteBuffer:
+    """
+    Write-behind buffer for the updates of the models collection.
+
+    Updates are merged per user, so ten color changes in a row become a single write, and are
+    committed in batched writes every flush_interval seconds and when the buffer is stopped.
+    Document references are cached by user id, the max_references most recently used, only
+    the first update of a user whose model was not read recently needs the lookup query. Until they are flushed, the pending fields are
+    applied to the models read through get_model.
+
+    A batch that fails because a document is gone is split until only the updates of the
+    missing documents are left, those are dropped and on_drop(user_id) is called. Other
+    failed updates are retried with the next flush, max_attempts times.
+
+    When the buffer is not started, every update is written right away.
+    """
+
+    # Firestore commits at most 500 writes at a time
+    MAX_BATCH = 500
+
+    def __init__(self, db, flush_interval=0.5, max_attempts=3, max_references=10000, on_drop=None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.max_references = max_references
+        self.on_drop = on_drop
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.references = OrderedDict()
+        self.pending = {}
+        self.flushing = {}
+        self.attempts = {}
+        self.stats = {
+            "updates": 0,
+            "merged": 0,
+            "lookups": 0,
+            "lookups_skipped": 0,
+            "references_evicted": 0,
+            "flushes": 0,
+            "writes": 0,
+            "failures": 0,
+            "splits": 0,
+            "dropped": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config_service, db, on_drop=None):
+        return cls(
+            db,
+            on_drop=on_drop,
+            flush_interval=float(config_service.get_property('model_writes', 'flush_interval_seconds')),
+            max_attempts=int(config_service.get_property('model_writes', 'max_attempts')),
+            max_references=int(config_service.get_property('model_writes', 'max_references')),
+        )
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name="model-writes", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        # Writes what is still pending, e.g. at shutdown
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.flush_interval + 10)
+        self.flush()
+
+    def remember(self, user_id, reference):
+        # Models read from Firestore hand their document reference over for later updates
+        with self.lock:
+            self._remember(user_id, reference)
+
+    def references_for(self, user_ids):
+        with self.lock:
+            return {user_id: self.references[user_id] for user_id in user_ids if user_id in self.references}
+
+    def update(self, user_id, fields):
+        """
+        Queues a partial update of the user's model.
+
+        Returns:
+            False when the user has no model, True once the update is queued.
+        """
+        reference = self._reference(user_id)
+        if reference is None:
+            return False
+
+        with self.lock:
+            # Kept until the update is written, see _remember
+            self._remember(user_id, reference)
+            queued = self.pending.get(user_id)
+            if queued is not None:
+                queued.update(fields)
+                self.stats["merged"] += 1
+            else:
+                self.pending[user_id] = dict(fields)
+            self.stats["updates"] += 1
+
+        if self.thread is None:
+            self.flush()
+        return True
+
+    def pending_fields(self, user_id):
+        # Fields being committed count as pending until the commit is done
+        with self.lock:
+            return dict(self.flushing.get(user_id, {}), **self.pending.get(user_id, {}))
+
+    def apply(self, user_id, character_model):
+        # The model as it will be once the pending fields are written
+        fields = self.pending_fields(user_id)
+        if character_model is None or not fields:
+            return character_model
+        return model.Model.from_dict(dict(character_model.to_dict(), **fields))
+
+    def flush(self):
+        # One flush at a time, so updates of a user are committed in order
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                updates = self.flushing = self.pending
+                self.pending = {}
+                references = {user_id: self.references[user_id] for user_id in updates}
+
+            try:
+                user_ids = list(updates)
+                for start in range(0, len(user_ids), self.MAX_BATCH):
+                    self._commit(user_ids[start:start + self.MAX_BATCH], updates, references)
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                pending=len(self.pending),
+                references=len(self.references),
+            )
+
+    def _reference(self, user_id):
+        with self.lock:
+            reference = self.references.get(user_id)
+            if reference is not None:
+                self.references.move_to_end(user_id)
+                self.stats["lookups_skipped"] += 1
+                return reference
+            self.stats["lookups"] += 1
+
+        query = self.db.collection("models").where(filter=FieldFilter("user_id", "==", user_id))
+        with tracing.span("firestore", operation="models.query"):
+            results = query.get()
+        if not results:
+            return None
+
+        self.remember(user_id, results[0].reference)
+        return results[0].reference
+
+    def _remember(self, user_id, reference):
+        self.references[user_id] = reference
+        self.references.move_to_end(user_id)
+
+        while len(self.references) > self.max_references:
+            # The least recently used reference of a user without updates to write
+            for oldest in self.references:
+                if oldest not in self.pending and oldest not in self.flushing:
+                    break
+            else:
+                return
+            del self.references[oldest]
+            self.stats["references_evicted"] += 1
+
+    def _commit(self, user_ids, updates, references):
+        try:
+            batch = self.db.batch()
+            for user_id in user_ids:
+                batch.update(references[user_id], updates[user_id])
+            batch.commit()
+
+            with self.lock:
+                for user_id in user_ids:
+                    self.attempts.pop(user_id, None)
+                self.stats["flushes"] += 1
+                self.stats["writes"] += len(user_ids)
+
+        except exceptions.NotFound as e:
+            # A batch fails as a whole, it is split until the missing documents are found
+            # so the updates of the other users are still written
+            if len(user_ids) > 1:
+                with self.lock:
+                    self.stats["splits"] += 1
+                middle = len(user_ids) // 2
+                self._commit(user_ids[:middle], updates, references)
+                self._commit(user_ids[middle:], updates, references)
+                return
+
+            logging.error("The model of %s is gone: %s", user_ids[0], e)
+            self._drop(user_ids[0], updates[user_ids[0]])
+
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+            self._requeue(user_ids, updates)
+
+    def _drop(self, user_id, fields):
+        with self.lock:
+            # The document may be gone, it is looked up again by the next update
+            if user_id not in self.pending:
+                self.references.pop(user_id, None)
+            self.attempts.pop(user_id, None)
+            self.stats["dropped"] += 1
+        logging.error("Dropped update of the model of %s: %s", user_id, fields)
+        # E.g. the model cache, which already holds the fields that were never written
+        if self.on_drop is not None:
+            self.on_drop(user_id)
+
+    def _requeue(self, user_ids, updates):
+        # Fields updated again in the meantime are newer than the ones that failed
+        dropped = []
+        with self.lock:
+            self.stats["failures"] += 1
+            for user_id in user_ids:
+                attempts = self.attempts.get(user_id, 0) + 1
+
+                if attempts >= self.max_attempts:
+                    dropped.append(user_id)
+                    continue
+
+                self.attempts[user_id] = attempts
+                self.pending[user_id] = dict(updates[user_id], **self.pending.get(user_id, {}))
+
+        for user_id in dropped:
+            self._drop(user_id, updates[user_id])
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("%s, %s", traceback.format_exc(), e)
@@ -13,24 +13,45 @@
 # limitations under the License.
 
 import traceback
-import random
 import logging
 import base64
-import requests
-import time
 import os
-import urllib.request
 import shutil
+import time
 from firebase_admin import credentials, firestore
 from json2html import Json2Html
 from google.cloud.firestore_v1.base_query import FieldFilter
 from vertexai.generative_models import FunctionDeclaration
-from vertexai.preview.vision_models import ImageGenerationModel
+from common.answer_cache import normalize_question
+from common.assets import AssetStore
+from common import tracing
 from common.function_calling import extract_text
+from common.single_flight import SingleFlight
 from models import model, user
+from services.avatars import AvatarPipeline
+from services.model_writes import ModelWriteBuffer
 
 class User:
-    def __init__(self, db, config_service, rag_model):
+    RAG_LOADING_REPLY = 'Reply that the Cloud Meow knowledge base is still loading and ask them to try again in a minute.'
+    NO_AVATAR_REPLY = "Reply that no avatar was found for this user. Suggest creating an avatar first."
+    UPLOAD_ERROR_REPLY = "Reply that there was an error creating the 3D model. Ask them to try again later."
+    CREATE_3D_ERROR_REPLY = "Reply that there was an error creating the 3D model from your avatar. Ask them to try again later."
+
+    # Firestore "in" filters take at most 30 values
+    IN_QUERY_LIMIT = 30
+
+    # Function calls of one response that read or write the avatar or the model run in the
+    # order the model gave them, see function_calling.group_calls
+    ORDERED_FUNCTIONS = frozenset([
+        "fc_show_my_avatar",
+        "fc_show_my_model",
+        "fc_generate_avatar",
+        "fc_regenerate_avatar",
+        "fc_save_model_color",
+        "fc_create_3d_model_from_avatar",
+    ])
+
+    def __init__(self, db, config_service, rag_model, job_scheduler, model_cache, rag_corpus=None, answer_cache=None, admission=None, hedger=None, single_flight=None, model_writes=None, assets=None, avatars=None):
         """
         Initializes the User service.
 
@@ -38,10 +59,30 @@ class User:
             db: Firestore client instance.
             config_service: Service to get configuration values.
             rag_model: The RAG model instance.
+            job_scheduler: The JobScheduler polling external jobs.
+            model_cache: The ModelCache in front of the models collection.
+            rag_corpus: The RAG corpus behind rag_model, None when RAG is disabled.
+            answer_cache: Optional AnswerCache in front of the RAG model.
+            admission: Optional AdmissionController the model calls go through.
+            hedger: Optional Hedger for the RAG model calls.
+            single_flight: SingleFlight merging identical concurrent lookups and RAG calls.
+            model_writes: ModelWriteBuffer the model updates go through, written right away when None.
+            assets: AssetStore for the generated avatars and 3D models.
+            avatars: AvatarPipeline generating the avatars, created from the config when None.
         """
         self.db = db
         self.config_service = config_service
         self.rag_model = rag_model
+        self.job_scheduler = job_scheduler
+        self.model_cache = model_cache
+        self.rag_corpus = rag_corpus
+        self.answer_cache = answer_cache
+        self.admission = admission
+        self.hedger = hedger
+        self.single_flight = single_flight or SingleFlight()
+        self.model_writes = model_writes or ModelWriteBuffer(db)
+        self.assets = assets or AssetStore()
+        self.avatars = avatars or AvatarPipeline.from_config(config_service, db, self.assets, job_scheduler, self.call_model)
 
     @staticmethod
     def get_function_declarations():
@@ -79,6 +120,18 @@ class User:
             }
         )
 
+        fc_regenerate_avatar = FunctionDeclaration(
+            name="fc_regenerate_avatar",
+            description='''Create another version of the avatar, when the user asks for another one 
+                or to try again. Leave the description empty to use the one of the last avatar.''',
+            parameters={
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string", "description": "Description of the picture or avatar"},
+                },
+            }
+        )
+
         fc_save_model_color = FunctionDeclaration(
             name="fc_save_model_color",
             description="Save new color when user requests to update his game model. Input is a color in hex format",
@@ -122,6 +175,7 @@ class User:
         return [
             fc_rag_retrieval,
             fc_generate_avatar,
+            fc_regenerate_avatar,
             fc_save_model_color,
             fc_show_my_model,
             fc_show_my_avatar,
@@ -137,12 +191,37 @@ class User:
         return '''Reply something like "There you go."''', '''
             <div>
                 <br>
-                <img class="avatar" src="/static/avatars/%s.png?rand=%s">
-            </div>''' % (user_id, str(random.randint(0, 1000000)))
+                <img class="avatar" src="%s">
+            </div>''' % self.single_flight.do(("avatar_urls", user_id), self.avatar_urls, user_id)["avatar"]
+
+    def avatar_urls(self, user_id):
+        """
+        Returns the URLs of the user's current avatar.
+
+        Avatars are stored under content-hash names and their URLs are recorded on the user in
+        Firestore. Avatars created before are named after the user.
+
+        Returns:
+            A dictionary with the avatar shown in the chat and the avatar_source image sent to the 3D model API.
+        """
+        legacy_url = self.assets.url("avatars", f"{user_id}.png")
+        urls = {"avatar": legacy_url, "avatar_source": legacy_url}
+
+        try:
+            with tracing.span("firestore", operation="users.query"):
+                results = self.db.collection("users").where(filter=FieldFilter("user_id", "==", user_id)).get()
+            recorded = results[0].to_dict() if results else {}
+            avatar = recorded.get("avatar")
+            if avatar and avatar.startswith(self.assets.url_prefix + "/"):
+                urls = {"avatar": avatar, "avatar_source": recorded.get("avatar_source") or avatar}
+        except Exception as e:
+            logging.error("%s, %s", traceback.format_exc(), e)
+
+        return urls
 
     def get_model(self, user_id):
         """
-        Retrieves the color of a character from Firestore.
+        Retrieves the color of a character, from the model cache or else from Firestore.
 
         Args:
             user_id: The ID of the user.
@@ -150,13 +229,33 @@ class User:
         Returns:
             A dictionary containing the character's color information, or None if not found.
         """
+        cached_model = self.model_cache.get(user_id)
+        if cached_model is None:
+            # Concurrent misses for the same user share one query
+            cached_model = self.single_flight.do(("get_model", user_id), self.load_model, user_id)
+
+        # Updates not written to Firestore yet
+        return self.model_writes.apply(user_id, cached_model)
+
+    def load_model(self, user_id):
         try:
+            # A document whose reference is known is fetched directly instead of queried
+            reference = self.model_writes.references_for([user_id]).get(user_id)
+            if reference is not None:
+                with tracing.span("firestore", operation="models.get"):
+                    snapshot = reference.get()
+                if snapshot.exists:
+                    character_model = model.Model.from_dict(snapshot.to_dict())
+                    self.model_cache.put(user_id, character_model)
+                    return character_model
+
             # Get the models collection reference
             models_ref = self.db.collection("models")
 
             # Query for the model with the given user_id
             query = models_ref.where("user_id", "==", user_id)
-            results = query.get()
+            with tracing.span("firestore", operation="models.query"):
+                results = query.get()
 
             if not results:
                 logging.warning(f"No character found for '{user_id}'.")
@@ -166,7 +265,11 @@ class User:
             # model_doc = results[0]
             # model_data = model_doc.to_dict()
             
-            return model.Model.from_dict(results[0].to_dict())
+            character_model = model.Model.from_dict(results[0].to_dict())
+            self.model_cache.put(user_id, character_model)
+            self.model_writes.remember(user_id, results[0].reference)
+
+            return character_model
 
             # we return the full object since it is now already a dict
             # return model_data
@@ -175,63 +278,144 @@ class User:
             logging.error("%s, %s", traceback.format_exc(), e)
             return None
 
-    def fc_generate_avatar(self, user_id, description):
-        try:
-            model = ImageGenerationModel.from_pretrained(self.config_service.get_property("general", "imagen_version"))
+    def get_models(self, user_ids, fields=None):
+        """
+        Retrieves the models of many users at once, see iter_models.
 
-            instruction = self.config_service.get_property("chatbot", "diffusion_generation_instruction")
+        Returns:
+            A list of model dictionaries in the order of user_ids, users without a model are left out.
+        """
+        return [character_model for chunk in self.iter_models(user_ids, fields) for character_model in chunk]
 
-            images = model.generate_images(
-                prompt=instruction % description,
-                number_of_images=4,
-                language="en",
-                seed=100,
-                add_watermark=False,
-                aspect_ratio="1:1",
-                safety_filter_level="block_some",
-                person_generation="allow_adult",
-            )
+    def iter_models(self, user_ids, fields=None, chunk_size=100):
+        """
+        Reads the models of many users, chunk_size users at a time.
 
-            output_file = "static/avatars/" + str(user_id) + ".png"
-            images[0].save(location=output_file, include_generation_parameters=False)        
+        Cached models are not read again, documents whose reference is known are fetched
+        with a single get_all and the others are looked up with "in" queries.
 
-            cdn_url = '/' + output_file
+        Args:
+            user_ids: The IDs of the users, duplicates are returned once.
+            fields: Optional list of the model fields to return, user_id is always included.
+
+        Returns:
+            A generator of lists of model dictionaries, one per chunk, in the order of user_ids.
+        """
+        # User IDs and fields are checked right away, not when the first chunk is read
+        if not all(isinstance(user_id, str) for user_id in user_ids):
+            raise ValueError("User IDs must be strings.")
+
+        projection = None
+        if fields:
+            projection = ["user_id"] + [field for field in fields if field != "user_id"]
+            unknown = set(projection) - set(model.Model.__slots__)
+            if unknown:
+                raise ValueError("Unknown model fields: %s" % ", ".join(sorted(unknown)))
+
+        return self.model_chunks(list(dict.fromkeys(user_ids)), projection, chunk_size)
+
+    def model_chunks(self, user_ids, projection, chunk_size):
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            found = self.read_models(chunk, projection)
+            yield [found[user_id] for user_id in chunk if user_id in found]
+
+    def read_models(self, user_ids, projection=None):
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            cached_model = self.model_cache.get(user_id)
+            if cached_model is not None:
+                found[user_id] = cached_model.to_dict()
+            else:
+                missing.append(user_id)
+
+        references = self.model_writes.references_for(missing)
+        if references:
+            for snapshot in self.db.get_all(list(references.values()), field_paths=projection):
+                if snapshot.exists:
+                    self.found_model(found, snapshot, projection)
+
+        unknown = [user_id for user_id in missing if user_id not in references]
+        for start in range(0, len(unknown), self.IN_QUERY_LIMIT):
+            query = self.db.collection("models").where(filter=FieldFilter("user_id", "in", unknown[start:start + self.IN_QUERY_LIMIT]))
+            if projection is not None:
+                query = query.select(projection)
+            for snapshot in query.stream():
+                self.found_model(found, snapshot, projection)
+
+        # Updates not written to Firestore yet
+        for user_id, data in found.items():
+            data.update(self.model_writes.pending_fields(user_id))
+            if projection is not None:
+                found[user_id] = {field: data[field] for field in projection if field in data}
+
+        return found
+
+    def found_model(self, found, snapshot, projection):
+        data = snapshot.to_dict()
+        user_id = data.get("user_id")
+        if user_id is None:
+            return
+
+        found[user_id] = data
+        self.model_writes.remember(user_id, snapshot.reference)
+        # Only complete models go into the model cache
+        if projection is None:
+            self.model_cache.put(user_id, model.Model.from_dict(data))
+
+    def fc_generate_avatar(self, user_id, description):
+        try:
+            # An image left over from an earlier generation with the same description
+            urls = self.avatars.take_candidate(user_id, description)
         except Exception as e:
-            logging.info("%s, %s", traceback.format_exc(), e)
+            logging.error("%s, %s", traceback.format_exc(), e)
             return 'Reply that we failed to generate a new avatar. Ask them to try again later'
 
+        if urls is not None:
+            return '''Reply that the avatar was successfully created.''', self.avatar_html(urls["avatar"])
+
+        # Generated in the background, the placeholder is swapped for the avatar once it is ready
+        job = self.avatars.start(user_id, description)
+
+        return '''Reply that their new avatar is being generated and will show up in a moment.''', self.job_status_html(job)
+
+    def fc_regenerate_avatar(self, user_id, description=None):
+        if not description and self.avatars.candidates is not None:
+            description = self.avatars.candidates.last_description(user_id)
+        if not description:
+            return 'Ask them to describe the avatar they would like.'
+
         try:
-            # Update Firestore "users" collection
-            user_ref = self.db.collection("users").where(filter=FieldFilter("user_id", "==", user_id))
-            user_ref.get()[0].reference.update({"avatar": cdn_url})
-            logging.info('Updated user avatar to %s', cdn_url)
+            urls = self.avatars.take_candidate(user_id, description)
         except Exception as e:
-            logging.info("%s, %s", traceback.format_exc(), e)
+            logging.error("%s, %s", traceback.format_exc(), e)
             return 'Reply that we failed to generate a new avatar. Ask them to try again later'
 
-        return '''Reply that the avatar was successfully created.''', '''
+        if urls is not None:
+            return '''Reply that here is another version of their avatar.''', self.avatar_html(urls["avatar"])
+
+        job = self.avatars.start_another(user_id, description)
+
+        return '''Reply that another version of their avatar is being generated and will show up in a moment.''', self.job_status_html(job)
+
+    def avatar_html(self, url):
+        return '''
             <div>
                 <br>
-                <img class="avatar" src="%s?rand=%s">
-            </div>''' % (cdn_url, str(random.randint(0, 1000000)))
+                <img class="avatar" src="%s">
+            </div>''' % url
 
     def fc_save_model_color(self, user_id, color):
         try:
-            # Get the models collection reference
-            models_ref = self.db.collection("models")
-
-            # Query for the model with the given user_id
-            query = models_ref.where(filter=FieldFilter("user_id", "==", user_id))
-            results = query.get()
+            fields = {"color": color, "original_material": False}
 
-            if not results:
+            # Written to Firestore in the background, merged with the user's other pending updates
+            if not self.model_writes.update(user_id, fields):
                 return f"Reply that no character for user '{user_id}' was found."
 
-            # Update the color of the first matching document
-            for doc in results:
-                doc.reference.update({"color": color, "original_material": False})
-                logging.info(f"Updated color to '{color}' for '{user_id}'\'s model.")
-                break
+            self.model_cache.update(user_id, fields)
+            logging.info(f"Updated color to '{color}' for '{user_id}'\'s model.")
 
             return '''Reply that their character color has been updated''', '''<script>window.reloadCurrentModel();</script>'''
         
@@ -240,12 +424,72 @@ class User:
             return 'Reply that we failed to update their character settings.'
 
     def fc_rag_retrieval(self, user_id, question_passthrough):
-        response = self.rag_model.generate_content(question_passthrough)
-        return extract_text(response), ''
+        if self.rag_corpus is not None and not self.rag_corpus.is_ready():
+            return self.RAG_LOADING_REPLY, ''
+
+        corpus_version, answer = self.lookup_rag_answer(question_passthrough)
+        if answer is not None:
+            return answer, ''
+
+        # The same question asked by several users at once is only sent to the model once
+        answer = self.single_flight.do(
+            ("rag", normalize_question(question_passthrough), corpus_version),
+            self.generate_rag_answer, question_passthrough, corpus_version)
+
+        return answer, ''
+
+    def generate_rag_answer(self, question, corpus_version):
+        started = time.monotonic()
+
+        response = self.call_model_hedged("gemini", self.rag_model.generate_content, self.rag_prompt(question))
+        answer = extract_text(response)
+
+        self.store_rag_answer(question, corpus_version, answer, time.monotonic() - started)
+
+        return answer
+
+    def call_model(self, limiter_name, function, *args, **kwargs):
+        # Goes through the limiter of the model's quota, see common.admission
+        if self.admission is None:
+            return function(*args, **kwargs)
+        return self.admission.limiter(limiter_name).call(function, *args, **kwargs)
+
+    def call_model_hedged(self, limiter_name, function, *args, **kwargs):
+        # Only for calls without side effects, a slow call may be sent twice
+        if self.hedger is None:
+            return self.call_model(limiter_name, function, *args, **kwargs)
+        return self.hedger.call(self.call_model, limiter_name, function, *args, **kwargs)
+
+    def lookup_rag_answer(self, question):
+        """
+        Looks the question up in the answer cache.
+
+        Returns:
+            (corpus_version, answer), answer is None when it has to be generated.
+        """
+        # Cached answers are dropped as soon as the corpus contents change
+        corpus_version = self.rag_corpus.version if self.rag_corpus is not None else None
+
+        if self.answer_cache is None:
+            return corpus_version, None
+
+        return corpus_version, self.answer_cache.lookup(question, corpus_version)
+
+    def rag_prompt(self, question):
+        if self.rag_corpus is None:
+            return question
+        return self.rag_corpus.augment_prompt(question)
+
+    def store_rag_answer(self, question, corpus_version, answer, latency):
+        if self.answer_cache is not None and answer:
+            self.answer_cache.store(question, corpus_version, answer, latency)
 
     def fc_create_3d_model_from_avatar(self, user_id):
         """
         Creates a 3D model from the user's avatar using an external API.
+
+        The upload happens right away, the job is then polled in the background by the
+        job scheduler and the returned HTML polls /jobs/<job_id> until the model is ready.
         
         Args:
             user_id: The ID of the user.
@@ -254,107 +498,151 @@ class User:
             A tuple containing a message to the user and HTML to display.
         """
         try:
-            # Path to the user's avatar
-            avatar_path = f"static/avatars/{user_id}.png"
-            
-            # Check if avatar exists
-            if not os.path.exists(avatar_path):
-                return "Reply that no avatar was found for this user. Suggest creating an avatar first.", ""
-            
-            # Read the avatar image and encode it in base64
-            with open(avatar_path, "rb") as image_file:
-                encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
+            payload = self.single_flight.do(("avatar", user_id), self.avatar_upload_payload, user_id)
+            if payload is None:
+                return self.NO_AVATAR_REPLY, ""
             
             # Send request to the API to create 3D model
-            api_endpoint = "https://genai3d.nikolaidan.demo.altostrat.com/upload"
-            payload = {"image": encoded_image}
+            api_endpoint = self.config_service.get_property("jobs", "api_endpoint") + "/upload"
             
             logging.info(f"Sending avatar for user {user_id} to 3D model API")
-            response = requests.post(api_endpoint, json=payload)
+            response = self.job_scheduler.session.post(api_endpoint, json=payload, timeout=60)
             
             if response.status_code != 200:
                 logging.error(f"API returned error: {response.status_code, response.text}")
-                return "Reply that there was an error creating the 3D model. Ask them to try again later.", ""
-            
-            # Get job ID from response
-            job_data = response.json()
-            job_id = job_data.get("job_id")
-            
-            if not job_id:
-                logging.error(f"No job ID returned from API: {job_data}")
-                return "Reply that there was an error processing the avatar. Ask them to try again later.", ""
+                return self.UPLOAD_ERROR_REPLY, ""
             
-            # Poll for job completion
-            check_url = f"https://genai3d.nikolaidan.demo.altostrat.com/check_job/{job_id}"
-            max_attempts = 60  # Maximum attempts (10 minutes at 10-second intervals)
-            attempt = 0
-            
-            while attempt < max_attempts:
-                logging.info(f"Checking job status for job {job_id}, attempt {attempt+1}")
-                status_response = requests.get(check_url)
-                
-                if status_response.status_code != 200:
-                    logging.error(f"Error checking job status: {status_response.status_code, status_response.text}")
-                    return "Reply that there was an error checking the status of your 3D model. Ask them to try again later.", ""
-                
-                status_data = status_response.json()
-                
-                if status_data.get("status") == "finished":
-                    # Job is complete, download the model file
-                    model_url = status_data.get("filename")
-                    if not model_url:
-                        logging.error(f"No model URL in finished job: {status_data}")
-                        return "Reply that there was an error retrieving the 3D model. Ask them to try again later.", ""
-                    
-                    # Create directory if it doesn't exist
-                    os.makedirs("static/models", exist_ok=True)
-                    
-                    # Download the model file
-                    model_filename = f"{job_id}.glb"
-                    model_path = f"static/models/{model_filename}"
-                    
-                    try:
-                        logging.info(f"Downloading 3D model from {model_url} to {model_path}")
-                        urllib.request.urlretrieve(model_url, model_path)
-                    except Exception as e:
-                        logging.error(f"Error downloading model file: {str(e)}")
-                        return "Reply that there was an error downloading your 3D model. Ask them to try again later.", ""
-                    
-                    # Update Firestore with the new model
-                    try:
-                        models_ref = self.db.collection("models")
-                        query = models_ref.where(filter=FieldFilter("user_id", "==", user_id))
-                        results = query.get()
-                        
-                        if not results:
-                            logging.warning(f"No model record found for user {user_id} to update")
-                            return f"Reply that we created a 3D model, but couldn't find your character record to update.", ""
-                        
-                        for doc in results:
-                            doc.reference.update({"model": model_filename})
-                            logging.info(f"Updated model for {user_id} to {model_filename}")
-                            break
-                        
-                        # Return success message and reload the model
-                        return '''Reply that the 3D model was successfully created from their avatar.''', '''<script>window.reloadCurrentModel();</script>'''
-                    
-                    except Exception as e:
-                        logging.error(f"Error updating model in Firestore: {str(e)}")
-                        return "Reply that the 3D model was created but there was an error updating your character. Ask them to try again later.", ""
-                
-                elif status_data.get("status") == "queued" or status_data.get("status") == "processing":
-                    # Job is still in progress, wait and check again
-                    time.sleep(10)  # Wait 10 seconds before checking again
-                    attempt += 1
-                else:
-                    # Unknown status
-                    logging.error(f"Unknown job status: {status_data}")
-                    return "Reply that there was an unexpected status while creating your 3D model. Ask them to try again later.", ""
-            
-            # If we get here, we've exceeded max attempts
-            return "Reply that the 3D model is taking too long to generate. Suggest they try again later.", ""
+            return self.start_3d_model_job(user_id, response.json())
             
         except Exception as e:
             logging.error(f"Error in fc_create_3d_model_from_avatar: {str(e)}")
             logging.error(traceback.format_exc())
-            return "Reply that there was an error creating the 3D model from your avatar. Ask them to try again later.", ""
\ No newline at end of file
+            return self.CREATE_3D_ERROR_REPLY, ""
+
+    def avatar_upload_payload(self, user_id):
+        """
+        Builds the 3D model API upload request for the user's avatar.
+
+        Returns:
+            The JSON payload, or None if the user has no avatar yet.
+        """
+        # Path to the user's avatar
+        avatar_path = self.assets.path_for_url(self.avatar_urls(user_id)["avatar_source"])
+        
+        # Check if avatar exists
+        if not os.path.exists(avatar_path):
+            return None
+        
+        # Read the avatar image and encode it in base64
+        with open(avatar_path, "rb") as image_file:
+            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
+
+        return {"image": encoded_image}
+
+    def start_3d_model_job(self, user_id, job_data):
+        """
+        Hands the job returned by the upload to the job scheduler.
+
+        Args:
+            user_id: The ID of the user.
+            job_data: The JSON response of the upload request.
+
+        Returns:
+            The function response and the HTML polling the job status.
+        """
+        # Get job ID from response
+        job_id = job_data.get("job_id")
+        
+        if not job_id:
+            logging.error(f"No job ID returned from API: {job_data}")
+            return "Reply that there was an error processing the avatar. Ask them to try again later.", ""
+        
+        # Poll for job completion in the background
+        check_url = self.config_service.get_property("jobs", "api_endpoint") + f"/check_job/{job_id}"
+        job = self.job_scheduler.submit(
+            job_id,
+            check_url,
+            lambda job, status_data: self._save_3d_model(user_id, job, status_data)
+        )
+
+        return '''Reply that the 3D model is being created from their avatar and that it will show up as soon as it is ready.''', self.job_status_html(job)
+
+    def _save_3d_model(self, user_id, job, status_data):
+        """
+        Downloads a finished 3D model and stores it on the user's model. Runs on the job scheduler.
+
+        Returns:
+            The message to show to the user, raises an Exception with the message on failure.
+        """
+        model_url = status_data.get("filename")
+        if not model_url:
+            logging.error(f"No model URL in finished job: {status_data}")
+            raise Exception("There was an error retrieving the 3D model.")
+        
+        # Download the model file, it is named after its contents once complete
+        model_path = self.assets.temp_file("models", ".glb")
+        
+        try:
+            logging.info(f"Downloading 3D model from {model_url} to {model_path}")
+            with self.job_scheduler.session.get(model_url, stream=True, timeout=120) as download:
+                download.raise_for_status()
+                with open(model_path, "wb") as model_file:
+                    for chunk in download.iter_content(chunk_size=1024 * 1024):
+                        model_file.write(chunk)
+            model_filename = self.assets.put_file("models", model_path, ".glb")
+        except Exception as e:
+            logging.error(f"Error downloading model file: {str(e)}")
+            if os.path.exists(model_path):
+                os.unlink(model_path)
+            raise Exception("There was an error downloading your 3D model.")
+        
+        # Update Firestore with the new model
+        try:
+            updated = self.model_writes.update(user_id, {"model": model_filename})
+        except Exception as e:
+            logging.error(f"Error updating model in Firestore: {str(e)}")
+            raise Exception("The 3D model was created but there was an error updating your character.")
+        
+        if not updated:
+            logging.warning(f"No model record found for user {user_id} to update")
+            raise Exception("We created a 3D model, but couldn't find your character record to update.")
+        
+        self.model_cache.update(user_id, {"model": model_filename})
+        logging.info(f"Updated model for {user_id} to {model_filename}")
+
+        return "Your 3D model is ready."
+
+    def job_status_html(self, job):
+        """
+        Renders the chat fragment for a background job, pending jobs poll /jobs/<job_id> again.
+        """
+        if job.is_pending() and job.kind == "avatar":
+            return '''
+            <div hx-get="/jobs/%s" hx-trigger="every 2s" hx-swap="outerHTML">
+                <br>
+                <div class="avatar avatar-placeholder"><img class="job-indicator" src="/static/images/loading.svg"></div>
+            </div>''' % job.job_id
+
+        if job.is_pending():
+            return '''
+            <div hx-get="/jobs/%s" hx-trigger="every 5s" hx-swap="outerHTML">
+                <br>
+                <img class="job-indicator" src="/static/images/loading.svg">
+            </div>''' % job.job_id
+
+        if job.status == "finished" and job.kind == "avatar":
+            return self.avatar_html(job.result["avatar"])
+
+        if job.status == "finished":
+            return '''
+            <div>
+                <br>
+                %s
+                <script>window.reloadCurrentModel();$("#modelWindow").show();</script>
+            </div>''' % job.message
+
+        return '''
+            <div>
+                <br>
+                %s Please try again later.
+            </div>''' % job.message
\ No newline at end of file
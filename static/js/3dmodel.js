@@ -161,7 +161,10 @@ function loadModel() {
         
         return new Promise((resolve, reject) => {
     
-            loader.load( 'static/models/'+data.model, function ( gltf ) {
+            // Models recorded before /assets existed may only be found at their old static path
+            const urls = ['/assets/models/' + data.model, 'static/models/' + data.model];
+
+            const onLoad = function ( gltf ) {
                 model = gltf.scene;
                 model.name = data.user_id;
 
@@ -184,10 +187,20 @@ function loadModel() {
                 }
 
                 resolve();
-            }, undefined, function ( e ) {
-                console.error( e );
-                reject();
-            } );
+            };
+
+            const tryLoad = function ( index ) {
+                loader.load( urls[index], onLoad, undefined, function ( e ) {
+                    if ( index + 1 < urls.length ) {
+                        tryLoad( index + 1 );
+                        return;
+                    }
+                    console.error( e );
+                    reject();
+                } );
+            };
+
+            tryLoad( 0 );
         });
     })
     .catch(error => console.error('Error:', error));
@@ -69,4 +69,95 @@ function showLoadingIndicator() {
 function removeLoadingIndicator() {
     $('.chat-loading-indicator-container').remove();    
     $('.response-target').removeClass('response-target');
-}
\ No newline at end of file
+}
+
+// Streams the chatbot reply from /chat/stream (server-sent events) into the placeholder
+async function streamChat(form) {
+    const formData = new FormData(form);
+    const target = $('.response-target');
+    let msg = null;
+    let text = '';
+
+    form.reset();
+    disableFormFields();
+    showLoadingIndicator();
+
+    function ensureMessage() {
+        if (msg === null) {
+            target.find('.chat-loading-indicator-container').remove();
+            msg = $('<div class="msg"></div>').appendTo(target);
+        }
+        return msg;
+    }
+
+    // Error pages are html fragments, rendered like the htmx path renders them
+    function showError(html) {
+        const fragment = $('<div></div>').html(html);
+        const inner = fragment.children('.msg');
+        ensureMessage().html(inner.length ? inner.html() : fragment.html());
+    }
+
+    function handleEvent(event) {
+        if (event.name === 'chunk') {
+            text += event.data;
+            // Re-rendering the whole text lets the browser fix up partially received tags
+            ensureMessage().html(text);
+        } else if (event.name === 'error') {
+            ensureMessage().html(event.data);
+        } else if (event.name === 'html') {
+            // jQuery executes inline scripts (e.g. reloadCurrentModel) when appending
+            ensureMessage().append(event.data);
+            // Activates hx-* attributes in the fragment, e.g. background job polling
+            htmx.process(ensureMessage()[0]);
+        }
+        scrollToBottom();
+    }
+
+    try {
+        const response = await fetch('/chat/stream', { method: 'POST', body: formData });
+        if (!response.ok) {
+            // E.g. a turn rejected while the server is overloaded, or a 500
+            showError(await response.text() || response.status + ' ' + response.statusText);
+            return;
+        }
+
+        const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done)
+                break;
+
+            buffer += value;
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+                handleEvent(parseServerSentEvent(buffer.slice(0, boundary)));
+                buffer = buffer.slice(boundary + 2);
+            }
+        }
+    } catch (error) {
+        console.error('Error:', error);
+        if (msg === null)
+            showError('The connection was lost, please try again.');
+    } finally {
+        scrollToBottom();
+        enableFormFields();
+        removeLoadingIndicator();
+    }
+}
+
+function parseServerSentEvent(block) {
+    const event = { name: 'message', data: [] };
+
+    block.split('\n').forEach(line => {
+        if (line.startsWith('event: '))
+            event.name = line.slice(7);
+        else if (line.startsWith('data: '))
+            event.data.push(line.slice(6));
+    });
+
+    event.data = event.data.join('\n');
+    return event;
+}
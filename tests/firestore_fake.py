@@ -0,0 +1,115 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from google.api_core import exceptions
+
+class FakeReference:
+    def __init__(self, db, id):
+        self.db = db
+        self.id = id
+
+class FakeSnapshot:
+    def __init__(self, reference, data, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data) if self.data is not None else None
+
+class FakeQuery:
+    def __init__(self, db, filter):
+        self.db = db
+        self.filter = filter
+        self.field_paths = None
+
+    def select(self, field_paths):
+        self.field_paths = field_paths
+        return self
+
+    def get(self):
+        self.db.queries += 1
+        field, op, value = self.filter.field_path, self.filter.op_string, self.filter.value
+        with self.db.lock:
+            documents = list(self.db.documents.items())
+        return [FakeSnapshot(FakeReference(self.db, id), data, self.field_paths) for id, data in documents
+                if (data.get(field) == value if op == "==" else data.get(field) in value)]
+
+    stream = get
+
+class FakeCollection:
+    def __init__(self, db):
+        self.db = db
+
+    def where(self, filter):
+        return FakeQuery(self.db, filter)
+
+    def document(self, id):
+        return FakeReference(self.db, id)
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, reference, fields):
+        self.updates.append((reference.id, fields))
+
+    def commit(self):
+        # All or nothing, like a Firestore batched write
+        with self.db.lock:
+            self.db.commits.append([id for id, _ in self.updates])
+            if self.db.fail_next_commits:
+                self.db.fail_next_commits -= 1
+                raise exceptions.ServiceUnavailable("unavailable")
+            for id, _ in self.updates:
+                if id not in self.db.documents:
+                    raise exceptions.NotFound("No document to update: %s" % id)
+            for id, fields in self.updates:
+                self.db.documents[id].update(fields)
+
+class FakeFirestore:
+    """
+    The parts of a Firestore client the model services use, with the documents of the
+    models collection in a dict. fail_next_commits makes the next commits fail with a
+    transient error.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.commits = []
+        self.queries = 0
+        self.get_alls = 0
+        self.fail_next_commits = 0
+
+    def add_model(self, user_id, **fields):
+        self.documents["doc-" + user_id] = dict({"user_id": user_id, "color": "red"}, **fields)
+
+    def collection(self, name):
+        assert name == "models"
+        return FakeCollection(self)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        with self.lock:
+            self.get_alls += 1
+            return [FakeSnapshot(reference, self.documents.get(reference.id), field_paths) for reference in references]
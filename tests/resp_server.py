@@ -0,0 +1,150 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+
+class FakeRedisServer:
+    """
+    In-process stand-in for Redis speaking RESP2 on a local port, with the list commands the
+    history store uses and MULTI/EXEC.
+
+    lose_next_reply makes the server apply the next command and close the connection
+    instead of replying, like a reply lost to a timeout. close_connections() closes every
+    connection, like a server dropping idle clients. With a password, connections have to
+    AUTH before anything else.
+    """
+
+    def __init__(self, password=None):
+        self.password = password
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.commands = []
+        self.connections = []
+        self.lose_next_reply = False
+
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept, name="fake-redis", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.listener.close()
+        self.close_connections()
+
+    def close_connections(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        reader = connection.makefile('rb')
+        queued = None
+        authenticated = self.password is None
+        try:
+            while True:
+                command = self._read_command(reader)
+                if command is None:
+                    return
+
+                name = command[0].decode().upper()
+                if name == "AUTH":
+                    authenticated = command[1].decode() == self.password
+                    reply = "OK" if authenticated else ValueError("WRONGPASS invalid password")
+                elif not authenticated:
+                    reply = ValueError("NOAUTH Authentication required.")
+                elif name == "MULTI":
+                    queued = []
+                    reply = "OK"
+                elif name == "EXEC":
+                    reply = [self._apply(queued_command) for queued_command in queued]
+                    queued = None
+                elif queued is not None:
+                    queued.append(command)
+                    reply = "QUEUED"
+                else:
+                    reply = self._apply(command)
+
+                with self.lock:
+                    lose, self.lose_next_reply = self.lose_next_reply, False
+                if lose:
+                    connection.shutdown(socket.SHUT_RDWR)
+                    return
+                connection.sendall(self._encode(reply))
+        except OSError:
+            return
+        finally:
+            connection.close()
+
+    def _apply(self, command):
+        name, args = command[0].decode().upper(), command[1:]
+        with self.lock:
+            self.commands.append(name)
+            if name in ("PING", "SELECT"):
+                return "OK"
+            if name == "RPUSH":
+                values = self.lists.setdefault(args[0], [])
+                values.extend(args[1:])
+                return len(values)
+            if name == "LRANGE":
+                values = self.lists.get(args[0], [])
+                start, stop = int(args[1]), int(args[2])
+                return values[start:] if stop == -1 else values[start:stop + 1]
+            if name == "LLEN":
+                return len(self.lists.get(args[0], []))
+            if name == "DEL":
+                return sum(1 for key in args if self.lists.pop(key, None) is not None)
+            if name == "EXPIRE":
+                return 1 if args[0] in self.lists else 0
+            return ValueError("ERR unknown command '%s'" % name)
+
+    @staticmethod
+    def _read_command(reader):
+        line = reader.readline()
+        if not line:
+            return None
+        command = []
+        for _ in range(int(line[1:-2])):
+            size = int(reader.readline()[1:-2])
+            command.append(reader.read(size + 2)[:-2])
+        return command
+
+    @classmethod
+    def _encode(cls, reply):
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode()
+        if isinstance(reply, str):
+            return b'+%s\r\n' % reply.encode()
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        return b'*%d\r\n' % len(reply) + b''.join(cls._encode(item) for item in reply)
@@ -0,0 +1,174 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from google.api_core import exceptions
+
+from common.admission import AdmissionRejected, ModelLimiter, TokenBucket, is_retryable
+
+def limiter(**options):
+    return ModelLimiter("gemini", **dict(dict(
+        requests_per_minute=6000, burst=100, max_concurrency=10, queue_deadline=2, backoff_initial=0.01), **options))
+
+def test_token_bucket_refills_at_its_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("common.admission.time.monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=2, capacity=2)
+
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+
+    now[0] += 0.25
+    assert bucket.take() == pytest.approx(0.25)
+    now[0] += 0.25
+    assert bucket.take() == 0
+
+    # Never more than the burst
+    now[0] += 60
+    assert bucket.time_for(3) == pytest.approx(0.5)
+
+def test_calls_wait_for_tokens():
+    # One token every 50 ms after a burst of 1
+    limit = limiter(requests_per_minute=1200, burst=1)
+
+    started = time.monotonic()
+    for _ in range(3):
+        limit.call(lambda: None)
+
+    assert time.monotonic() - started >= 0.09
+    assert limit.get_stats()["admitted"] == 3
+
+def test_call_is_shed_when_the_queue_cannot_drain_before_the_deadline():
+    # One token per second, the deadline is half a second
+    limit = limiter(requests_per_minute=60, burst=1, queue_deadline=0.5)
+    limit.call(lambda: None)
+
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as rejected:
+        limit.call(lambda: None)
+
+    assert "queue" in rejected.value.reason
+    # Right away, not after waiting for the deadline
+    assert time.monotonic() - started < 0.1
+    assert limit.get_stats()["rejected_shed"] == 1
+
+def test_concurrency_is_limited():
+    limit = limiter(max_concurrency=2)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=6) as callers:
+        list(callers.map(lambda _: limit.call(work), range(6)))
+
+    assert running[1] == 2
+    stats = limit.get_stats()
+    assert (stats["admitted"], stats["active"], stats["waiting"]) == (6, 0, 0)
+
+def test_call_waiting_for_a_slot_is_rejected_at_the_deadline():
+    limit = limiter(max_concurrency=1, queue_deadline=0.1)
+    release = threading.Event()
+    holder = threading.Thread(target=limit.call, args=(release.wait,))
+    holder.start()
+    time.sleep(0.02)
+
+    with pytest.raises(AdmissionRejected):
+        limit.call(lambda: None)
+    assert limit.get_stats()["rejected_deadline"] == 1
+
+    release.set()
+    holder.join()
+
+def test_retryable_errors_are_retried():
+    limit = limiter()
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise exceptions.TooManyRequests("quota")
+        return "answer"
+
+    assert limit.call(flaky) == "answer"
+    assert limit.get_stats()["retries"] == 2
+
+def test_other_errors_and_the_last_retry_are_raised():
+    limit = limiter(max_retries=1)
+
+    def broken():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limit.call(broken)
+
+    def overloaded():
+        raise exceptions.ServiceUnavailable("unavailable")
+
+    with pytest.raises(exceptions.ServiceUnavailable):
+        limit.call(overloaded)
+
+    stats = limit.get_stats()
+    assert (stats["retries"], stats["failures"], stats["active"]) == (1, 2, 0)
+    assert is_retryable(exceptions.ResourceExhausted("quota"))
+    assert not is_retryable(exceptions.InvalidArgument("bad"))
+
+def test_stream_is_only_retried_before_the_first_chunk():
+    limit = limiter()
+    attempts = []
+
+    def stream():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise exceptions.ServiceUnavailable("unavailable")
+        yield "first"
+        raise exceptions.ServiceUnavailable("lost mid-stream")
+
+    received = []
+    with pytest.raises(exceptions.ServiceUnavailable, match="mid-stream"):
+        for chunk in limit.stream(stream):
+            received.append(chunk)
+
+    assert received == ["first"]
+    assert len(attempts) == 2
+    assert limit.get_stats()["active"] == 0
+
+def test_async_calls_share_the_limits():
+    limit = limiter(max_concurrency=1)
+    running = [0, 0]
+
+    async def work():
+        running[0] += 1
+        running[1] = max(running[1], running[0])
+        await asyncio.sleep(0.02)
+        running[0] -= 1
+        return "done"
+
+    async def run():
+        return await asyncio.gather(*(limit.call_async(work) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["done"] * 3
+    assert running[1] == 1
@@ -0,0 +1,38 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from common.admission import ModelLimiter
+from common.answer_cache import AnswerCache
+from common.local_rag import HashingEmbedder
+
+def test_embeddings_go_through_the_limiter():
+    limiter = ModelLimiter("embeddings", requests_per_minute=600, burst=50, max_concurrency=4)
+    cache = AnswerCache(HashingEmbedder(), threshold=0.5, limiter=limiter)
+
+    assert cache.lookup("What is Cloud Meow?", "v1") is None
+    cache.store("What is Cloud Meow?", "v1", "A cat cloud.", 1.0)
+    # The vector of the miss is reused by store(), a near-duplicate is embedded again
+    assert cache.lookup("What is Cloud Meow, please?", "v1") == "A cat cloud."
+
+    assert limiter.get_stats()["admitted"] == 2
+
+def test_rejected_embedding_only_matches_exactly():
+    # An empty bucket with no time to wait for a token sheds every call
+    limiter = ModelLimiter("embeddings", requests_per_minute=0.001, burst=0, max_concurrency=1, queue_deadline=0)
+    cache = AnswerCache(HashingEmbedder(), threshold=0.5, limiter=limiter)
+
+    cache.store("What is Cloud Meow?", "v1", "A cat cloud.", 1.0)
+    assert cache.lookup("What is Cloud Meow?", "v1") == "A cat cloud."
+    assert cache.lookup("Tell me what Cloud Meow is", "v1") is None
+    assert cache.get_stats()["embedding_failures"] == 2
@@ -0,0 +1,116 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from common.assets import AssetStore
+
+def test_legacy_models_are_found_in_the_legacy_root(tmp_path):
+    legacy = tmp_path / "static" / "models"
+    legacy.mkdir(parents=True)
+    (legacy / "default.glb").write_bytes(b"glTF default")
+    assets = AssetStore(root=str(tmp_path / "assets"), legacy_root=str(tmp_path / "static"))
+
+    found = assets.lookup("models", "default.glb")
+    assert found.path == str(legacy / "default.glb")
+    assert not found.immutable
+
+    # Content-addressed names only ever live under root
+    name = assets.put("models", b"glTF new", ".glb")
+    assert assets.lookup("models", name).path == os.path.join(str(tmp_path / "assets"), "models", name)
+    assert assets.lookup("models", "missing.glb") is None
+
+def test_put_names_assets_by_content_and_precompresses_them(tmp_path):
+    assets = AssetStore(root=str(tmp_path), legacy_root=None, compress_min_bytes=100)
+    model = b"glTF" + b"\x00" * 2000
+
+    name = assets.put("models", model, ".glb")
+    assert AssetStore.is_content_addressed(name)
+    assert assets.put("models", model, ".glb") == name
+    assert os.path.isfile(assets.path("models", name) + ".gz")
+
+    # Small files and already compressed formats get no variants
+    small = assets.put("models", b"glTF", ".glb")
+    png = assets.put("avatars", b"\x89PNG" + b"\x00" * 2000, ".png")
+    assert not os.path.exists(assets.path("models", small) + ".gz")
+    assert not os.path.exists(assets.path("avatars", png) + ".gz")
+
+def test_lookup_picks_the_variant_and_validators(tmp_path):
+    assets = AssetStore(root=str(tmp_path), legacy_root=None, compress_min_bytes=100)
+    name = assets.put("models", b"glTF" + b"\x00" * 2000, ".glb")
+    (tmp_path / "models" / (name + ".br")).write_bytes(b"brotli")
+    digest = name.split(".")[0]
+
+    plain = assets.lookup("models", name)
+    assert (plain.encoding, plain.etag, plain.mimetype) == (None, digest, "model/gltf-binary")
+    assert plain.headers()["Cache-Control"] == "public, max-age=31536000, immutable"
+
+    assert assets.lookup("models", name, "gzip, deflate").etag == digest + "-gzip"
+    assert assets.lookup("models", name, "gzip, br").encoding == "br"
+    assert assets.lookup("models", name, "br;q=0, gzip").encoding == "gzip"
+    assert assets.lookup("models", name, "gzip").headers()["Content-Encoding"] == "gzip"
+
+def test_lookup_refuses_unknown_kinds_and_unsafe_names(tmp_path):
+    assets = AssetStore(root=str(tmp_path), legacy_root=None)
+    (tmp_path / "secret.txt").write_bytes(b"secret")
+
+    assert assets.lookup("models", "../secret.txt") is None
+    assert assets.lookup("config", "secret.txt") is None
+    assert assets.lookup("models", ".hidden.glb") is None
+
+def test_legacy_names_are_revalidated_with_a_content_etag(tmp_path):
+    assets = AssetStore(root=str(tmp_path), legacy_root=None)
+    (tmp_path / "models").mkdir()
+    path = tmp_path / "models" / "cat.glb"
+    path.write_bytes(b"first")
+
+    first = assets.lookup("models", "cat.glb")
+    assert first.headers()["Cache-Control"] == "no-cache"
+    assert assets.lookup("models", "cat.glb").etag == first.etag
+
+    path.write_bytes(b"second version")
+    assert assets.lookup("models", "cat.glb").etag != first.etag
+
+def test_served_assets_answer_conditional_and_range_requests(tmp_path):
+    # The /assets route of the WSGI app
+    from flask import Flask, request, send_file
+
+    assets = AssetStore(root=str(tmp_path), legacy_root=None)
+    name = assets.put("models", b"0123456789", ".glb")
+    app = Flask(__name__)
+
+    @app.route("/assets/<kind>/<name>")
+    def asset(kind, name):
+        found = assets.lookup(kind, name, request.headers.get("Accept-Encoding"))
+        if found is None:
+            return 'Asset was not found.', 404
+        response = send_file(os.path.abspath(found.path), mimetype=found.mimetype, etag=found.etag, conditional=True)
+        response.headers.update(found.headers())
+        return response
+
+    client = app.test_client()
+    url = assets.url("models", name)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"%s"' % name.split(".")[0]
+
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    partial = client.get(url, headers={"Range": "bytes=2-5"})
+    assert partial.status_code == 206
+    assert partial.data == b"2345"
+    assert partial.headers["Content-Range"] == "bytes 2-5/10"
+
+    assert client.get("/assets/models/missing.glb").status_code == 404
@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from common import function_calling
+
+def response_with(*parts):
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=list(parts)))])
+
+def function_call_part(name, **args):
+    return SimpleNamespace(function_call=SimpleNamespace(name=name, args=args))
+
+def test_extract_function_calls_keeps_every_call_in_order():
+    response = response_with(
+        SimpleNamespace(function_call=SimpleNamespace(name="", args={})),
+        function_call_part("fc_save_model_color", color="red"),
+        function_call_part("fc_show_my_avatar"),
+    )
+
+    assert function_calling.extract_function_calls(response) == [
+        ("fc_save_model_color", {"color": "red"}),
+        ("fc_show_my_avatar", {}),
+    ]
+    assert function_calling.extract_function_calls(SimpleNamespace(candidates=[])) == []
+
+class Service:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.colors = []
+
+    def fc_save_model_color(self, user_id, color):
+        with self.lock:
+            self.colors.append(color)
+        return "Saved " + color, "<p>%s</p>" % color
+
+    def fc_show_my_avatar(self, user_id):
+        return "Here it is"
+
+    def fc_broken(self, user_id):
+        raise ValueError("boom")
+
+def test_call_functions_returns_one_result_per_call():
+    service = Service()
+    calls = [
+        ("fc_save_model_color", {"user_id": "u", "color": "red"}),
+        ("fc_show_my_avatar", {"user_id": "u"}),
+        ("fc_save_model_color", {"user_id": "u", "color": "blue"}),
+        ("fc_broken", {"user_id": "u"}),
+    ]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = function_calling.call_functions(service, calls, executor)
+
+    assert results == [
+        ("Saved red", "<p>red</p>"),
+        ("Here it is", ""),
+        ("Saved blue", "<p>blue</p>"),
+        ("Unable to retrieve data from external source", ""),
+    ]
+    # Calls to the same function run in order
+    assert service.colors == ["red", "blue"]
+
+class AvatarService:
+    ORDERED_FUNCTIONS = frozenset(["fc_generate_avatar", "fc_create_3d_model_from_avatar"])
+
+    def __init__(self):
+        self.events = []
+        self.generating = threading.Event()
+
+    def fc_generate_avatar(self, user_id, description):
+        self.generating.set()
+        time.sleep(0.05)
+        self.events.append("avatar")
+        return "Generated"
+
+    def fc_create_3d_model_from_avatar(self, user_id):
+        self.events.append("model from " + ("avatar" if "avatar" in self.events else "nothing"))
+        return "Created"
+
+    def fc_rag_retrieval(self, user_id, question_passthrough):
+        # Runs next to the avatar calls
+        return "Concurrent" if self.generating.wait(5) else "Blocked"
+
+AVATAR_CALLS = [
+    ("fc_create_3d_model_from_avatar", {"user_id": "u"}),
+    ("fc_rag_retrieval", {"user_id": "u", "question_passthrough": "?"}),
+    ("fc_generate_avatar", {"user_id": "u", "description": "a cat"}),
+]
+
+def test_ordered_functions_run_in_the_order_of_the_response():
+    service = AvatarService()
+    calls = [AVATAR_CALLS[2], AVATAR_CALLS[1], AVATAR_CALLS[0]]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = function_calling.call_functions(service, calls, executor)
+
+    assert service.events == ["avatar", "model from avatar"]
+    assert [response for response, _ in results] == ["Generated", "Concurrent", "Created"]
+    assert function_calling.group_calls(service, AVATAR_CALLS) == [[0, 2], [1]]
+
+def test_ordered_functions_run_in_order_async():
+    service = AvatarService()
+
+    class AsyncService:
+        ORDERED_FUNCTIONS = service.ORDERED_FUNCTIONS
+
+        def __getattr__(self, name):
+            async def call(**params):
+                return await asyncio.to_thread(getattr(service, name), **params)
+            return call
+
+    results = asyncio.run(function_calling.call_functions_async(AsyncService(), [AVATAR_CALLS[2], AVATAR_CALLS[0]]))
+
+    assert service.events == ["avatar", "model from avatar"]
+    assert [response for response, _ in results] == ["Generated", "Created"]
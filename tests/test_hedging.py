@@ -0,0 +1,147 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from common.hedging import Hedger
+
+class Upstream:
+    """
+    Answers with the latencies given, one per request, then instantly.
+    """
+
+    def __init__(self, *latencies, errors=()):
+        self.latencies = list(latencies)
+        self.errors = set(errors)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def next_request(self):
+        with self.lock:
+            number = self.requests
+            self.requests += 1
+        return number, self.latencies[number] if number < len(self.latencies) else 0
+
+    def call(self, value):
+        number, latency = self.next_request()
+        time.sleep(latency)
+        if number in self.errors:
+            raise OSError("request %d failed" % number)
+        return "%s from request %d" % (value, number)
+
+    async def call_async(self, value):
+        number, latency = self.next_request()
+        await asyncio.sleep(latency)
+        if number in self.errors:
+            raise OSError("request %d failed" % number)
+        return "%s from request %d" % (value, number)
+
+def hedger(**options):
+    # Every call may be hedged after 50 ms
+    return Hedger(**dict(dict(initial_delay=0.05, min_samples=1000, max_extra_ratio=1), **options))
+
+def test_fast_call_is_not_hedged():
+    upstream = Upstream(0)
+    hedging = hedger()
+
+    assert hedging.call(upstream.call, "answer") == "answer from request 0"
+    assert upstream.requests == 1
+    assert hedging.get_stats()["hedges_fired"] == 0
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    upstream = Upstream(2, 0)
+    hedging = hedger()
+
+    started = time.monotonic()
+    assert hedging.call(upstream.call, "answer") == "answer from request 1"
+    assert time.monotonic() - started < 1
+
+    stats = hedging.get_stats()
+    assert (stats["hedges_fired"], stats["hedges_won"]) == (1, 1)
+
+def test_failed_call_is_rescued_by_its_hedge():
+    upstream = Upstream(0.1, 0.2, errors=[0])
+    hedging = hedger()
+
+    assert hedging.call(upstream.call, "answer") == "answer from request 1"
+    assert hedging.get_stats()["failures_rescued"] == 1
+
+def test_error_is_raised_once_both_requests_failed():
+    upstream = Upstream(0.1, 0.1, errors=[0, 1])
+
+    with pytest.raises(OSError):
+        hedger().call(upstream.call, "answer")
+
+def test_hedges_are_capped_by_the_budget():
+    # One hedge per two calls, the first call is not allowed one yet
+    upstream = Upstream(0.1, 0.1, 0)
+    hedging = hedger(max_extra_ratio=0.5)
+
+    hedging.call(upstream.call, "first")
+    hedging.call(upstream.call, "second")
+
+    stats = hedging.get_stats()
+    assert (stats["calls"], stats["hedges_fired"], stats["hedges_skipped_budget"]) == (2, 1, 1)
+
+def test_calls_are_not_capped_by_the_hedge_workers():
+    upstream = Upstream(*[0.2] * 8)
+    # Slower than every call, nothing is hedged
+    hedging = hedger(initial_delay=5, workers=2)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=8) as callers:
+        results = list(callers.map(lambda number: hedging.call(upstream.call, number), range(8)))
+
+    assert len(results) == 8
+    # All 8 ran at once, not 2 at a time
+    assert time.monotonic() - started < 0.6
+
+def test_hedge_is_skipped_when_the_workers_are_busy():
+    upstream = Upstream(0.3, 0.3, 0.3, 0.3)
+    hedging = hedger(workers=1)
+
+    with ThreadPoolExecutor(max_workers=2) as callers:
+        list(callers.map(lambda number: hedging.call(upstream.call, number), range(2)))
+
+    stats = hedging.get_stats()
+    assert (stats["hedges_fired"], stats["hedges_skipped_busy"]) == (1, 1)
+    # The losing hedge frees its worker once it is done
+    time.sleep(0.2)
+    assert hedging.running_hedges == 0
+
+def test_delay_follows_the_recent_latencies():
+    hedging = Hedger(percentile=50, initial_delay=5, min_delay=0.01, min_samples=3)
+    assert hedging.hedge_delay() == 5
+
+    for latency in (0.1, 0.2, 0.3):
+        hedging._record(latency)
+    assert hedging.hedge_delay() == 0.2
+
+def test_async_hedge_wins_and_the_loser_is_cancelled():
+    upstream = Upstream(2, 0)
+    hedging = hedger()
+
+    async def call():
+        result = await hedging.call_async(upstream.call_async, "answer")
+        # Only this task is left, the slow primary was cancelled
+        await asyncio.sleep(0)
+        return result, len(asyncio.all_tasks())
+
+    assert asyncio.run(call()) == ("answer from request 1", 1)
+    assert hedging.get_stats()["hedges_won"] == 1
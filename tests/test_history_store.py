@@ -0,0 +1,161 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import pytest
+
+from common.history_store import (
+    HistoryStore, InMemoryHistoryBackend, RedisHistoryBackend, RespConnection, RespError, SQLiteHistoryBackend)
+from tests.resp_server import FakeRedisServer
+
+class TextCodec:
+    # Turns are plain strings here, the real codec needs vertexai
+    def encode(self, content):
+        return content.encode('utf-8')
+
+    def decode(self, record):
+        return record.decode('utf-8')
+
+@pytest.fixture
+def redis_server():
+    server = FakeRedisServer()
+    yield server
+    server.close()
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryHistoryBackend()
+    if request.param == "sqlite":
+        return SQLiteHistoryBackend(str(tmp_path / "history.db"))
+    server = request.getfixturevalue("redis_server")
+    return RedisHistoryBackend(RespConnection("127.0.0.1", server.port), ttl_seconds=60)
+
+def test_backend_append_load_length(backend):
+    backend.append("user", [b"one", b"two"])
+    backend.append("user", [b"three"])
+
+    assert backend.load("user") == [b"one", b"two", b"three"]
+    assert backend.length("user") == 3
+    assert backend.load("other") == []
+    assert backend.length("other") == 0
+
+def test_backend_replace_and_clear(backend):
+    backend.append("user", [b"one", b"two", b"three"])
+
+    backend.replace("user", [b"summary"])
+    assert backend.load("user") == [b"summary"]
+    assert backend.length("user") == 1
+
+    backend.replace("user", [])
+    assert backend.length("user") == 0
+
+    backend.append("user", [b"one"])
+    backend.clear("user")
+    assert backend.load("user") == []
+
+def test_store_round_trip(backend):
+    store = HistoryStore(backend, codec=TextCodec())
+
+    history = ["hello", "hi"]
+    store.save("user", history)
+    history += ["color?", "blue"]
+    store.save("user", history)
+
+    assert backend.length("user") == 4
+    assert HistoryStore(backend, codec=TextCodec()).load("user") == history
+
+    # A history that got shorter is rewritten
+    store.save("user", ["summary", "blue"])
+    assert store.load("user") == ["summary", "blue"]
+
+    store.replace("user", ["compacted"])
+    assert store.length("user") == 1
+    assert store.load("user") == ["compacted"]
+
+def test_lost_append_reply_is_not_sent_again(redis_server):
+    backend = RedisHistoryBackend(RespConnection("127.0.0.1", redis_server.port))
+    store = HistoryStore(backend, codec=TextCodec())
+    store.save("user", ["hello", "hi"])
+
+    # The server applies the RPUSH but the reply never arrives
+    redis_server.lose_next_reply = True
+    with pytest.raises((OSError, EOFError)):
+        store.save("user", ["hello", "hi", "color?", "blue"])
+    assert backend.length("user") == 4
+
+    # The next save reads the length again instead of appending the same turns twice
+    store.save("user", ["hello", "hi", "color?", "blue", "thanks"])
+    assert store.load("user") == ["hello", "hi", "color?", "blue", "thanks"]
+
+def test_lost_read_reply_is_sent_again(redis_server):
+    connection = RespConnection("127.0.0.1", redis_server.port)
+    backend = RedisHistoryBackend(connection)
+    backend.append("user", [b"one"])
+
+    redis_server.lose_next_reply = True
+    assert backend.length("user") == 1
+
+def test_connection_closed_while_idle_is_replaced(redis_server):
+    backend = RedisHistoryBackend(RespConnection("127.0.0.1", redis_server.port))
+    backend.append("user", [b"one"])
+
+    redis_server.close_connections()
+    backend.append("user", [b"two"])
+
+    assert backend.load("user") == [b"one", b"two"]
+    assert redis_server.commands.count("RPUSH") == 2
+
+def test_sqlite_appends_of_several_workers_get_their_own_seq(tmp_path):
+    path = str(tmp_path / "history.db")
+    errors = []
+
+    def worker(number):
+        # Every worker process has its own connection
+        backend = SQLiteHistoryBackend(path)
+        try:
+            for i in range(50):
+                backend.append("user", [b"%d-%d" % (number, i)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    records = SQLiteHistoryBackend(path).load("user")
+    assert len(records) == 200
+    for number in range(4):
+        assert [record for record in records if record.startswith(b"%d-" % number)] == [b"%d-%d" % (number, i) for i in range(50)]
+
+def test_failed_auth_does_not_leave_the_connection_open():
+    server = FakeRedisServer(password="secret")
+    try:
+        connection = RespConnection("127.0.0.1", server.port, password="wrong")
+        with pytest.raises(RespError, match="WRONGPASS"):
+            connection.execute("LLEN", "user")
+        assert connection.sock is None and connection.reader is None
+
+        # Nothing is sent on an unauthenticated connection, every command authenticates again
+        with pytest.raises(RespError, match="WRONGPASS"):
+            connection.execute("LLEN", "user")
+
+        connection.password = "secret"
+        assert connection.execute("LLEN", "user") == 0
+    finally:
+        server.close()
@@ -0,0 +1,76 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from common.intent_router import IntentRouter, tokenize
+from services.user import User
+
+ROUTED = ["fc_show_my_avatar", "fc_show_my_model", "fc_generate_avatar"]
+
+@pytest.fixture
+def router():
+    return IntentRouter(User.get_function_declarations(), ROUTED, {"fc_show_my_avatar": "Here it is."})
+
+def test_tokenize_drops_stopwords_and_maps_synonyms():
+    assert tokenize("Please display my Character!") == ["show", "model"]
+
+@pytest.mark.parametrize("prompt, function_name", [
+    ("show my avatar", "fc_show_my_avatar"),
+    ("Show me my avatar please", "fc_show_my_avatar"),
+    ("display my profile picture", "fc_show_my_avatar"),
+    ("show my character", "fc_show_my_model"),
+    ("view my 3d model", "fc_show_my_model"),
+])
+def test_trivial_commands_are_routed(router, prompt, function_name):
+    assert router.route(prompt) == (function_name, 1.0)
+
+@pytest.mark.parametrize("prompt", [
+    # More than the command, the model has to see it
+    "show my avatar wearing a hat",
+    "what is the price of the avatar storage plan",
+    # Needs a description, generate_avatar has required parameters and is never routed
+    "generate avatar",
+    "",
+    "please",
+])
+def test_other_prompts_fall_back_to_the_model(router, prompt):
+    assert router.route(prompt) is None
+
+def test_confidence_threshold(router):
+    # 2 of 2 name words, 2 of 3 prompt words
+    assert router.route("show avatar quickly") is None
+
+    lenient = IntentRouter(User.get_function_declarations(), ROUTED, {}, threshold=0.6)
+    function_name, confidence = lenient.route("show avatar quickly")
+    assert function_name == "fc_show_my_avatar"
+    assert confidence == pytest.approx(2 / 3)
+
+def test_stats_and_replies(router):
+    router.route("show my avatar")
+    router.route("tell me about Cloud Meow")
+
+    assert router.get_stats() == {"routed": 1, "fallbacks": 1, "llm_calls_avoided": 2}
+    assert router.reply_for("fc_show_my_avatar") == "Here it is."
+    assert router.reply_for("fc_show_my_model") == "There you go."
+
+def test_history_turns_look_like_a_function_calling_turn():
+    turns = IntentRouter.history_turns("show my avatar", "fc_show_my_avatar", "Showing the avatar", "Here it is.")
+
+    assert [turn.role for turn in turns] == ["user", "model", "user", "model"]
+    assert turns[0].parts[0].text == "show my avatar"
+    assert turns[1].parts[0].function_call.name == "fc_show_my_avatar"
+    assert turns[2].parts[0].function_response.name == "fc_show_my_avatar"
+    assert turns[2].parts[0].function_response.response["content"] == "Showing the avatar"
+    assert turns[3].parts[0].text == "Here it is."
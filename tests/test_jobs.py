@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from common.jobs import JobScheduler
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_local_jobs_are_forgotten_without_polled_jobs():
+    scheduler = JobScheduler(retention=0.1, workers=2)
+    scheduler.start()
+    try:
+        jobs = [scheduler.run("job-%d" % i, "avatar", lambda job: "done") for i in range(3)]
+        wait_until(lambda: all(job.status == "finished" for job in jobs))
+        assert scheduler.get("job-0").result == "done"
+
+        # Only the scheduler thread waking up on its own forgets them
+        wait_until(lambda: not scheduler.jobs)
+    finally:
+        scheduler.stop()
+
+def test_local_jobs_are_forgotten_when_more_are_run():
+    scheduler = JobScheduler(retention=0.05, workers=2)
+    try:
+        first = scheduler.run("first", "avatar", lambda job: "done")
+        wait_until(lambda: first.status == "finished")
+        time.sleep(0.1)
+
+        scheduler.run("second", "avatar", lambda job: "done")
+        assert scheduler.get("first") is None
+    finally:
+        scheduler.stop()
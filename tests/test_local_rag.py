@@ -0,0 +1,162 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from common.local_rag import HashingEmbedder, LocalRAG, chunk_text, read_document
+
+PAGES = [
+    "Cloud Meow is a cat themed cloud provider. Its mascot is an orange cat called Nimbus.",
+    "Cloud Meow storage keeps every file in three regions. Backups run every night at midnight.",
+    "Support is open every day. Ask the purr desk for help with billing and invoices.",
+]
+
+def write_pdf(path, pages):
+    # A minimal PDF with one line of Helvetica text per page, enough for pypdf to extract
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = "BT /F1 10 Tf 20 700 Td (%s) Tj ET" % text
+        objects.append("<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       "/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append("%d 0 R" % len(objects))
+    objects[1] = "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(kids), len(kids))
+
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body.encode("latin-1"))
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+    with open(path, mode='wb') as file:
+        file.write(output)
+
+class Config:
+    def __init__(self, **rag):
+        self.rag = rag
+
+    def get_property(self, section, key):
+        assert section == 'rag'
+        return self.rag[key]
+
+class CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.embedded = 0
+
+    def embed(self, texts):
+        self.embedded += len(texts)
+        return super().embed(texts)
+
+def local_config(tmp_path, chunk_size=12):
+    return Config(
+        local_paths=str(tmp_path / "cloudmeow.pdf"),
+        local_index_dir=str(tmp_path / "index"),
+        local_chunk_size=str(chunk_size),
+        local_chunk_overlap="4",
+        local_top_k="2",
+        local_min_score="0.05",
+        sync_retry_initial_seconds="1",
+        sync_retry_max_seconds="1",
+    )
+
+def test_chunk_text_overlaps():
+    words = " ".join("w%d" % i for i in range(10))
+
+    assert chunk_text(words, 4, 1) == ["w0 w1 w2 w3", "w3 w4 w5 w6", "w6 w7 w8 w9"]
+    assert chunk_text("", 4, 1) == []
+
+def test_index_is_built_and_retrieves_top_k(tmp_path):
+    write_pdf(str(tmp_path / "cloudmeow.pdf"), PAGES)
+    assert "Nimbus" in read_document(str(tmp_path / "cloudmeow.pdf"))
+
+    engine = LocalRAG(local_config(tmp_path), embedder=HashingEmbedder(), background=False)
+
+    assert engine.is_ready()
+    index = tmp_path / "index"
+    manifest = json.loads((index / "current.json").read_text())
+    assert sorted(os.listdir(str(index))) == ["current.json", manifest["directory"]]
+    assert sorted(os.listdir(str(index / manifest["directory"]))) == ["chunks.json", "embeddings.npy"]
+    matrix = np.load(str(index / manifest["directory"] / "embeddings.npy"))
+    assert matrix.shape == (len(engine.chunks), 1024)
+    assert len(engine.chunks) > len(PAGES)
+
+    chunks = engine.retrieve("When do the backups run?")
+    assert 1 <= len(chunks) <= 2
+    assert "Backups run" in chunks[0]["text"]
+    assert chunks[0]["source"] == "cloudmeow.pdf"
+    assert chunks == sorted(chunks, key=lambda chunk: -chunk["score"])
+
+    assert "Backups run" in engine.augment_prompt("When do the backups run?")
+
+def test_index_is_only_rebuilt_when_its_fingerprint_changes(tmp_path):
+    write_pdf(str(tmp_path / "cloudmeow.pdf"), PAGES)
+    embedder = CountingEmbedder()
+
+    first = LocalRAG(local_config(tmp_path), embedder=embedder, background=False)
+    built = embedder.embedded
+
+    # Same documents and settings, e.g. another worker starting: the index is reused
+    second = LocalRAG(local_config(tmp_path), embedder=embedder, background=False)
+    assert embedder.embedded == built
+    assert second.version == first.version
+
+    # A changed document is embedded again
+    write_pdf(str(tmp_path / "cloudmeow.pdf"), PAGES + ["The purr desk also answers questions about Nimbus."])
+    third = LocalRAG(local_config(tmp_path), embedder=embedder, background=False)
+    assert embedder.embedded > built
+    assert third.version != first.version
+    assert len(third.chunks) > len(first.chunks)
+
+    # So are changed chunking settings
+    rebuilt = embedder.embedded
+    fourth = LocalRAG(local_config(tmp_path, chunk_size=20), embedder=embedder, background=False)
+    assert embedder.embedded > rebuilt
+    assert fourth.version != third.version
+
+    # Only the published build is kept
+    assert len(os.listdir(str(tmp_path / "index"))) == 2
+
+def test_workers_building_at_once_publish_a_single_index(tmp_path):
+    write_pdf(str(tmp_path / "cloudmeow.pdf"), PAGES)
+    engines = []
+    errors = []
+
+    def worker():
+        try:
+            engines.append(LocalRAG(local_config(tmp_path), embedder=HashingEmbedder(), background=False))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(set(engine.version for engine in engines)) == 1
+    for engine in engines:
+        assert "Backups run" in engine.retrieve("When do the backups run?")[0]["text"]
+    # Temporary files are gone, at most the builds that lost the race are left behind
+    assert not [name for name in os.listdir(str(tmp_path / "index")) if name.endswith(".tmp")]
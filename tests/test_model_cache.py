@@ -0,0 +1,118 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+from models import model
+from services.model_cache import ModelCache
+
+class FakeWatch:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def unsubscribe(self):
+        self.collection.callbacks.clear()
+
+class FakeModelsCollection:
+    """
+    Stands in for the Firestore models collection, the snapshots are sent by the test.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def on_snapshot(self, callback):
+        self.callbacks.append(callback)
+        return FakeWatch(self)
+
+    def send(self, *changes):
+        # changes are (ADDED|MODIFIED|REMOVED, document data)
+        document_changes = [
+            SimpleNamespace(type=SimpleNamespace(name=kind), document=SimpleNamespace(to_dict=lambda data=data: data))
+            for kind, data in changes
+        ]
+        for callback in list(self.callbacks):
+            callback([], document_changes, None)
+
+def model_data(user_id, color):
+    return {"user_id": user_id, "original_material": "fur", "model": user_id + ".glb", "color": color}
+
+def test_snapshot_updates_cached_model():
+    cache = ModelCache()
+    collection = FakeModelsCollection()
+    cache.start_watch(collection)
+    cache.put("alice", model.Model.from_dict(model_data("alice", "red")))
+
+    collection.send(("MODIFIED", model_data("alice", "blue")))
+
+    assert cache.get("alice").color == "blue"
+    assert cache.get_stats()["snapshot_updates"] == 1
+
+def test_snapshot_removal_invalidates_cached_model():
+    cache = ModelCache()
+    collection = FakeModelsCollection()
+    cache.start_watch(collection)
+    cache.put("alice", model.Model.from_dict(model_data("alice", "red")))
+
+    collection.send(("REMOVED", model_data("alice", "red")))
+
+    assert cache.get("alice") is None
+
+def test_snapshot_of_uncached_model_is_not_kept():
+    cache = ModelCache()
+    collection = FakeModelsCollection()
+    cache.start_watch(collection)
+
+    # The first snapshot lists the whole collection
+    collection.send(("ADDED", model_data("alice", "red")), ("ADDED", model_data("bob", "green")))
+
+    assert cache.get_stats()["entries"] == 0
+
+def test_stop_watch_unsubscribes():
+    cache = ModelCache()
+    collection = FakeModelsCollection()
+    cache.start_watch(collection)
+    cache.put("alice", model.Model.from_dict(model_data("alice", "red")))
+
+    cache.stop_watch()
+    collection.send(("MODIFIED", model_data("alice", "blue")))
+
+    assert cache.get("alice").color == "red"
+
+def test_models_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("services.model_cache.time.monotonic", lambda: now[0])
+    cache = ModelCache(ttl=30)
+    cache.put("alice", model.Model.from_dict(model_data("alice", "red")))
+
+    now[0] += 20
+    # A write of this process does not make the rest of the model any fresher
+    cache.update("alice", {"color": "blue"})
+    assert cache.get("alice").color == "blue"
+
+    now[0] += 10
+    assert cache.get("alice") is None
+    assert cache.get_stats()["expirations"] == 1
+
+    # Read again, it is kept for another ttl
+    cache.put("alice", model.Model.from_dict(model_data("alice", "green")))
+    now[0] += 29
+    assert cache.get("alice").color == "green"
+
+def test_ttl_of_zero_keeps_models():
+    cache = ModelCache(ttl=0)
+    cache.put("alice", model.Model.from_dict(model_data("alice", "red")))
+
+    assert cache.get("alice").color == "red"
+    assert cache.get_stats()["expirations"] == 0
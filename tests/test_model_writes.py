@@ -0,0 +1,146 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from models import model
+from services.model_writes import ModelWriteBuffer
+from tests.firestore_fake import FakeFirestore
+
+def buffer_for(users, **options):
+    db = FakeFirestore()
+    for user_id in users:
+        db.add_model(user_id)
+    dropped = []
+    buffer = ModelWriteBuffer(db, on_drop=dropped.append, **options)
+    # Queued until flush() is called, as if the flush thread was running
+    buffer.thread = object()
+    return db, buffer, dropped
+
+def test_updates_are_merged_per_user_and_written_in_one_batch():
+    db, buffer, _ = buffer_for(["alice", "bob"])
+
+    buffer.update("alice", {"color": "blue"})
+    buffer.update("alice", {"color": "green", "original_material": False})
+    buffer.update("bob", {"color": "pink"})
+    assert buffer.pending_fields("alice") == {"color": "green", "original_material": False}
+
+    buffer.flush()
+
+    assert db.commits == [["doc-alice", "doc-bob"]]
+    assert db.documents["doc-alice"]["color"] == "green"
+    assert db.documents["doc-bob"]["color"] == "pink"
+    assert buffer.pending_fields("alice") == {}
+    stats = buffer.get_stats()
+    assert (stats["updates"], stats["merged"], stats["writes"]) == (3, 1, 2)
+
+def test_references_are_looked_up_once():
+    db, buffer, _ = buffer_for(["alice"])
+
+    buffer.update("alice", {"color": "blue"})
+    buffer.update("alice", {"color": "green"})
+
+    assert db.queries == 1
+    assert not buffer.update("nobody", {"color": "blue"})
+
+def test_missing_document_only_drops_its_own_update():
+    users = ["user%d" % i for i in range(8)]
+    db, buffer, dropped = buffer_for(users)
+    for user_id in users:
+        buffer.update(user_id, {"color": "blue"})
+
+    # Deleted after its reference was looked up
+    del db.documents["doc-user5"]
+    buffer.flush()
+
+    assert dropped == ["user5"]
+    for user_id in users:
+        if user_id != "user5":
+            assert db.documents["doc-" + user_id]["color"] == "blue"
+    assert buffer.get_stats()["dropped"] == 1
+    assert buffer.get_stats()["writes"] == 7
+    # The next update of the user looks the document up again
+    assert buffer.references_for(["user5"]) == {}
+
+def test_failed_batch_is_retried_then_dropped():
+    db, buffer, dropped = buffer_for(["alice"], max_attempts=2)
+    buffer.update("alice", {"color": "blue"})
+
+    db.fail_next_commits = 1
+    buffer.flush()
+    assert buffer.pending_fields("alice") == {"color": "blue"}
+
+    # A newer update made while the write was failing wins over the failed one
+    buffer.update("alice", {"color": "green"})
+    db.fail_next_commits = 1
+    buffer.flush()
+    assert dropped == ["alice"]
+    assert db.documents["doc-alice"]["color"] == "red"
+
+def test_requeued_fields_keep_newer_updates():
+    db, buffer, dropped = buffer_for(["alice"])
+    buffer.update("alice", {"color": "blue", "model": "old.glb"})
+
+    db.fail_next_commits = 1
+    buffer.flush()
+    buffer.update("alice", {"color": "green"})
+    buffer.flush()
+
+    assert dropped == []
+    assert db.documents["doc-alice"]["color"] == "green"
+    assert db.documents["doc-alice"]["model"] == "old.glb"
+
+def test_references_are_bounded_but_kept_while_updates_are_pending():
+    db, buffer, _ = buffer_for([], max_references=2)
+
+    for user_id in ["alice", "bob", "carol"]:
+        buffer.remember(user_id, db.collection("models").document("doc-" + user_id))
+    assert list(buffer.references) == ["bob", "carol"]
+    assert buffer.get_stats()["references_evicted"] == 1
+
+    db.add_model("bob")
+    buffer.update("bob", {"color": "blue"})
+    buffer.remember("dave", db.collection("models").document("doc-dave"))
+    buffer.remember("erin", db.collection("models").document("doc-erin"))
+
+    # Bob's update is still waiting for the flush, his reference is not evicted before it is written
+    assert "bob" in buffer.references
+    assert len(buffer.references) == 2
+    buffer.flush()
+    assert db.documents["doc-bob"]["color"] == "blue"
+
+def test_background_flushes_write_the_latest_fields_in_order():
+    db = FakeFirestore()
+    db.add_model("alice", original_material=True, model="cat.glb")
+    buffer = ModelWriteBuffer(db, flush_interval=0.01)
+    buffer.start()
+
+    for color in ["blue", "green", "pink"]:
+        buffer.update("alice", {"color": color})
+        # Reads see the update before it is written
+        assert buffer.apply("alice", model.Model.from_dict(db.documents["doc-alice"])).color == color
+
+    buffer.stop()
+
+    assert db.documents["doc-alice"]["color"] == "pink"
+    assert buffer.pending_fields("alice") == {}
+    assert buffer.get_stats()["pending"] == 0
+
+def test_unstarted_buffer_writes_right_away():
+    db = FakeFirestore()
+    db.add_model("alice")
+    buffer = ModelWriteBuffer(db)
+
+    buffer.update("alice", {"color": "blue"})
+
+    assert db.documents["doc-alice"]["color"] == "blue"
+    assert db.commits == [["doc-alice"]]
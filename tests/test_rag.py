@@ -0,0 +1,108 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from common import rag as rag_module
+from common.rag import RAG
+
+PATH = "gs://bucket/CloudMeow.pdf"
+CORPUS = "projects/p/locations/l/ragCorpora/1"
+START = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+class FakeVertexRag:
+    """
+    The corpus side of vertexai.preview.rag: one corpus whose RagFiles are created by import_files.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.calls = []
+        self.now = START
+        self.created = 0
+
+    def list_corpora(self):
+        return [SimpleNamespace(name=CORPUS, display_name="corpus")]
+
+    def list_files(self, corpus_name):
+        return list(self.files.values())
+
+    def import_files(self, corpus_name, paths, chunk_size, chunk_overlap):
+        self.calls.append(("import", list(paths)))
+        for path in paths:
+            self.created += 1
+            name = "%s/ragFiles/%d" % (CORPUS, self.created)
+            self.files[name] = SimpleNamespace(name=name, gcs_source=SimpleNamespace(uris=[path]), create_time=self.now)
+
+    def delete_file(self, name):
+        self.calls.append(("delete", name))
+        del self.files[name]
+
+class Config:
+    def __init__(self, manifest_path):
+        self.rag = {
+            "corpus_name": "corpus",
+            "paths": PATH,
+            "sync_mode": "incremental",
+            "manifest_path": manifest_path,
+            "sync_retry_initial_seconds": "1",
+            "sync_retry_max_seconds": "1",
+        }
+
+    def get_property(self, section, key):
+        assert section == 'rag'
+        return self.rag[key]
+
+@pytest.fixture
+def vertex_rag(monkeypatch):
+    fake = FakeVertexRag()
+    for name in ("list_corpora", "list_files", "import_files", "delete_file"):
+        monkeypatch.setattr(rag_module.rag, name, getattr(fake, name))
+    return fake
+
+@pytest.fixture
+def source(monkeypatch):
+    blob = SimpleNamespace(md5_hash="v1", crc32c=None, updated=START - timedelta(hours=1))
+    monkeypatch.setattr(RAG, "_source_blob", staticmethod(lambda path: blob))
+    return blob
+
+def fresh_instance(tmp_path, vertex_rag):
+    # Every instance starts without the manifest, as on Cloud Run
+    vertex_rag.now += timedelta(hours=1)
+    return RAG(Config(str(tmp_path / ("manifest-%s.json" % vertex_rag.now.hour))), background=False)
+
+def test_fresh_instance_adopts_an_unchanged_file(tmp_path, vertex_rag, source):
+    first = fresh_instance(tmp_path, vertex_rag)
+    assert vertex_rag.calls == [("import", [PATH])]
+
+    second = fresh_instance(tmp_path, vertex_rag)
+
+    assert vertex_rag.calls == [("import", [PATH])]
+    assert second.files == first.files
+    assert second.is_ready()
+
+def test_fresh_instance_imports_a_source_changed_since_the_import(tmp_path, vertex_rag, source):
+    first = fresh_instance(tmp_path, vertex_rag)
+
+    source.md5_hash, source.updated = "v2", vertex_rag.now + timedelta(minutes=10)
+    second = fresh_instance(tmp_path, vertex_rag)
+
+    # The new version is imported before the old one is deleted
+    old_file = CORPUS + "/ragFiles/" + first.files[0]
+    assert vertex_rag.calls[1:] == [("import", [PATH]), ("delete", old_file)]
+    assert second.files != first.files
+    assert list(vertex_rag.files) == [CORPUS + "/ragFiles/" + second.files[0]]
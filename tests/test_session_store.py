@@ -0,0 +1,112 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from common.session_store import SessionStore
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("common.session_store.time.monotonic", lambda: now[0])
+    return now
+
+def store(**options):
+    evicted = []
+    # Turns are strings here, sized by their length
+    sessions = SessionStore(size_of=len, on_evict=evicted.append, **options)
+    return sessions, evicted
+
+def test_sessions_and_histories_are_kept():
+    sessions, evicted = store()
+
+    assert sessions.get_session("alice") is None
+    sessions.put("alice", "session", ["hello", "hi"])
+
+    assert sessions.get_session("alice") == "session"
+    assert sessions.get_history("alice") == ["hello", "hi"]
+    stats = sessions.get_stats()
+    assert (stats["hits"], stats["misses"], stats["history_bytes"]) == (1, 1, 7)
+    assert evicted == []
+
+def test_idle_sessions_expire_on_access_and_in_the_sweep(clock):
+    sessions, evicted = store(idle_ttl=60)
+    sessions.put("alice", "session", ["hello"])
+    sessions.put("bob", "session", ["hi"])
+
+    clock[0] += 30
+    assert sessions.get_session("bob") == "session"
+
+    clock[0] += 31
+    assert sessions.get_session("alice") is None
+    assert evicted == ["alice"]
+
+    clock[0] += 30
+    sessions.sweep()
+    assert evicted == ["alice", "bob"]
+    assert sessions.get_stats()["evictions_idle"] == 2
+    assert sessions.get_stats()["history_bytes"] == 0
+
+def test_least_recently_used_session_is_evicted():
+    sessions, evicted = store(max_sessions=2)
+    sessions.put("alice", "session", [])
+    sessions.put("bob", "session", [])
+    sessions.get_session("alice")
+
+    sessions.put("carol", "session", [])
+
+    assert evicted == ["bob"]
+    assert sessions.get_stats()["evictions_lru"] == 1
+
+def test_histories_are_capped_in_bytes():
+    sessions, evicted = store(max_history_bytes=10)
+    sessions.put("alice", "session", ["12345"])
+    sessions.put("bob", "session", ["1234"])
+
+    # Bob's history grows in place, only the new turns are sized
+    history = sessions.get_history("bob")
+    history.append("12")
+    sessions.update_history("bob", history)
+
+    assert evicted == ["alice"]
+    assert sessions.get_stats()["history_bytes"] == 6
+
+    # The most recently used session stays even when it is over the cap alone
+    history.append("1234567890")
+    sessions.update_history("bob", history)
+    assert sessions.get_history("bob") == history
+    assert sessions.get_stats()["evictions_memory"] == 1
+
+def test_replaced_and_shortened_histories_are_sized_again():
+    sessions, _ = store()
+    sessions.put("alice", "session", ["12345", "12345"])
+
+    # E.g. compacted into a summary
+    sessions.update_history("alice", ["123", "12"])
+    assert sessions.get_stats()["history_bytes"] == 5
+
+    # Or shortened in place
+    history = sessions.get_history("alice")
+    history[:] = ["1"]
+    sessions.update_history("alice", history)
+    assert sessions.get_stats()["history_bytes"] == 1
+
+def test_reset_sessions_keeps_histories():
+    sessions, _ = store()
+    sessions.put("alice", "session", ["hello"])
+
+    sessions.reset_sessions()
+
+    assert sessions.get_session("alice") is None
+    assert sessions.get_history("alice") == ["hello"]
@@ -0,0 +1,142 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from common.single_flight import SingleFlight, SingleFlightTimeout
+
+class Upstream:
+    def __init__(self, error=None):
+        self.calls = 0
+        self.release = threading.Event()
+        self.error = error
+
+    def call(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return "answer to " + value
+
+def run_callers(single_flight, upstream, count, key=("rag", "question")):
+    results = [None] * count
+
+    def caller(number):
+        try:
+            results[number] = single_flight.do(key, upstream.call, "question")
+        except BaseException as e:
+            results[number] = e
+
+    threads = [threading.Thread(target=caller, args=(number,)) for number in range(count)]
+    for thread in threads:
+        thread.start()
+    # Every caller joined the flight before it lands
+    deadline = time.monotonic() + 5
+    while single_flight.get_stats()["calls"] < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    upstream.release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_concurrent_identical_calls_are_merged():
+    single_flight = SingleFlight()
+    upstream = Upstream()
+
+    results = run_callers(single_flight, upstream, 5)
+
+    assert results == ["answer to question"] * 5
+    assert upstream.calls == 1
+    stats = single_flight.get_stats()
+    assert (stats["calls"], stats["merged"], stats["in_flight"]) == (5, 4, 0)
+    assert stats["merged_by_kind"] == {"rag": 4}
+
+def test_nothing_is_cached_after_the_call():
+    single_flight = SingleFlight()
+    upstream = Upstream()
+    upstream.release.set()
+
+    single_flight.do(("rag", "question"), upstream.call, "question")
+    single_flight.do(("rag", "question"), upstream.call, "question")
+
+    assert upstream.calls == 2
+
+def test_error_is_shared_with_every_waiter():
+    single_flight = SingleFlight()
+    upstream = Upstream(error=OSError("upstream down"))
+
+    results = run_callers(single_flight, upstream, 3)
+
+    assert all(isinstance(result, OSError) for result in results)
+    assert upstream.calls == 1
+    assert single_flight.get_stats()["errors_shared"] == 2
+
+def test_leader_that_never_returned_is_not_shared_as_none():
+    single_flight = SingleFlight()
+    upstream = Upstream(error=KeyboardInterrupt())
+
+    results = run_callers(single_flight, upstream, 2)
+
+    assert all(isinstance(result, KeyboardInterrupt) for result in results)
+
+def test_waiter_gives_up_after_the_timeout():
+    single_flight = SingleFlight(timeout=0.05)
+    upstream = Upstream()
+    leader = threading.Thread(target=single_flight.do, args=(("rag", "question"), upstream.call, "question"))
+    leader.start()
+    time.sleep(0.01)
+
+    with pytest.raises(SingleFlightTimeout):
+        single_flight.do(("rag", "question"), upstream.call, "question")
+
+    upstream.release.set()
+    leader.join()
+    assert single_flight.get_stats()["timeouts"] == 1
+
+def test_async_callers_share_a_call_a_cancelled_one_does_not_cancel_it():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def lookup(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return "answer to " + value
+
+    async def run():
+        first = asyncio.ensure_future(single_flight.do_async(("rag", "q"), lookup, "q"))
+        second = asyncio.ensure_future(single_flight.do_async(("rag", "q"), lookup, "q"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "answer to q"
+    assert calls == ["q"]
+
+def test_async_error_is_shared():
+    single_flight = SingleFlight()
+
+    async def lookup():
+        await asyncio.sleep(0.01)
+        raise OSError("upstream down")
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do_async(("rag", "q"), lookup) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, OSError) for result in results)
+    assert single_flight.get_stats()["errors_shared"] == 2
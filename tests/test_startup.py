@@ -0,0 +1,29 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from common.startup import retry_until_done
+
+def test_retry_until_done_retries_transient_errors():
+    calls = []
+    errors = []
+
+    def sync():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OSError("list_files failed")
+        return "synced"
+
+    assert retry_until_done(sync, "sync", initial_delay=0, on_error=errors.append) == "synced"
+    assert len(calls) == 3
+    assert [str(error) for error in errors] == ["list_files failed"] * 2
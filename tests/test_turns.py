@@ -0,0 +1,123 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from common.turns import TurnRejected, UserTurns
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def queue_turns(turns, user_id, count, order):
+    # Starts count turns of the user one after the other, each queued before the next arrives
+    threads = []
+    for number in range(count):
+        def run(number=number):
+            with turns.turn(user_id):
+                order.append(number)
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_until(lambda: turns.get_stats()["queued_turns"] == number + 1)
+        threads.append(thread)
+    return threads
+
+def test_turns_of_a_user_run_one_at_a_time_in_arrival_order():
+    turns = UserTurns(max_queue_depth=10)
+    order = []
+
+    turns.acquire("alice")
+    threads = queue_turns(turns, "alice", 5, order)
+    assert order == []
+
+    turns.release("alice")
+    for thread in threads:
+        thread.join()
+
+    assert order == [0, 1, 2, 3, 4]
+    stats = turns.get_stats()
+    assert (stats["turns"], stats["queued"], stats["active_users"]) == (6, 5, 0)
+
+def test_turns_of_other_users_do_not_wait():
+    turns = UserTurns()
+
+    with turns.turn("alice"):
+        started = time.monotonic()
+        with turns.turn("bob"):
+            pass
+        assert time.monotonic() - started < 0.1
+
+def test_full_mailbox_rejects_right_away():
+    turns = UserTurns(max_queue_depth=2)
+    order = []
+
+    turns.acquire("alice")
+    threads = queue_turns(turns, "alice", 1, order)
+
+    with pytest.raises(TurnRejected) as rejected:
+        turns.acquire("alice")
+    assert rejected.value.reason == "too many turns queued"
+    assert turns.get_stats()["rejected_queue_full"] == 1
+
+    turns.release("alice")
+    for thread in threads:
+        thread.join()
+    assert order == [0]
+
+def test_queued_turn_times_out():
+    turns = UserTurns(wait_timeout=0.05)
+
+    turns.acquire("alice")
+    with pytest.raises(TurnRejected) as rejected:
+        turns.acquire("alice")
+    assert "timed out" in rejected.value.reason
+
+    # The turn that timed out left the mailbox, the next one is not stuck behind it
+    turns.release("alice")
+    with turns.turn("alice"):
+        pass
+    assert turns.get_stats()["rejected_timeout"] == 1
+    assert turns.get_stats()["active_users"] == 0
+
+def test_async_turns_run_in_order_and_cancelled_ones_are_skipped():
+    turns = UserTurns(max_queue_depth=4)
+    order = []
+
+    async def run():
+        async def take(number):
+            async with turns.turn_async("alice"):
+                order.append(number)
+
+        await turns.acquire_async("alice")
+        first = asyncio.ensure_future(take(1))
+        cancelled = asyncio.ensure_future(take(2))
+        last = asyncio.ensure_future(take(3))
+        await asyncio.sleep(0.01)
+
+        # The client of the second turn went away while it was queued
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        turns.release("alice")
+        await asyncio.gather(first, last)
+
+    asyncio.run(run())
+
+    assert order == [1, 3]
+    assert turns.get_stats()["active_users"] == 0
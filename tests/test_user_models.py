@@ -0,0 +1,65 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from models import model
+from services.model_cache import ModelCache
+from services.model_writes import ModelWriteBuffer
+from services.user import User
+from tests.firestore_fake import FakeFirestore
+
+def user_service(users):
+    db = FakeFirestore()
+    for user_id in users:
+        db.add_model(user_id, original_material="fur", model=user_id + ".glb")
+    model_writes = ModelWriteBuffer(db)
+    model_writes.thread = object()
+    service = User(db, None, None, None, ModelCache(), model_writes=model_writes, avatars=object())
+    return db, service
+
+def test_get_models_reads_cached_known_and_unknown_models_once():
+    users = ["user%d" % i for i in range(40)]
+    db, service = user_service(users)
+    cached = model.Model.from_dict(dict(db.documents["doc-user0"], color="cached"))
+    service.model_cache.put("user0", cached)
+    service.model_writes.remember("user1", db.collection("models").document("doc-user1"))
+    service.model_writes.update("user2", {"color": "pending"})
+
+    models = service.get_models(["user2", "user0", "user1", "nobody", "user2"] + users[3:])
+
+    assert [found["user_id"] for found in models] == ["user2", "user0", "user1"] + users[3:]
+    assert models[0]["color"] == "pending"
+    assert models[1]["color"] == "cached"
+    # One get_all for the known references, "in" queries of at most 30 ids for the others
+    assert db.get_alls == 1
+    assert db.queries == 1 + 2
+
+def test_get_models_projects_fields():
+    db, service = user_service(["alice"])
+
+    assert service.get_models(["alice"], ["color"]) == [{"user_id": "alice", "color": "red"}]
+    # Partial models are not cached
+    assert service.model_cache.get("alice") is None
+
+@pytest.mark.parametrize("user_ids, fields", [
+    ([{}], None),
+    ([["alice"]], None),
+    (["alice"], ["color", "password"]),
+])
+def test_iter_models_rejects_bad_requests_right_away(user_ids, fields):
+    _, service = user_service(["alice"])
+
+    with pytest.raises(ValueError):
+        service.iter_models(user_ids, fields)